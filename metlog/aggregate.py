@@ -0,0 +1,281 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+In-process aggregation of metrics that would be too chatty to send one
+message per observation. A MetlogClient hands every `gauge` and `unique`
+observation (and every keyed `incr`) to its aggregator, which returns the
+finished aggregates to be sent as each flush interval ends.
+"""
+try:
+    import simplejson as json
+except ImportError:
+    import json  # NOQA
+
+from metlog.util import HyperLogLog, LRUCache, SpaceSaving
+import bisect
+import random
+import threading
+import time
+
+# default histogram bucket upper bounds for aggregated timers, in ms
+TIMER_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                 10000)
+
+
+class _Histogram(object):
+    """
+    Bucketed timer observations, w/ a small reservoir sample of exemplar
+    observations kept for each bucket.
+    """
+    def __init__(self, bounds, reservoir_size):
+        self.bounds = bounds
+        self.reservoir_size = reservoir_size
+        # one more bucket than bounds, for values past the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.exemplars = [[] for i in xrange(len(bounds) + 1)]
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, elapsed, exemplar_id):
+        index = bisect.bisect_left(self.bounds, elapsed)
+        self.counts[index] += 1
+        seen = self.counts[index]
+        self.sum += elapsed
+        if self.min is None or elapsed < self.min:
+            self.min = elapsed
+        if self.max is None or elapsed > self.max:
+            self.max = elapsed
+        if not self.reservoir_size:
+            return
+        # reservoir sampling, so every observation in the bucket has the
+        # same chance of being an exemplar
+        reservoir = self.exemplars[index]
+        exemplar = [elapsed, round(time.time(), 3), exemplar_id]
+        if len(reservoir) < self.reservoir_size:
+            reservoir.append(exemplar)
+        else:
+            slot = random.randrange(seen)
+            if slot < self.reservoir_size:
+                reservoir[slot] = exemplar
+
+    def upper_bound(self, index):
+        # None stands in for infinity, which JSON can't represent
+        return self.bounds[index] if index < len(self.bounds) else None
+
+    def payload(self):
+        buckets = []
+        exemplars = []
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            upper = self.upper_bound(index)
+            buckets.append([upper, count])
+            exemplars.extend([upper] + exemplar
+                             for exemplar in self.exemplars[index])
+        return {'buckets': buckets, 'exemplars': exemplars}
+
+
+# indexes into the per-name state lists
+_TYPE, _LOGGER, _SEVERITY, _FIELDS, _VALUE, _MIN, _MAX, _COUNT = range(8)
+
+
+class MetricAggregator(object):
+    """
+    Collects gauge, unique, keyed counter and timer observations over fixed
+    flush intervals. Gauges keep the last, minimum and maximum values seen;
+    uniques feed a HyperLogLog sketch to estimate the number of distinct
+    keys; keyed counters feed a Space-Saving sketch that tracks the most
+    frequent keys of each counter; timers are bucketed into a histogram
+    that keeps a few exemplar observations per bucket. At the end of each
+    interval one message per name is produced, and all state is reset.
+
+    Intervals are only checked when an observation comes in, so the last
+    interval before a quiet period is reported late, or when `flush` is
+    called.
+    """
+    def __init__(self, flush_interval=10, max_names=1000, precision=10,
+                 top_k=10, top_capacity=None, timer_buckets=TIMER_BUCKETS,
+                 exemplars=1, exemplar_field='request_id'):
+        """
+        :param flush_interval: Length in seconds of each aggregation
+                               interval.
+        :param max_names: Maximum number of gauge and unique names tracked
+                          per interval. When a new name shows up, the least
+                          recently used name is reported early to make room.
+        :param precision: HyperLogLog precision for unique counts, see
+                          `metlog.util.HyperLogLog`.
+        :param top_k: Number of keys reported per keyed counter.
+        :param top_capacity: Number of keys tracked per keyed counter,
+                             defaults to 4 times `top_k`. More counters give
+                             more accurate counts for the top keys.
+        :param timer_buckets: Sorted sequence of histogram bucket upper
+                              bounds for timers, in the timers' units.
+        :param exemplars: Number of exemplar observations kept per histogram
+                          bucket.
+        :param exemplar_field: Name of the `fields` key (e.g. a request id
+                               bound to the client) whose value is recorded
+                               w/ each exemplar.
+        """
+        self.flush_interval = float(flush_interval)
+        self.precision = int(precision)
+        self.top_k = int(top_k)
+        if top_capacity is None:
+            top_capacity = 4 * self.top_k
+        self.top_capacity = max(int(top_capacity), self.top_k)
+        if isinstance(timer_buckets, basestring):
+            timer_buckets = timer_buckets.split()
+        self.timer_buckets = tuple(sorted(float(bound)
+                                          for bound in timer_buckets))
+        self.exemplars = int(exemplars)
+        self.exemplar_field = exemplar_field
+        self._names = LRUCache(int(max_names), self._evicted)
+        self._pending = []
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def _evicted(self, key, state):
+        self._pending.append(self._aggregate(key[1], state))
+
+    def _aggregate(self, name, state):
+        """
+        Build an aggregate, a `(type, logger, severity, payload, fields)`
+        tuple ready to be sent as a message.
+        """
+        fields = dict(state[_FIELDS]) if state[_FIELDS] else {}
+        fields['name'] = name
+        fields['count'] = state[_COUNT]
+        fields['window'] = self.flush_interval
+        if state[_TYPE] == 'gauge':
+            fields['min'] = state[_MIN]
+            fields['max'] = state[_MAX]
+            payload = str(state[_VALUE])
+        elif state[_TYPE] == 'histogram':
+            histogram = state[_VALUE]
+            fields.pop(self.exemplar_field, None)
+            fields['sum'] = histogram.sum
+            fields['min'] = histogram.min
+            fields['max'] = histogram.max
+            payload = json.dumps(histogram.payload(), separators=(',', ':'))
+        elif state[_TYPE] == 'top':
+            sketch = state[_VALUE]
+            top = sketch.top(self.top_k)
+            fields['total'] = sketch.total
+            fields['other'] = sketch.total - sum(entry[1] for entry in top)
+            payload = json.dumps([[key, count] for key, count, error in top],
+                                 separators=(',', ':'))
+            if top:
+                fields['max_error'] = max(entry[2] for entry in top)
+        else:
+            payload = str(len(state[_VALUE]))
+        return (state[_TYPE], state[_LOGGER], state[_SEVERITY], payload,
+                fields)
+
+    def _roll(self, now):
+        """End the current interval if it's over."""
+        if now - self._start >= self.flush_interval:
+            self._start = now
+            self._pending.extend(self._aggregate(key[1], state)
+                                 for key, state in self._names.items())
+            self._names.clear()
+
+    def _take_pending(self):
+        if not self._pending:
+            return ()
+        pending, self._pending = self._pending, []
+        return pending
+
+    def _state(self, type, name, logger, severity, fields):
+        key = (type, name)
+        state = self._names.get(key)
+        if state is None:
+            state = [type, None, None, None, None, None, None, 0]
+            self._names[key] = state
+        # the most recent observation's message settings win
+        state[_LOGGER] = logger
+        state[_SEVERITY] = severity
+        state[_FIELDS] = fields
+        state[_COUNT] += 1
+        return state
+
+    def gauge(self, name, value, logger=None, severity=None, fields=None):
+        """
+        Record a gauge value. Returns a sequence of finished aggregates.
+        """
+        with self._lock:
+            self._roll(time.time())
+            state = self._state('gauge', name, logger, severity, fields)
+            state[_VALUE] = value
+            if state[_MIN] is None or value < state[_MIN]:
+                state[_MIN] = value
+            if state[_MAX] is None or value > state[_MAX]:
+                state[_MAX] = value
+            return self._take_pending()
+
+    def unique(self, name, key, logger=None, severity=None, fields=None):
+        """
+        Record an occurrence of `key` for a unique count. Returns a sequence
+        of finished aggregates.
+        """
+        with self._lock:
+            self._roll(time.time())
+            state = self._state('unique', name, logger, severity, fields)
+            if state[_VALUE] is None:
+                state[_VALUE] = HyperLogLog(self.precision)
+            state[_VALUE].add(key)
+            return self._take_pending()
+
+    def top(self, name, key, count=1, logger=None, severity=None,
+            fields=None):
+        """
+        Increment the `key` member of the `name` counter family. Returns a
+        sequence of finished aggregates.
+        """
+        with self._lock:
+            self._roll(time.time())
+            state = self._state('top', name, logger, severity, fields)
+            if state[_VALUE] is None:
+                state[_VALUE] = SpaceSaving(self.top_capacity)
+            state[_VALUE].add(key, count)
+            return self._take_pending()
+
+    def timing(self, name, elapsed, logger=None, severity=None,
+               fields=None):
+        """
+        Record a timer observation. The value of the `exemplar_field` key of
+        `fields`, if any, is recorded as the exemplar id. Returns a sequence
+        of finished aggregates.
+        """
+        exemplar_id = fields.get(self.exemplar_field) if fields else None
+        with self._lock:
+            self._roll(time.time())
+            state = self._state('histogram', name, logger, severity, fields)
+            if state[_VALUE] is None:
+                state[_VALUE] = _Histogram(self.timer_buckets, self.exemplars)
+            state[_VALUE].add(elapsed, exemplar_id)
+            return self._take_pending()
+
+    def flush(self):
+        """
+        End the current interval early, returning the aggregates for
+        everything recorded so far.
+        """
+        with self._lock:
+            self._start = time.time()
+            ready = self._pending
+            ready.extend(self._aggregate(key[1], state)
+                         for key, state in self._names.items())
+            self._names.clear()
+            self._pending = []
+        return ready
@@ -14,6 +14,13 @@
 #
 # ***** END LICENSE BLOCK *****
 from __future__ import absolute_import
+try:
+    import simplejson as json
+except ImportError:
+    import json  # NOQA
+
+import copy
+import itertools
 import os
 import random
 import socket
@@ -22,10 +29,16 @@ import threading
 import time
 import traceback
 import types
+import weakref
 
+from collections import deque
 from datetime import datetime
 from functools import wraps
+from metlog.aggregate import MetricAggregator
+from metlog.instrument import ClientStats
+from metlog.instrument import clock as _clock
 from metlog.senders import NoSendSender
+from metlog.util import ContextLocal, HyperLogLog, LRUCache, hash_fraction
 
 
 class SEVERITY:
@@ -42,6 +55,77 @@ class SEVERITY:
     DEBUG = 7
 
 
+def _rfc3339_now():
+    """Return the current UTC time as an RFC3339 timestamp string."""
+    utcnow = datetime.utcnow()
+    if utcnow.microsecond == 0:
+        return "%s.000000Z" % utcnow.isoformat()
+    return "%sZ" % utcnow.isoformat()
+
+
+class OldstylePayload(object):
+    """
+    Deferred payload for 'oldstyle' messages. Holds the format string, the
+    format args and any exception info, and only does the (potentially
+    expensive) string formatting and traceback rendering if the message makes
+    it through the client's filters.
+    """
+    __slots__ = ('msg', 'args', 'exc_info')
+
+    def __init__(self, msg, args=(), exc_info=None):
+        self.msg = msg
+        self.args = args
+        self.exc_info = exc_info
+
+    def format_message(self):
+        """Return the message w/ the args interpolated, but no traceback."""
+        msg = self.msg
+        if not isinstance(msg, basestring):
+            msg = str(msg)
+        if self.args:
+            msg = msg % self.args
+        return msg
+
+    @staticmethod
+    def append_traceback(msg, tb_text):
+        """Append rendered traceback text to a formatted message."""
+        if tb_text[-1:] == '\n':
+            tb_text = tb_text[:-1]
+        if msg[-1:] != '\n':
+            msg = msg + '\n'
+        try:
+            return msg + tb_text
+        except UnicodeError:
+            return msg + tb_text.decode(sys.getfilesystemencoding())
+
+    @staticmethod
+    def format_tb(tb):
+        """
+        Return the formatted lines of `tb`, which is either a traceback object
+        or a list of entries as returned by `traceback.extract_tb`.
+        """
+        if isinstance(tb, list):
+            return traceback.format_list(tb)
+        return traceback.format_tb(tb)
+
+    def render(self):
+        """Return the fully formatted payload string."""
+        msg = self.format_message()
+        exc_info = self.exc_info
+        if exc_info:
+            exc_type, exc_value, tb = exc_info
+            tb_lines = []
+            if tb:
+                tb_lines.append('Traceback (most recent call last):\n')
+                tb_lines.extend(self.format_tb(tb))
+            tb_lines.extend(traceback.format_exception_only(exc_type,
+                                                            exc_value))
+            msg = self.append_traceback(msg, ''.join(tb_lines))
+        return msg
+
+    __str__ = render
+
+
 class _NoOpTimer(object):
     """
     A bogus timer object that will act as a contextdecorator but which
@@ -61,28 +145,85 @@ class _NoOpTimer(object):
         return False
 
 
+# `timer_units` setting -> multiplier to convert seconds to those units
+TIMER_SCALES = {'ms': 1000, 'us': 1000000}
+
+# timer message settings used when none are passed to `MetlogClient.timer`,
+# i.e. (logger, severity, fields, rate)
+_DEFAULT_TIMER_DATA = (None, None, None, 1.0)
+
+
+# per thread (or greenlet) timer state, a weak key dict mapping each
+# `_Timer` used in that thread to its `[start, result, msg_data]` list;
+# entries go away when the timer is garbage collected (e.g. after being
+# evicted from its client's registry), and the whole dict w/ the thread
+_timer_local = ContextLocal()
+
+# indexes into the timer state lists
+_START, _RESULT, _MSG_DATA = 0, 1, 2
+
+
+def _timer_states():
+    try:
+        return _timer_local.states
+    except AttributeError:
+        states = _timer_local.states = weakref.WeakKeyDictionary()
+        return states
+
+
 class _Timer(object):
-    """A contextdecorator for timing."""
+    """
+    A contextdecorator for timing. The start time, result, and the message
+    settings from the most recent `MetlogClient.timer` call are kept
+    separately for each thread (or gevent greenlet, see
+    `metlog.util.ContextLocal`), so one timer object can be shared by
+    concurrent threads.
+    """
 
-    def __init__(self, client, name, msg_data):
-        # most attributes on a _Timer object should be threadlocal, except for
-        # a few which we put directly in the __dict__
-        self.__dict__['client'] = client
-        self.__dict__['_local'] = threading.local()
-        self.__dict__['name'] = name
-        self.msg_data = msg_data
+    def __init__(self, client, name, msg_data=_DEFAULT_TIMER_DATA,
+                 units='ms'):
+        """
+        :param client: MetlogClient used to send the timer message.
+        :param name: Timer name.
+        :param msg_data: Tuple of `(logger, severity, fields, rate)` message
+                         settings.
+        :param units: Units in which elapsed time is reported, 'ms' or 'us'.
+        """
+        self.client = client
+        self.name = name
+        self.units = units
+        self._scale = TIMER_SCALES[units]
+        # keeping a plain weak reference around lets the state lookups
+        # reuse it instead of creating a new one each time
+        self._ref = weakref.ref(self)
+        self._state()[_MSG_DATA] = msg_data
 
-    def __delattr__(self, attr):
-        """Store thread-local data safely."""
-        delattr(self._local, attr)
+    def _state(self):
+        try:
+            states = _timer_local.states
+        except AttributeError:
+            states = _timer_states()
+        state = states.get(self)
+        if state is None:
+            state = states[self] = [None, None, _DEFAULT_TIMER_DATA]
+        return state
 
-    def __getattr__(self, attr):
-        """Store thread-local data safely."""
-        return getattr(self._local, attr)
+    @property
+    def msg_data(self):
+        return self._state()[_MSG_DATA]
 
-    def __setattr__(self, attr, value):
-        """Store thread-local data safely."""
-        setattr(self._local, attr, value)
+    @msg_data.setter
+    def msg_data(self, msg_data):
+        self._state()[_MSG_DATA] = msg_data
+
+    @property
+    def start(self):
+        return self._state()[_START]
+
+    @property
+    def result(self):
+        """Elapsed time of this thread's most recently completed block."""
+        return self._state()[_RESULT]
 
     def __call__(self, fn):
         """
@@ -99,15 +240,271 @@ class _Timer(object):
         return wrapped
 
     def __enter__(self):
-        self.start = time.time()
+        state = self._state()
+        state[_RESULT] = None
+        state[_START] = _clock()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        state = self._state()
+        elapsed = int(round((_clock() - state[_START]) * self._scale))
+        state[_RESULT] = elapsed
+        logger, severity, fields, rate = state[_MSG_DATA]
+        if self.units == 'ms':
+            self.client.timer_send(self.name, elapsed, logger, severity,
+                                   fields, rate)
+        else:
+            self.client.timer_send(self.name, elapsed, logger, severity,
+                                   fields, rate, units=self.units)
+        return False
+
+
+class _SpanTree(object):
+    """
+    Per-request buffer collecting the finished spans of one root span.
+    """
+    def __init__(self, max_spans):
+        self.trace_id = '%016x' % random.getrandbits(64)
+        self.start = _clock()
+        self.max_spans = max_spans
+        self.records = []
+        self.dropped = 0
+        self._ids = itertools.count(1)
+
+    def next_id(self):
+        return next(self._ids)
+
+    def add(self, record, root=False):
+        # the root span finishes last but is always kept
+        if root or len(self.records) < self.max_spans - 1:
+            self.records.append(record)
+        else:
+            self.dropped += 1
+
+
+class _Span(object):
+    """
+    A single use context manager timing one span. Spans opened while
+    another span is active (in the same thread or greenlet) become its
+    children. Nothing is sent until the root span exits, at which point the
+    whole tree is sent as a single 'spans' message.
+    """
+    def __init__(self, client, name, logger=None, severity=None,
+                 fields=None):
+        self.client = client
+        self.name = name
+        self.logger = logger
+        self.severity = severity
+        self.fields = fields
+        self.parent = None
+        self.tree = None
+        self.span_id = None
+        self.start = None
         self.result = None
+
+    @property
+    def trace_id(self):
+        """Id shared by all of the spans in a tree, once entered."""
+        return self.tree.trace_id if self.tree is not None else None
+
+    def __enter__(self):
+        local = self.client._span_local
+        parent = getattr(local, 'span', None)
+        if parent is None:
+            self.tree = _SpanTree(self.client.max_spans)
+        else:
+            self.tree = parent.tree
+        self.parent = parent
+        self.span_id = self.tree.next_id()
+        local.span = self
+        self.start = _clock()
+        return self
+
+    def __exit__(self, typ, value, tb):
+        end = _clock()
+        client = self.client
+        tree = self.tree
+        scale = TIMER_SCALES[client.timer_units]
+        self.result = int(round((end - self.start) * scale))
+        parent_id = self.parent.span_id if self.parent is not None else 0
+        tree.add([self.span_id, parent_id, self.name,
+                  int(round((self.start - tree.start) * scale)),
+                  self.result], self.parent is None)
+        client._span_local.span = self.parent
+        if self.parent is None:
+            client._send_spans(self)
+        return False
+
+
+class _SendErrorReporter(object):
+    """
+    Reports message delivery failures to stderr w/o flooding it: the first
+    failure is written out in full, after which failures are only counted,
+    per exception type, and a single summary is written per `interval`.
+    `pending` is the number of failures not yet reported; the client checks
+    `due` as messages go by, so the last failures of an outage are reported
+    even when no further failure comes along.
+    """
+    # longest message representation included in a report
+    max_detail = 500
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.pending = 0
+        self._counts = {}
+        self._last_report = None
+        self._latest = None
+        self._lock = threading.Lock()
+
+    def report(self, exc, msg):
+        """Count a failure, writing a report if one is due."""
+        now = time.time()
+        with self._lock:
+            name = type(exc).__name__
+            self._counts[name] = self._counts.get(name, 0) + 1
+            self._latest = (exc, msg)
+            if (self._last_report is not None and
+                now - self._last_report < self.interval):
+                self.pending += 1
+                return
+            self._last_report = now
+            counts, self._counts = self._counts, {}
+            self.pending = 0
+        self._write(counts, exc, msg)
+
+    def due(self, now):
+        """Return True if there are pending failures ready to be reported."""
+        return bool(self.pending) and now - self._last_report >= self.interval
+
+    def flush(self):
+        """Write a summary of any failures not yet reported."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            latest = self._latest
+            self._last_report = time.time()
+            self.pending = 0
+        if counts:
+            self._write(counts, *latest)
+
+    def _write(self, counts, exc, msg):
+        detail = unicode(str(msg), errors='ignore')
+        if len(detail) > self.max_detail:
+            detail = detail[:self.max_detail] + u'...'
+        detail = detail.encode('utf8')
+        total = sum(counts.itervalues())
+        if total == 1:
+            err_msg = "Error sending message (%s): [%s]\n" % (repr(exc),
+                                                              detail)
+        else:
+            summary = ', '.join('%s: %d' % item
+                                for item in sorted(counts.iteritems()))
+            err_msg = ("Errors sending messages, %d failures in the last "
+                       "%d seconds (%s), latest (%s): [%s]\n" %
+                       (total, self.interval, summary, repr(exc), detail))
+        sys.stderr.write(err_msg)
+
+
+# envelope keys shared by all of the messages in a scope's composite message
+_SCOPE_SHARED_KEYS = frozenset(['env_version', 'metlog_pid',
+                                'metlog_hostname'])
+
+
+class _Scope(object):
+    """
+    A single use context manager for the messages generated in the current
+    thread or greenlet while it's active. Messages can be collected and
+    sent as one composite 'scope' message on exit, and low severity
+    messages can be held back and only sent if the scope turns out to be
+    slow or to have logged an error. A scope entered while another one is
+    already active joins the outer scope.
+    """
+    def __init__(self, client, logger=None, severity=None, fields=None,
+                 max_messages=100, composite=True, hold_severity=None,
+                 keep_severity=SEVERITY.ERROR, latency_threshold=None,
+                 max_held=100):
+        self.client = client
+        self.logger = logger
+        self.severity = severity
+        self.fields = fields
+        self.max_messages = max_messages
+        self.composite = composite
+        self.hold_severity = hold_severity
+        self.keep_severity = keep_severity
+        self.latency_threshold = latency_threshold
+        self.messages = []
+        self.held = deque(maxlen=max_held)
+        self.held_dropped = 0
+        self.retained = None
+        self.closed = False
+        self._keep = False
+        self._start = None
+        self._outer = None
+        self._owner = False
+
+    def hold(self, msg):
+        """
+        Check a message before it's rendered, returning True if it's been
+        held back until the scope exits. Messages as severe as
+        `keep_severity` mark the scope's held messages to be kept.
+        """
+        if self.closed or self.hold_severity is None:
+            return False
+        severity = msg.get('severity')
+        if severity is None:
+            severity = self.client.severity
+        if severity <= self.keep_severity:
+            self._keep = True
+        if severity < self.hold_severity:
+            return False
+        if len(self.held) == self.held.maxlen:
+            self.held_dropped += 1
+        self.held.append(msg)
+        return True
+
+    def add(self, msg):
+        """
+        Buffer a rendered message for the composite message, returning False
+        if it should be sent on its own instead.
+        """
+        if self.closed or not self.composite:
+            return False
+        self.messages.append(msg)
+        if len(self.messages) >= self.max_messages:
+            self.client._flush_scope(self)
+        return True
+
+    def __enter__(self):
+        local = self.client._scope_local
+        outer = getattr(local, 'scope', None)
+        if outer is None or outer.closed:
+            local.scope = self
+            self._owner = True
+        self._outer = outer
+        self._start = _clock()
         return self
 
     def __exit__(self, typ, value, tb):
-        elapsed = time.time() - self.start
-        elapsed = int(round(elapsed * 1000))  # Convert to ms.
-        self.result = elapsed
-        self.client.timer_send(self.name, elapsed, **self.msg_data)
+        if not self._owner:
+            return False
+        client = self.client
+        if self.hold_severity is not None:
+            # a scope that dies w/ an exception counts as failed
+            keep = self._keep or typ is not None
+            if not keep and self.latency_threshold is not None:
+                elapsed = (_clock() - self._start) * 1000
+                keep = elapsed >= self.latency_threshold
+            self.retained = keep
+            held, self.held = self.held, ()
+            self.hold_severity = None
+            if keep:
+                for msg in held:
+                    client._deliver(msg)
+            else:
+                client._stats.dropped += len(held)
+            client._stats.dropped += self.held_dropped
+        client._scope_local.scope = self._outer
+        self.closed = True
+        client._flush_scope(self)
         return False
 
 
@@ -120,7 +517,13 @@ class MetlogClient(object):
     env_version = '0.8'
 
     def __init__(self, sender, logger, severity=6,
-                 disabled_timers=None, filters=None):
+                 disabled_timers=None, filters=None, sample_key=None,
+                 sampler=None, deduper=None, exc_aggregator=None,
+                 max_timers=1000, max_timer_names=None,
+                 overflow_timer_name='overflow', timer_units='ms',
+                 max_spans=1000, aggregator=None, aggregate_timers=False,
+                 stats_interval=None, error_interval=60,
+                 fallback_sender=None, latency_sample=100):
         """
         :param sender: A sender object used for actual message delivery.
         :param logger: Default `logger` value for all sent messages.
@@ -132,11 +535,75 @@ class MetlogClient(object):
         :param disabled_timers: Sequence of string tokens identifying timers
                                 that should be deactivated.
         :param filters: A sequence of filter callables.
+        :param sample_key: Optional name of a `fields` key (e.g. a request id)
+                           whose value should determine the sampling
+                           decision when a `rate` is used, so that all
+                           metrics sharing that value are kept or dropped
+                           together.
+        :param sampler: Optional sampler object (see `metlog.sampling`) that
+                        adjusts the sample rate of timers and counters at
+                        runtime.
+        :param deduper: Optional deduper object (see `metlog.dedupe`) used to
+                        suppress repeated messages.
+        :param exc_aggregator: Optional exception aggregator object (see
+                               `metlog.dedupe`) used to render messages w/
+                               exception info.
+        :param max_timers: Maximum number of timer objects to cache, the least
+                           recently used is discarded when full.
+        :param max_timer_names: Optional limit on the number of distinct
+                                timer names. Names seen after the limit is
+                                reached are all timed under
+                                `overflow_timer_name`, w/ the (approximate)
+                                number of distinct names folded into it in
+                                `fields['folded_names']`.
+        :param overflow_timer_name: Timer name used for names over the
+                                    `max_timer_names` limit.
+        :param timer_units: Units for the elapsed times measured by `timer`,
+                            either 'ms' (the default) or 'us'. Microsecond
+                            timings are flagged w/ `fields['units']`. Also
+                            used for span timings.
+        :param max_spans: Maximum number of spans recorded per root span,
+                          further spans are only counted.
+        :param aggregator: Optional aggregator object (see
+                           `metlog.aggregate`) used for `gauge` and `unique`
+                           metrics. Defaults to a `MetricAggregator` w/ a
+                           10 second flush interval.
+        :param aggregate_timers: If True, timings are aggregated into one
+                                 'histogram' message per timer name per
+                                 flush interval, w/ exemplar observations
+                                 (see `metlog.aggregate`), instead of being
+                                 sent individually.
+        :param stats_interval: Optional number of seconds btn
+                               'metlog_internal' messages reporting the
+                               client's own `stats`.
+        :param error_interval: Minimum number of seconds btn reports of
+                               message delivery failures to stderr. Failures
+                               in btn are counted by exception type and
+                               reported as a summary.
+        :param fallback_sender: Optional sender to which messages are passed
+                                when the main sender fails.
+        :param latency_sample: Render and send latencies are measured for
+                               one in every `latency_sample` messages, to
+                               keep the clock calls off most messages' path.
+                               1 measures every message, 0 or None none.
         """
-        self.setup(sender, logger, severity, disabled_timers, filters)
+        # created before `setup`, so reconfiguration doesn't reset them
+        self._stats = ClientStats()
+        self._error_reporter = _SendErrorReporter(error_interval)
+        self.setup(sender, logger, severity, disabled_timers, filters,
+                   sample_key, sampler, deduper, exc_aggregator, max_timers,
+                   max_timer_names, overflow_timer_name, timer_units,
+                   max_spans, aggregator, aggregate_timers, stats_interval,
+                   error_interval, fallback_sender, latency_sample)
         self._dynamic_methods = {}
-        self._timer_obs = {}
+        # context fields merged into every message, see `bind`; timers are
+        # shared w/ child clients so they're always tied to the root client
+        self._bound_fields = None
+        self._root = self
         self._noop_timer = _NoOpTimer()
+        # currently active span and scope, per thread or greenlet
+        self._span_local = ContextLocal()
+        self._scope_local = ContextLocal()
         self.hostname = socket.gethostname()
         self.pid = os.getpid()
 
@@ -144,7 +611,12 @@ class MetlogClient(object):
         random.seed()
 
     def setup(self, sender=None, logger='', severity=6, disabled_timers=None,
-              filters=None):
+              filters=None, sample_key=None, sampler=None, deduper=None,
+              exc_aggregator=None, max_timers=1000, max_timer_names=None,
+              overflow_timer_name='overflow', timer_units='ms',
+              max_spans=1000, aggregator=None, aggregate_timers=False,
+              stats_interval=None, error_interval=60, fallback_sender=None,
+              latency_sample=100):
         """
         :param sender: A sender object used for actual message delivery.
         :param logger: Default `logger` value for all sent messages.
@@ -152,6 +624,30 @@ class MetlogClient(object):
         :param disabled_timers: Sequence of string tokens identifying timers
                                 that should be deactivated.
         :param filters: A sequence of filter callables.
+        :param sample_key: Optional `fields` key used for deterministic
+                           sampling, see `__init__`.
+        :param sampler: Optional sampler object, see `__init__`.
+        :param deduper: Optional deduper object, see `__init__`.
+        :param exc_aggregator: Optional exception aggregator object, see
+                               `__init__`.
+        :param max_timers: Maximum number of cached timer objects.
+        :param max_timer_names: Optional distinct timer name limit, see
+                                `__init__`.
+        :param overflow_timer_name: Timer name used for names over the
+                                    `max_timer_names` limit.
+        :param timer_units: Units for `timer` measurements, 'ms' or 'us'.
+        :param max_spans: Maximum number of spans recorded per root span.
+        :param aggregator: Optional aggregator object, see `__init__`.
+        :param aggregate_timers: Aggregate timings into histograms, see
+                                 `__init__`.
+        :param stats_interval: Optional number of seconds btn
+                               'metlog_internal' stats messages.
+        :param error_interval: Minimum number of seconds btn delivery
+                               failure reports, see `__init__`.
+        :param fallback_sender: Optional sender used when the main sender
+                                fails.
+        :param latency_sample: Measure latencies for one in every
+                               `latency_sample` messages, see `__init__`.
         """
         if sender is None:
             sender = NoSendSender()
@@ -168,6 +664,35 @@ class MetlogClient(object):
         if filters is None:
             filters = list()
         self.filters = filters
+        self.sample_key = sample_key
+        self.sampler = sampler
+        self.deduper = deduper
+        self.exc_aggregator = exc_aggregator
+        if aggregator is None:
+            aggregator = MetricAggregator()
+        self.aggregator = aggregator
+        self.aggregate_timers = aggregate_timers
+        # INI values may come in as strings
+        if stats_interval is not None:
+            stats_interval = float(stats_interval)
+        self.stats_interval = stats_interval
+        self._stats_sent = time.time()
+        self._error_reporter.interval = float(error_interval)
+        self.fallback_sender = fallback_sender
+        self.latency_sample = int(latency_sample) if latency_sample else 0
+
+        # timer registry and cardinality guard
+        if timer_units not in TIMER_SCALES:
+            raise ValueError('Unsupported timer_units: %r' % timer_units)
+        self.timer_units = timer_units
+        self._timer_lock = threading.Lock()
+        self._timer_obs = LRUCache(max_timers)
+        self.max_timer_names = max_timer_names
+        self.overflow_timer_name = overflow_timer_name
+        self._timer_names = set()
+        self._folded_names = HyperLogLog()
+        self.folded_timer_names = 0
+        self.max_spans = max_spans
 
     @property
     def is_active(self):
@@ -178,23 +703,175 @@ class MetlogClient(object):
         """
         return not isinstance(self.sender, NoSendSender)
 
+    def _sampled_out(self, rate, fields):
+        """
+        Decide whether a message w/ the given sample `rate` should be dropped.
+        If the client has a `sample_key` and it's in `fields`, the decision
+        is a hash of its value, otherwise it's random.
+        """
+        if self.sample_key is not None and fields:
+            key = fields.get(self.sample_key)
+            if key is not None:
+                return hash_fraction(key) >= rate
+        return random.random() >= rate
+
     def send_message(self, msg):
         """
         Apply any filters and, if required, pass message along to the sender
         for delivery.
         """
+        if (self.stats_interval is not None and
+            time.time() - self._stats_sent >= self.stats_interval):
+            self._send_stats()
+        if (self._error_reporter.pending and
+            self._error_reporter.due(time.time())):
+            self._error_reporter.flush()
+        stats = self._stats
+        stats.created += 1
         for filter_fn in self.filters:
             if not filter_fn(msg):
+                stats.filtered += 1
+                return
+        if self.deduper is not None:
+            forward, summaries = self.deduper.check(msg)
+            for summary in summaries:
+                summary['timestamp'] = _rfc3339_now()
+                self._deliver(summary)
+            if not forward:
+                stats.suppressed += 1
+                return
+        self._deliver(msg)
+
+    def _deliver(self, msg, buffered=True):
+        """
+        Finish rendering the message and hand it to the sender (or the active
+        scope's buffer), reporting any errors to stderr.
+        """
+        stats = self._stats
+        every = self.latency_sample
+        timed = every and not stats.created % every
+        scope = None
+        if buffered and isinstance(msg, dict):
+            scope = getattr(self._scope_local, 'scope', None)
+            if scope is not None and scope.hold(msg):
+                stats.held += 1
                 return
         try:
-            self.sender.send_message(msg)
+            try:
+                payload = msg['payload']
+            except (TypeError, KeyError):
+                payload = None
+            if isinstance(payload, OldstylePayload):
+                if timed:
+                    start = _clock()
+                if payload.exc_info and self.exc_aggregator is not None:
+                    self.exc_aggregator.render(msg, payload)
+                else:
+                    msg['payload'] = payload.render()
+                if timed:
+                    stats.render_time.record(_clock() - start)
+            if scope is not None and scope.add(msg):
+                return
+            if timed:
+                start = _clock()
+                self.sender.send_message(msg)
+                stats.send_time.record(_clock() - start)
+            else:
+                self.sender.send_message(msg)
+            stats.sent += 1
         except StandardError, e:
-            unicode_msg = unicode(str(msg), errors='ignore')
+            stats.errors += 1
+            self._error_reporter.report(e, msg)
+            if self.fallback_sender is not None:
+                try:
+                    self.fallback_sender.send_message(msg)
+                    stats.fallback_sent += 1
+                except StandardError:
+                    stats.fallback_errors += 1
+
+    def scope(self, logger=None, severity=None, fields=None,
+              max_messages=100, composite=True, hold_severity=None,
+              keep_severity=SEVERITY.ERROR, latency_threshold=None,
+              max_held=100):
+        """
+        Return a new scope object, a context manager for the messages
+        generated in the current thread or greenlet while it's active, after
+        filtering.
+
+        By default the messages are collected and sent as a single 'scope'
+        message when the scope exits, instead of one message each. The
+        composite message's payload is a JSON list of the collected messages
+        w/o the envelope values they share (`env_version`, `metlog_pid`,
+        `metlog_hostname`, and `logger` when it matches the scope's).
+        `fields['count']` holds the number of messages. A scope that only
+        collected a single message sends it unchanged.
+
+        If `hold_severity` is set, messages at that severity or lower (e.g.
+        `SEVERITY.DEBUG`) are held back, unrendered, until the scope exits.
+        They're then sent only if the scope logged a message at
+        `keep_severity` or higher, raised an exception, or took at least
+        `latency_threshold` ms, and are otherwise discarded. The decision is
+        stored in the scope's `retained` attribute.
+
+        :param logger: String token identifying the message generator,
+                       defaults to the client's `logger`.
+        :param severity: Numerical code (0-7) for the composite message's
+                         severity, defaults to the most severe of the
+                         collected messages.
+        :param fields: Arbitrary key/value pairs for add'l metadata on the
+                       composite message.
+        :param max_messages: Maximum number of messages to collect, a
+                             composite message is sent early when reached.
+        :param composite: Set to False to send messages individually, e.g.
+                          when only holding back low severity messages.
+        :param hold_severity: Optional severity at or below which messages
+                              are held until the scope exits.
+        :param keep_severity: Severity at or above which a message causes
+                              the held messages to be sent.
+        :param latency_threshold: Optional duration, in ms, at or above
+                                  which the held messages are sent.
+        :param max_held: Maximum number of messages to hold, the oldest are
+                         discarded (and counted in `held_dropped`) beyond
+                         that.
+        """
+        return _Scope(self, logger, severity, fields, max_messages,
+                      composite, hold_severity, keep_severity,
+                      latency_threshold, max_held)
 
-            err_msg = "Error sending message (%s): [%s]" % \
-                      (repr(e), unicode_msg.encode("utf8"))
-            sys.stderr.write(err_msg)
+    def _flush_scope(self, scope):
+        """Send the messages collected by `scope` as a composite message."""
+        messages, scope.messages = scope.messages, []
+        if not messages:
             return
+        if len(messages) == 1:
+            self._deliver(messages[0], buffered=False)
+            return
+        logger = scope.logger if scope.logger is not None else self.logger
+        entries = []
+        for msg in messages:
+            entry = dict((key, value) for key, value in msg.iteritems()
+                         if key not in _SCOPE_SHARED_KEYS)
+            if entry.get('logger') == logger:
+                del entry['logger']
+            entries.append(entry)
+        try:
+            payload = json.dumps(entries, separators=(',', ':'))
+        except (TypeError, ValueError):
+            # unserializable content, let the messages fend for themselves
+            for msg in messages:
+                self._deliver(msg, buffered=False)
+            return
+        severity = scope.severity
+        if severity is None:
+            severity = min(msg.get('severity', self.severity)
+                           for msg in messages)
+        fields = dict(scope.fields) if scope.fields else {}
+        fields['count'] = len(messages)
+        full_msg = dict(type='scope', timestamp=_rfc3339_now(),
+                        logger=logger, severity=severity, payload=payload,
+                        fields=fields, env_version=self.env_version,
+                        metlog_pid=self.pid, metlog_hostname=self.hostname)
+        self._deliver(full_msg, buffered=False)
 
     def add_method(self, method, override=False):
         """
@@ -220,6 +897,55 @@ class MetlogClient(object):
         meth = types.MethodType(method, self, self.__class__)
         setattr(self, name, meth)
 
+    def bind(self, **fields):
+        """
+        Return a child client that adds `fields` (on top of any fields bound
+        to this client) to every message it generates. The child shares this
+        client's sender, filters, helpers and timer registry, so binding
+        is cheap enough to do per request. The merged context fields are
+        computed once, here. Messages w/o `fields` of their own share that
+        dict, others get a copy w/ the per-call `fields` layered on top;
+        neither dict is ever modified.
+        """
+        child = copy.copy(self)
+        bound = dict(self._bound_fields) if self._bound_fields else {}
+        bound.update(fields)
+        child._bound_fields = bound
+        # dynamic methods are bound to their instance
+        child._dynamic_methods = dict(self._dynamic_methods)
+        for name, method in child._dynamic_methods.iteritems():
+            setattr(child, name,
+                    types.MethodType(method, child, child.__class__))
+        return child
+
+    @property
+    def bound_fields(self):
+        """Copy of the context fields bound to this client."""
+        return dict(self._bound_fields) if self._bound_fields else {}
+
+    def _copy_fields(self, fields):
+        """
+        Return a new dict w/ the bound fields overlaid by `fields`, leaving
+        both untouched.
+        """
+        bound = self._bound_fields
+        if not bound:
+            return dict(fields) if fields else {}
+        merged = dict(bound)
+        if fields:
+            merged.update(fields)
+        return merged
+
+    def _merge_fields(self, fields):
+        """
+        Return the bound fields overlaid by `fields`. W/o per-call fields
+        that's the bound dict itself, which is shared and mustn't be
+        modified; use `_copy_fields` for a dict that can be annotated.
+        """
+        if not fields:
+            return self._bound_fields
+        return self._copy_fields(fields)
+
     def metlog(self, type, logger=None, severity=None, payload='',
                fields=None):
         """
@@ -229,17 +955,20 @@ class MetlogClient(object):
         :param logger: String token identifying the message generator.
         :param severity: Numerical code (0-7) for msg severity, per RFC 5424.
         :param payload: Actual message contents.
-        :param fields: Arbitrary key/value pairs for add'l metadata.
+        :param fields: Arbitrary key/value pairs for add'l metadata. Merged
+                       w/ any bound fields, see `bind`.
         """
+        if self._bound_fields is not None:
+            fields = self._merge_fields(fields)
+        self._metlog(type, logger, severity, payload, fields)
+
+    def _metlog(self, type, logger, severity, payload, fields):
+        """Wrap a message in the envelope and send it, w/o merging fields."""
         logger = logger if logger is not None else self.logger
         severity = severity if severity is not None else self.severity
         fields = fields if fields is not None else dict()
         # have to make sure we've got good RFC3339 time formatting
-        utcnow = datetime.utcnow()
-        if utcnow.microsecond == 0:
-            timestamp = "%s.000000Z" % utcnow.isoformat()
-        else:
-            timestamp = "%sZ" % utcnow.isoformat()
+        timestamp = _rfc3339_now()
 
         full_msg = dict(type=type, timestamp=timestamp, logger=logger,
                         severity=severity, payload=payload, fields=fields,
@@ -262,26 +991,109 @@ class MetlogClient(object):
                      used then some percentage of the timers will do nothing.
         """
         # check if timer(s) is(are) disabled or if we exclude for sample rate
-        if ((self._disabled_timers.intersection(set(['*', name]))) or
-            (rate < 1.0 and random.random() >= rate)):
+        disabled = self._disabled_timers
+        if disabled and ('*' in disabled or name in disabled):
+            return self._noop_timer
+        if self._bound_fields is not None:
+            fields = self._merge_fields(fields)
+        if self.sampler is not None:
+            rate = self.sampler.rate(name, rate)
+        if rate < 1.0 and self._sampled_out(rate, fields):
+            self._stats.sampled_out += 1
             return self._noop_timer
-        msg_data = dict(logger=logger, severity=severity, fields=fields,
-                        rate=rate)
-        if name in self._timer_obs:
-            timer = self._timer_obs[name]
-            timer.msg_data = msg_data
+        if (self.max_timer_names is not None and
+            name not in self._timer_names and
+            not self._admit_timer_name(name)):
+            name = self.overflow_timer_name
+            fields = dict(fields) if fields else {}
+            fields['folded_names'] = self.folded_timer_names
+        if (logger is None and severity is None and fields is None and
+            rate == 1.0):
+            # the common case, no need to build a new tuple
+            msg_data = _DEFAULT_TIMER_DATA
         else:
-            timer = _Timer(self, name, msg_data)
-            self._timer_obs[name] = timer
+            msg_data = (logger, severity, fields, rate)
+        with self._timer_lock:
+            timer = self._timer_obs.get(name)
+            if timer is None:
+                timer = _Timer(self._root, name, msg_data, self.timer_units)
+                self._timer_obs[name] = timer
+        timer._state()[_MSG_DATA] = msg_data
         return timer
 
+    def span(self, name, logger=None, severity=None, fields=None):
+        """
+        Return a new span object, a context manager that times a block of
+        code as part of a tree of nested spans. Each span gets an id unique
+        within its tree and records the id of the span that was active when
+        it was entered (its parent, 0 for the root). Rather than one message
+        per span, a single 'spans' message is generated when the root span
+        exits.
+
+        The message payload is a JSON list of `[span_id, parent_id, name,
+        start, elapsed]` entries, w/ `start` being the offset from the
+        start of the root span; times are in `timer_units`. The root span's
+        name, the tree's random `trace_id`, the units and the number of
+        spans are sent in `fields`, along w/ any `fields` provided for the
+        root span.
+
+        :param name: Required string label for the span.
+        :param logger: String token identifying the message generator, only
+                       used for a root span.
+        :param severity: Numerical code (0-7) for msg severity, per RFC 5424,
+                         only used for a root span.
+        :param fields: Arbitrary key/value pairs for add'l metadata, only
+                       used for a root span.
+        """
+        if self._bound_fields is not None:
+            fields = self._merge_fields(fields)
+        return _Span(self, name, logger, severity, fields)
+
+    def current_span(self):
+        """
+        Return the span active in the current thread or greenlet, or None.
+        """
+        return getattr(self._span_local, 'span', None)
+
+    def _send_spans(self, root):
+        """Generate the 'spans' message for a finished root span."""
+        tree = root.tree
+        fields = dict(root.fields) if root.fields else {}
+        fields['name'] = root.name
+        fields['trace_id'] = tree.trace_id
+        fields['units'] = self.timer_units
+        fields['spans'] = len(tree.records) + tree.dropped
+        if tree.dropped:
+            fields['dropped_spans'] = tree.dropped
+        # children finish first, sort so the root leads; bound fields were
+        # merged into the root's fields by `span`
+        records = sorted(tree.records)
+        self._metlog('spans', root.logger, root.severity,
+                     json.dumps(records, separators=(',', ':')), fields)
+
+    def _admit_timer_name(self, name):
+        """
+        Check a new timer name against the `max_timer_names` limit. Returns
+        True if the name can be used, False if it has to be folded into the
+        overflow timer, in which case it's counted in `folded_timer_names`.
+        """
+        with self._timer_lock:
+            if name == self.overflow_timer_name:
+                return True
+            if len(self._timer_names) < self.max_timer_names:
+                self._timer_names.add(name)
+                return True
+            if self._folded_names.add(name):
+                self.folded_timer_names = len(self._folded_names)
+        return False
+
     def timer_send(self, name, elapsed, logger=None, severity=None,
-                   fields=None, rate=1.0):
+                   fields=None, rate=1.0, units='ms'):
         """
         Converts timing data into a metlog message for delivery.
 
         :param name: Required string label for the timer.
-        :param elapsed: Elapsed time of the timed event, in ms.
+        :param elapsed: Elapsed time of the timed event, in ms (or `units`).
         :param logger: String token identifying the message generator.
         :param severity: Numerical code (0-7) for msg severity, per RFC 5424.
         :param fields: Arbitrary key/value pairs for add'l metadata.
@@ -289,14 +1101,26 @@ class MetlogClient(object):
                      rate is *NOT* enforced in this method, i.e. all messages
                      will be sent through to metlog, sample rate is purely
                      informational at this point.
+        :param units: Units of `elapsed`, 'ms' (the default) or 'us'. Anything
+                      other than ms is noted in `fields['units']`.
+
+        If the client's `aggregate_timers` is set, the timing is handed to the
+        aggregator instead of being sent right away.
         """
         payload = str(elapsed)
-        fields = fields if fields is not None else dict()
-        fields.update({'name': name, 'rate': rate})
-        self.metlog('timer', logger, severity, payload, fields)
+        fields = self._copy_fields(fields)
+        fields['name'] = name
+        fields['rate'] = rate
+        if units != 'ms':
+            fields['units'] = units
+        if self.aggregate_timers:
+            self._send_aggregates(self.aggregator.timing(name, elapsed, logger,
+                                                         severity, fields))
+            return
+        self._metlog('timer', logger, severity, payload, fields)
 
     def incr(self, name, count=1, logger=None, severity=None, fields=None,
-             rate=1.0):
+             rate=1.0, key=None):
         """
         Sends an 'increment counter' message.
 
@@ -305,39 +1129,146 @@ class MetlogClient(object):
         :param logger: String token identifying the message generator.
         :param severity: Numerical code (0-7) for msg severity, per RFC 5424.
         :param fields: Arbitrary key/value pairs for add'l metadata.
+        :param rate: Sample rate, btn 0 & 1, inclusive. Ignored for keyed
+                     counters.
+        :param key: Optional high cardinality key (e.g. a URL) within the
+                    `name` counter family. Keyed counts are aggregated by
+                    the client's aggregator, and a single 'top' message is
+                    sent per family per flush interval w/ the most frequent
+                    keys and their counts as a JSON list payload, and the
+                    `total` and `other` (i.e. not in the top keys) counts in
+                    `fields`.
         """
-        if rate < 1 and random.random() >= rate:
+        if key is not None:
+            if self._bound_fields is not None:
+                fields = self._merge_fields(fields)
+            self._send_aggregates(self.aggregator.top(name, key, count,
+                                                      logger, severity,
+                                                      fields))
+            return
+        if self.sampler is not None:
+            rate = self.sampler.rate(name, rate)
+        fields = self._copy_fields(fields)
+        if rate < 1 and self._sampled_out(rate, fields):
+            self._stats.sampled_out += 1
             return
         payload = str(count)
-        fields = fields if fields is not None else dict()
         fields['name'] = name
         fields['rate'] = rate
-        self.metlog('counter', logger, severity, payload, fields)
+        self._metlog('counter', logger, severity, payload, fields)
+
+    def gauge(self, name, value, logger=None, severity=None, fields=None):
+        """
+        Record the current value of a gauge. Values are aggregated by the
+        client's aggregator, and a single 'gauge' message is sent per name
+        per flush interval, w/ the last value as payload and the `min`,
+        `max` and `count` of the values in `fields`.
+
+        :param name: String label for the gauge.
+        :param value: Numeric value of the gauge.
+        :param logger: String token identifying the message generator.
+        :param severity: Numerical code (0-7) for msg severity, per RFC 5424.
+        :param fields: Arbitrary key/value pairs for add'l metadata. Those
+                       of the last value in the interval are sent.
+        """
+        if self._bound_fields is not None:
+            fields = self._merge_fields(fields)
+        self._send_aggregates(self.aggregator.gauge(name, value, logger,
+                                                    severity, fields))
+
+    def unique(self, name, key, logger=None, severity=None, fields=None):
+        """
+        Record an occurrence of `key` (e.g. a user id) for an approximate
+        count of distinct keys. A single 'unique' message is sent per name
+        per flush interval, w/ the estimated number of distinct keys as
+        payload and the number of occurrences in `fields['count']`.
+
+        :param name: String label for the unique count.
+        :param key: Hashable value to be counted.
+        :param logger: String token identifying the message generator.
+        :param severity: Numerical code (0-7) for msg severity, per RFC 5424.
+        :param fields: Arbitrary key/value pairs for add'l metadata. Those
+                       of the last occurrence in the interval are sent.
+        """
+        if self._bound_fields is not None:
+            fields = self._merge_fields(fields)
+        self._send_aggregates(self.aggregator.unique(name, key, logger,
+                                                     severity, fields))
+
+    def _send_aggregates(self, aggregates):
+        for type, logger, severity, payload, fields in aggregates:
+            self._metlog(type, logger, severity, payload, fields)
+
+    def flush(self):
+        """
+        Send everything the client is holding on to for a later interval,
+        i.e. the current `gauge` and `unique` aggregates, any pending
+        deduper summaries and the summaries of filters that have a `flush`
+        function (e.g. `rate_limit_provider`), and report any delivery
+        failures still waiting to be summarized. Useful at shutdown.
+        """
+        self._send_aggregates(self.aggregator.flush())
+        if self.deduper is not None:
+            for summary in self.deduper.flush():
+                summary['timestamp'] = _rfc3339_now()
+                self._deliver(summary)
+        for filter_fn in self.filters:
+            flush_filter = getattr(filter_fn, 'flush', None)
+            summary = flush_filter() if flush_filter is not None else None
+            if summary is not None:
+                # delivered directly, the filters could drop it otherwise
+                full_msg = dict(timestamp=_rfc3339_now(), logger=self.logger,
+                                env_version=self.env_version,
+                                metlog_pid=self.pid,
+                                metlog_hostname=self.hostname)
+                full_msg.update(summary)
+                self._deliver(full_msg)
+        self._error_reporter.flush()
+
+    def stats(self):
+        """
+        Return a dictionary of the client's self-instrumentation: counts of
+        messages `created` (i.e. passed to `send_message`), `filtered` out,
+        `suppressed` by the deduper, `sampled_out` (timers and counters),
+        `held` and `dropped` by scopes, `sent` and failed w/ `errors`, and
+        passed to the fallback sender (`fallback_sent`, or `fallback_errors`
+        if it failed too), plus `render_time` (formatting 'oldstyle'
+        payloads) and `send_time` (in `sender.send_message`, which usually
+        includes serialization) latency histograms, which only hold the
+        messages sampled per `latency_sample`. If the sender has a `stats`
+        method its results are included under `sender`.
+        """
+        result = self._stats.snapshot()
+        sender_stats = getattr(self.sender, 'stats', None)
+        if callable(sender_stats):
+            result['sender'] = sender_stats()
+        return result
+
+    def _send_stats(self):
+        """Send a 'metlog_internal' message w/ the current `stats`."""
+        self._stats_sent = time.time()
+        stats = self.stats()
+        fields = dict((name, stats[name]) for name in ClientStats.COUNTERS)
+        fields['send_time_mean_us'] = stats['send_time']['mean_us']
+        fields['send_time_max_us'] = stats['send_time']['max_us']
+        self._metlog('metlog_internal', None, None,
+                     json.dumps(stats, separators=(',', ':')), fields)
 
     # Standard Python logging API emulation
     def _oldstyle(self, severity, msg, *args, **kwargs):
-        """Do any necessary string formatting and then generate the msg"""
+        """
+        Generate the msg, deferring any string formatting until the filters
+        have decided that the message will actually be delivered.
+        """
         # if `args` is a mapping then extract it
         if (len(args) == 1 and hasattr(args[0], 'keys')
             and hasattr(args[0], '__getitem__')):
             args = args[0]
-        if args:
-            msg = msg % args
         exc_info = kwargs.get('exc_info', False)
-        if exc_info:
-            if not isinstance(exc_info, tuple):
-                exc_info = sys.exc_info()
-            tb_lines = traceback.format_exception(exc_info[0], exc_info[1],
-                                                  exc_info[2])
-            s = ''.join(tb_lines)
-            if s[-1:] == '\n':
-                s = s[:-1]
-            if msg[-1:] != '\n':
-                msg = msg + '\n'
-            try:
-                msg = msg + s
-            except UnicodeError:
-                msg = msg + s.decode(sys.getfilesystemencoding())
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        if args or exc_info or not isinstance(msg, basestring):
+            msg = OldstylePayload(msg, args, exc_info)
         self.metlog(type='oldstyle', severity=severity, payload=msg)
 
     def debug(self, msg, *args, **kwargs):
@@ -14,9 +14,11 @@
 # ***** END LICENSE BLOCK *****
 from datetime import datetime
 from docopt import docopt
+from metlog.client import MetlogClient
 from metlog.config import client_from_dict_config, client_from_stream_config
 import json
 import socket
+import time
 
 mb_doc = """mb: MetlogBench, blast messages at a Metlog router.
 
@@ -69,3 +71,49 @@ def mb():
 
     while True:
         client.metlog('MBTEST', payload='MBTEST')
+
+
+mbtimer_doc = """mbtimer: measure the overhead of MetlogClient timers.
+
+Usage:
+  mbtimer [--iterations=<n>] [--us]
+
+Options:
+  --iterations=<n>  Number of timed blocks per run [default: 200000]
+  --us              Report timings in microseconds
+"""
+
+
+class _NullSender(object):
+    """Sender that discards everything, so only client overhead is measured."""
+    def send_message(self, msg):
+        pass
+
+
+def mbtimer():
+    arguments = docopt(mbtimer_doc)
+    iterations = int(arguments['--iterations'])
+    kwargs = {}
+    if arguments.get('--us'):
+        kwargs['timer_units'] = 'us'
+    client = MetlogClient(_NullSender(), 'mbtimer', **kwargs)
+    disabled = MetlogClient(_NullSender(), 'mbtimer', disabled_timers=['*'])
+
+    def run(client):
+        start = time.time()
+        for i in xrange(iterations):
+            with client.timer('bench'):
+                pass
+        return (time.time() - start) / iterations * 1e6
+
+    def empty():
+        start = time.time()
+        for i in xrange(iterations):
+            pass
+        return (time.time() - start) / iterations * 1e6
+
+    baseline = min(empty() for i in range(3))
+    enabled = min(run(client) for i in range(3)) - baseline
+    noop = min(run(disabled) for i in range(3)) - baseline
+    print 'enabled timer:  %.2f us per block' % enabled
+    print 'disabled timer: %.2f us per block' % noop
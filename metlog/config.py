@@ -22,6 +22,15 @@ import json
 import os
 import re
 
+# optional MetlogClient settings that are passed through as is
+_CLIENT_OPTIONS = ('sample_key', 'max_timers', 'max_timer_names',
+                   'overflow_timer_name', 'timer_units', 'max_spans',
+                   'aggregate_timers', 'stats_interval', 'error_interval',
+                   'latency_sample')
+# optional MetlogClient helper objects, configured like the sender
+_CLIENT_HELPERS = ('sampler', 'deduper', 'exc_aggregator',
+                   'aggregator', 'fallback_sender')
+
 _IS_INTEGER = re.compile('^-?[0-9].*')
 _IS_ENV_VAR = re.compile('\$\{(\w.*)?\}')
 
@@ -81,7 +90,7 @@ def nest_prefixes(config_dict, prefixes=None, separator="_"):
                       key.
     """
     if prefixes is None:
-        prefixes = ['sender', 'global']
+        prefixes = ['sender'] + list(_CLIENT_HELPERS) + ['global']
     for prefix in prefixes:
         prefix_dict = {}
         for key in config_dict.keys():
@@ -97,6 +106,17 @@ def nest_prefixes(config_dict, prefixes=None, separator="_"):
     return config_dict
 
 
+def _instantiate(resolver, spec):
+    """
+    Create an object from a config dictionary w/ a `class` dotted name, an
+    optional `args` sequence, and any remaining values as keyword arguments.
+    Mutates `spec`.
+    """
+    cls = resolver.resolve(spec.pop('class'))
+    args = spec.pop('args', tuple())
+    return cls(*args, **spec)
+
+
 def client_from_dict_config(config, client=None, clear_global=False):
     """
     Configure a metlog client, fully configured w/ sender and plugins.
@@ -115,6 +135,32 @@ def client_from_dict_config(config, client=None, clear_global=False):
       Metlog client default severity value.
     disabled_timers
       Sequence of string tokens identifying timers that are to be deactivated.
+    sample_key
+      Name of a `fields` key whose value determines sampling decisions for
+      timers and counters, instead of chance.
+    max_timers
+      Maximum number of timer objects the client will cache.
+    max_timer_names
+      Maximum number of distinct timer names, further names are folded into
+      the `overflow_timer_name` timer.
+    overflow_timer_name
+      Name of the timer that absorbs names over the `max_timer_names` limit.
+    timer_units
+      Units for timer measurements, either 'ms' (the default) or 'us'.
+    max_spans
+      Maximum number of spans recorded per root span.
+    aggregate_timers
+      If true, timings are aggregated into histograms w/ exemplars by the
+      client's aggregator instead of being sent individually.
+    stats_interval
+      Optional number of seconds btn 'metlog_internal' messages reporting the
+      client's own stats.
+    error_interval
+      Minimum number of seconds btn reports of message delivery failures
+      written to stderr, defaults to 60.
+    latency_sample
+      Render and send latencies are measured for one in every
+      `latency_sample` messages, defaults to 100; 0 turns measuring off.
     filters
       Sequence of 2-tuples `(filter_provider, config)`. Each `filter_provider`
       is a dotted name referring to a function which, when called and passed
@@ -129,6 +175,23 @@ def client_from_dict_config(config, client=None, clear_global=False):
       method.
     sender
       Nested dictionary containing sender configuration.
+    sampler
+      Optional nested dictionary containing sampler configuration, in the same
+      format as the sender configuration (see below).
+    deduper
+      Optional nested dictionary containing deduper configuration, in the same
+      format as the sender configuration (see below).
+    exc_aggregator
+      Optional nested dictionary containing exception aggregator
+      configuration, in the same format as the sender configuration (see
+      below).
+    aggregator
+      Optional nested dictionary containing gauge/unique aggregator
+      configuration, in the same format as the sender configuration (see
+      below).
+    fallback_sender
+      Optional nested dictionary containing the configuration of a sender to
+      be used for messages the main sender fails to deliver.
     global
       Dictionary to be applied to CLIENT_HOLDER's `global_config` storage.
       New config will overwrite any conflicting values, but will not delete
@@ -139,9 +202,11 @@ def client_from_dict_config(config, client=None, clear_global=False):
     sender may result in a non-functional Metlog client. Any unrecognized keys
     will be ignored.
 
-    Note that any top level config values starting with `sender_` will be added
-    to the `sender` config dictionary, overwriting any values that may already
-    be set.
+    Note that any top level config values starting with `sender_` (or
+    `sampler_`, `deduper_`, `exc_aggregator_`, `aggregator_`,
+    `fallback_sender_`) will be added to the `sender` (or `sampler`,
+    `deduper`, `exc_aggregator`, `aggregator`, `fallback_sender`) config
+    dictionary, overwriting any values that may already be set.
 
     The sender configuration supports the following values:
 
@@ -162,6 +227,8 @@ def client_from_dict_config(config, client=None, clear_global=False):
     logger = config.get('logger', '')
     severity = config.get('severity', 6)
     disabled_timers = config.get('disabled_timers', [])
+    client_kwargs = dict((key, config[key]) for key in _CLIENT_OPTIONS
+                         if key in config)
     filter_specs = config.get('filters', [])
     plugins_data = config.pop('plugins', {})
     global_conf = config.get('global', {})
@@ -174,11 +241,11 @@ def client_from_dict_config(config, client=None, clear_global=False):
 
     resolver = DottedNameResolver()
 
-    # instantiate sender
-    sender_clsname = sender_config.pop('class')
-    sender_cls = resolver.resolve(sender_clsname)
-    sender_args = sender_config.pop('args', tuple())
-    sender = sender_cls(*sender_args, **sender_config)
+    # instantiate sender and optional helper objects
+    sender = _instantiate(resolver, sender_config)
+    for helper in _CLIENT_HELPERS:
+        if config.get(helper):
+            client_kwargs[helper] = _instantiate(resolver, config[helper])
 
     # initialize filters
     filters = [resolver.resolve(dotted_name)(**cfg)
@@ -187,9 +254,10 @@ def client_from_dict_config(config, client=None, clear_global=False):
     # instantiate and/or configure client
     if client is None:
         client = MetlogClient(sender, logger, severity, disabled_timers,
-                              filters)
+                              filters, **client_kwargs)
     else:
-        client.setup(sender, logger, severity, disabled_timers, filters)
+        client.setup(sender, logger, severity, disabled_timers, filters,
+                     **client_kwargs)
 
     # initialize plugins and attach to client
     for section_name, plugin_spec in plugins_data.items():
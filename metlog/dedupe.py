@@ -0,0 +1,238 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+Suppression of repeated messages. A deduper can be given to a MetlogClient,
+which will consult it for every message that makes it through the filters.
+Similarly, an exception aggregator can be given to a client to take over
+rendering of messages that carry exception info.
+"""
+from metlog.util import LRUCache
+import hashlib
+import threading
+import time
+import traceback
+
+# indexes into the per-fingerprint entries
+_START, _REPEATS, _ENVELOPE, _TEMPLATE = 0, 1, 2, 3
+
+
+class MessageDeduper(object):
+    """
+    Forwards the first of a run of identical messages and swallows the
+    repeats that follow within `window` seconds. Messages are considered
+    identical if they have the same type, logger, severity and payload
+    template (i.e. the format string of an 'oldstyle' message, before any
+    args are interpolated), and carry the same exception (by type and
+    traceback locations, see `ExceptionAggregator.fingerprint`), if any.
+
+    Once a fingerprint's window is over, a summary message is generated w/
+    the number of repeats in `fields['repeats']`. Summaries are returned from
+    `check` (for messages of any type) as fingerprints expire, are evicted to
+    make room for new ones, or show up again after their window, and from
+    `flush`.
+    """
+    def __init__(self, window=10, max_fingerprints=1000, types=None):
+        """
+        :param window: Number of seconds after the first occurrence of a
+                       message during which repeats are suppressed.
+        :param max_fingerprints: Maximum number of distinct messages tracked.
+        :param types: Sequence of message types to dedupe, defaults to
+                      'oldstyle' only; deduping e.g. timers would lose data.
+        """
+        if types is None:
+            types = ['oldstyle']
+        elif isinstance(types, basestring):
+            types = [types]
+        self.types = frozenset(types)
+        self.window = float(window)
+        self._seen = LRUCache(int(max_fingerprints), self._evicted)
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _evicted(self, fingerprint, entry):
+        if entry[_REPEATS]:
+            self._pending.append(self._summary(entry))
+
+    def _summary(self, entry):
+        summary = dict(entry[_ENVELOPE])
+        repeats = entry[_REPEATS]
+        summary['payload'] = 'Message repeated %d times: %s' % (
+            repeats, entry[_TEMPLATE])
+        summary['fields'] = {'repeats': repeats, 'window': self.window}
+        return summary
+
+    def check(self, msg):
+        """
+        Register a message. Returns a 2-tuple `(forward, summaries)`, where
+        `forward` is False if the message is a repeat that should be dropped
+        and `summaries` is a sequence of summary messages ready to be sent.
+        """
+        if not isinstance(msg, dict) or msg.get('type') not in self.types:
+            if not self._seen:
+                return True, ()
+            # other messages still sweep, so quiet fingerprints get reported
+            with self._lock:
+                self._sweep(time.time())
+                return True, self._take_pending()
+        payload = msg.get('payload')
+        exc_fingerprint = None
+        if hasattr(payload, 'render'):
+            # deferred 'oldstyle' payload, use the unformatted message
+            template = payload.msg
+            if payload.exc_info:
+                # same message, different exception isn't a repeat
+                exc_fingerprint = ExceptionAggregator.fingerprint(
+                    payload.exc_info[0], payload.exc_info[2])
+        else:
+            template = payload
+        fingerprint = (msg['type'], msg.get('logger'), msg.get('severity'),
+                       template, exc_fingerprint)
+        try:
+            hash(fingerprint)
+        except TypeError:
+            fingerprint = repr(fingerprint)
+        now = time.time()
+        with self._lock:
+            entry = self._seen.get(fingerprint)
+            if entry is not None and now - entry[_START] < self.window:
+                entry[_REPEATS] += 1
+                forward = False
+            else:
+                if entry is not None and entry[_REPEATS]:
+                    self._pending.append(self._summary(entry))
+                envelope = dict(msg)
+                del envelope['payload']
+                self._seen[fingerprint] = [now, 0, envelope, template]
+                forward = True
+            self._sweep(now)
+            summaries = self._take_pending()
+        return forward, summaries
+
+    def _sweep(self, now):
+        """
+        Retire the least recently seen fingerprint if it's done, which over
+        time sweeps out everything that's gone quiet. Must hold the lock.
+        """
+        oldest = self._seen.oldest()
+        if oldest is not None and now - oldest[1][_START] >= self.window:
+            self._seen.pop(oldest[0])
+            self._evicted(*oldest)
+
+    def _take_pending(self):
+        """Return and reset the pending summaries. Must hold the lock."""
+        if not self._pending:
+            return ()
+        summaries = self._pending
+        self._pending = []
+        return summaries
+
+    def flush(self):
+        """
+        Forget all fingerprints, returning summaries for any that have
+        suppressed repeats.
+        """
+        with self._lock:
+            summaries = self._pending
+            self._pending = []
+            for fingerprint, entry in self._seen.items():
+                if entry[_REPEATS]:
+                    summaries.append(self._summary(entry))
+            self._seen.clear()
+        return summaries
+
+
+class ExceptionAggregator(object):
+    """
+    Renders the payloads of messages that carry exception info (e.g. from
+    `MetlogClient.exception`), fingerprinting each exception by its type and
+    the code locations of its traceback frames. The formatted traceback is
+    cached per fingerprint.
+
+    The first occurrence of a fingerprint (and the first after each
+    `window` seconds) gets the full traceback. Repeats within the window get
+    a compact payload w/ just the message, the exception line and the
+    fingerprint. Either way `fields['exc_fingerprint']` and
+    `fields['exc_count']` (the number of occurrences in the current window)
+    are set, so the compact messages can be matched up w/ the full one.
+    """
+    def __init__(self, window=60, max_fingerprints=1000):
+        """
+        :param window: Number of seconds after a full report during which
+                       repeats are sent in compact form.
+        :param max_fingerprints: Maximum number of fingerprints (and cached
+                                 tracebacks) to keep.
+        """
+        self.window = float(window)
+        self._seen = LRUCache(int(max_fingerprints))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(exc_type, tb):
+        """
+        Return a fingerprint string for an exception type and traceback. Only
+        code locations are used, so it's much cheaper than formatting the
+        traceback, which has to read source lines. `tb` can also be a list of
+        entries as returned by `traceback.extract_tb`.
+        """
+        parts = ['%s.%s' % (getattr(exc_type, '__module__', ''),
+                            getattr(exc_type, '__name__', exc_type))]
+        if isinstance(tb, list):
+            parts.extend('%s:%d:%s' % entry[:3] for entry in tb)
+            tb = None
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            parts.append('%s:%d:%s' % (code.co_filename, tb.tb_lineno,
+                                       code.co_name))
+            tb = tb.tb_next
+        return hashlib.md5('\n'.join(parts)).hexdigest()[:16]
+
+    def render(self, msg, payload):
+        """
+        Set the rendered payload and fingerprint fields on `msg`, for an
+        `OldstylePayload` w/ exception info.
+        """
+        exc_type, exc_value, tb = payload.exc_info
+        fingerprint = self.fingerprint(exc_type, tb)
+        now = time.time()
+        with self._lock:
+            # entries are [window start, count, formatted traceback]
+            entry = self._seen.get(fingerprint)
+            if entry is None or now - entry[0] >= self.window:
+                if entry is None:
+                    tb_text = ''.join(payload.format_tb(tb))
+                else:
+                    tb_text = entry[2]
+                entry = [now, 1, tb_text]
+                self._seen[fingerprint] = entry
+                full = True
+            else:
+                entry[1] += 1
+                full = False
+            count = entry[1]
+        exc_text = ''.join(traceback.format_exception_only(exc_type,
+                                                           exc_value))
+        if full:
+            if tb:
+                exc_text = ('Traceback (most recent call last):\n' +
+                            entry[2] + exc_text)
+        else:
+            exc_text = '%s [traceback %s, seen %d times]' % (
+                exc_text.rstrip('\n'), fingerprint, count)
+        msg['payload'] = payload.append_traceback(payload.format_message(),
+                                                  exc_text)
+        # the fields dict may be shared w/ the caller or the client's bound
+        # fields, so annotate a copy
+        fields = msg['fields'] = dict(msg.get('fields') or {})
+        fields['exc_fingerprint'] = fingerprint
+        fields['exc_count'] = count
@@ -20,6 +20,29 @@ Each filter accepts a single `msg` dictionary argument and returns a boolean
 value: True if a message *should* be delivered, False if a message *should not*
 be delivered. Note that the `msg` dictionary *may* be mutated by the filter.
 """
+from metlog.client import SEVERITY
+from metlog.util import LRUCache, hash_fraction
+import random
+import threading
+import time
+
+# message keys that are looked up directly on the message; any other key name
+# used by a filter is looked up in the message's `fields` dictionary
+_MSG_KEYS = frozenset(['type', 'logger', 'severity'])
+
+
+def _key_getter(key):
+    """
+    Return a function that extracts the value of `key` from a message.
+    """
+    if key in _MSG_KEYS:
+        return lambda msg: msg[key]
+
+    def get_field(msg):
+        fields = msg.get('fields')
+        if fields:
+            return fields.get(key)
+    return get_field
 
 
 def severity_max_provider(severity):
@@ -77,3 +100,190 @@ def type_severity_max_provider(types):
         return severity_filter(msg)
 
     return type_severity_max
+
+
+def rate_limit_provider(rate, burst=None, key='type', max_keys=1000,
+                        summary_interval=60):
+    """
+    Filter messages using a token bucket per distinct value of `key`. Each
+    bucket holds up to `burst` tokens and is refilled at `rate` tokens per
+    second; a message is delivered if its bucket has a token to spend.
+
+    :param rate: Number of messages per second allowed through for each key.
+    :param burst: Maximum number of messages that may be sent in a burst,
+                  defaults to `rate` (i.e. one second's worth).
+    :param key: What to rate limit by: 'type', 'logger', 'severity', or the
+                name of a key in the message `fields`.
+    :param max_keys: Maximum number of keys tracked. The least recently seen
+                     key is forgotten when a new one arrives.
+    :param summary_interval: Minimum number of seconds between summaries.
+
+    Suppressed messages are counted, and at most once per `summary_interval`
+    one of them will be turned into a 'rate_limit_summary' message instead of
+    being dropped. The summary payload is the total number of suppressed
+    messages, and `fields['suppressed']` maps each key to its count. Counts
+    that haven't been reported yet (e.g. for the last window before things
+    quieted down) are returned as a summary message by the filter's `flush`
+    function, which `MetlogClient.flush` calls.
+    """
+    rate = float(rate)
+    burst = float(burst) if burst is not None else max(rate, 1.0)
+    summary_interval = float(summary_interval)
+    get_key = _key_getter(key)
+    # counts for keys that were forgotten before they could be reported
+    evicted = {'count': 0}
+
+    def on_evict(bucket_key, bucket):
+        evicted['count'] += bucket[2]
+
+    # each bucket is [tokens, last refill time, suppressed count]
+    buckets = LRUCache(int(max_keys), on_evict)
+    last_summary = [time.time()]
+    lock = threading.Lock()
+
+    def summarize(msg, now):
+        suppressed = {}
+        total = evicted['count']
+        if total:
+            suppressed['__other__'] = total
+        evicted['count'] = 0
+        for bucket_key, bucket in buckets.items():
+            if bucket[2]:
+                suppressed[bucket_key] = bucket[2]
+                total += bucket[2]
+                bucket[2] = 0
+        last_summary[0] = now
+        msg['type'] = 'rate_limit_summary'
+        msg['severity'] = SEVERITY.WARNING
+        msg['payload'] = str(total)
+        msg['fields'] = {'suppressed': suppressed, 'key': key,
+                         'interval': summary_interval}
+        return total
+
+    def rate_limit(msg):
+        now = time.time()
+        msg_key = get_key(msg)
+        with lock:
+            bucket = buckets.get(msg_key)
+            if bucket is None:
+                buckets[msg_key] = [burst - 1, now, 0]
+                return True
+            tokens = bucket[0] + (now - bucket[1]) * rate
+            if tokens > burst:
+                tokens = burst
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return True
+            bucket[0] = tokens
+            bucket[2] += 1
+            if now - last_summary[0] >= summary_interval:
+                summarize(msg, now)
+                return True
+            return False
+
+    def flush():
+        """
+        Return a partial 'rate_limit_summary' message (`type`, `severity`,
+        `payload` and `fields`) for the messages suppressed since the last
+        summary, or None if there weren't any.
+        """
+        summary = {}
+        with lock:
+            if not summarize(summary, time.time()):
+                return None
+        return summary
+
+    rate_limit.flush = flush
+    return rate_limit
+
+
+def _parse_rates(rates):
+    """
+    Normalize a sample rate spec to a dict. Accepts a dict, or (for INI
+    style config) a sequence of (or a single) 'key:rate' strings.
+    """
+    if not rates:
+        return {}
+    if hasattr(rates, 'items'):
+        return dict((key, float(rate)) for key, rate in rates.items())
+    if isinstance(rates, basestring):
+        rates = [rates]
+    parsed = {}
+    for spec in rates:
+        key, rate = spec.rsplit(':', 1)
+        parsed[key.strip()] = float(rate)
+    return parsed
+
+
+# salt for `sample_provider` hash decisions, keeping them independent of
+# `MetlogClient` sampling on the same key
+_SAMPLE_SALT = 'sample_provider'
+
+
+def sample_provider(types=None, loggers=None, severities=None, default=1.0,
+                    hash_key=None):
+    """
+    Randomly sample messages, w/ the sample rate chosen by message type,
+    logger or severity (checked in that order). Each rate is a number btn 0
+    & 1, inclusive (i.e. .5 = 50%).
+
+    :param types: Mapping of message type to sample rate.
+    :param loggers: Mapping of logger name to sample rate.
+    :param severities: Mapping of severity to sample rate. Each rate applies
+                       to the given severity and all less severe
+                       (i.e. numerically higher) ones, up to the next
+                       specified severity.
+    :param default: Sample rate for messages not matched by any of the above.
+    :param hash_key: Optional name of a `fields` key (e.g. a request id). When
+                     a message has this field the keep/drop decision is a hash
+                     of its value instead of chance, so that related messages
+                     are kept or dropped together. The hash is salted, so
+                     the decision is independent of the client's own
+                     `sample_key` sampling and the two rates multiply.
+
+    Messages that are kept w/ a rate of less than 1 have `fields['rate']` set
+    to the effective rate (multiplied by any rate already in there from
+    sampling in e.g. `MetlogClient.incr`) so that downstream counts can be
+    rescaled.
+    """
+    type_rates = _parse_rates(types)
+    logger_rates = _parse_rates(loggers)
+    severity_rates = dict((int(sev), rate) for sev, rate
+                          in _parse_rates(severities).items())
+    default = float(default)
+    # precompute the rate for each possible severity
+    severity_table = []
+    rate = None
+    for severity in range(SEVERITY.DEBUG + 1):
+        rate = severity_rates.get(severity, rate)
+        severity_table.append(default if rate is None else rate)
+    # our own generator, so we don't contend w/ or perturb the global one
+    rand = random.Random().random
+
+    def sample(msg):
+        rate = type_rates.get(msg['type'])
+        if rate is None:
+            rate = logger_rates.get(msg['logger'])
+            if rate is None:
+                severity = msg['severity']
+                if 0 <= severity <= SEVERITY.DEBUG:
+                    rate = severity_table[severity]
+                else:
+                    rate = default
+        if rate >= 1.0:
+            return True
+        fields = msg['fields']
+        if hash_key is not None and hash_key in fields:
+            if hash_fraction(fields[hash_key], _SAMPLE_SALT) >= rate:
+                return False
+        elif rand() >= rate:
+            return False
+        # the message may share its fields dict w/ the caller, so annotate a
+        # copy rather than compounding the rate on every reuse
+        fields = dict(fields)
+        fields['rate'] = fields.get('rate', 1.0) * rate
+        msg['fields'] = fields
+        return True
+
+    return sample
@@ -0,0 +1,111 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+Self-instrumentation for metlog clients and senders: plain counters and
+coarse latency histograms, cheap enough to keep updated on every message.
+Counters are updated w/o locking, so concurrent updates from several threads
+may occasionally be lost; they're meant for monitoring, not accounting.
+"""
+import time
+
+# highest resolution clock available; note that on Python 2 this is the wall
+# clock, so timings can be thrown off by system clock adjustments
+clock = getattr(time, 'perf_counter', time.time)
+
+# number of power of 2 microsecond buckets, the last one is ~16 seconds and up
+_BUCKETS = 25
+
+
+class LatencyHistogram(object):
+    """
+    Records durations in power of 2 microsecond buckets, i.e. w/ a relative
+    precision of a factor of 2, which is enough to tell where time goes.
+    """
+    def __init__(self):
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        Record a duration, in seconds. Negative durations, from the wall
+        clock being set back, are recorded as 0.
+        """
+        if seconds < 0.0:
+            seconds = 0.0
+        micros = int(seconds * 1000000)
+        index = micros.bit_length()
+        if index >= _BUCKETS:
+            index = _BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        """
+        Return a dictionary w/ the `count`, `total_us`, `mean_us` and
+        `max_us` of the recorded durations, and `buckets`, a list of
+        `[upper_bound_us, count]` pairs for the non-empty buckets.
+        """
+        buckets = [[1 << index, count]
+                   for index, count in enumerate(self.counts) if count]
+        total_us = int(self.total * 1000000)
+        return {'count': self.count,
+                'total_us': total_us,
+                'mean_us': total_us // self.count if self.count else 0,
+                'max_us': int(self.max * 1000000),
+                'buckets': buckets}
+
+
+class SenderStats(object):
+    """
+    Counters and serialization timing kept by senders, exposed via their
+    `stats` method.
+    """
+    def __init__(self):
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.serialize_time = LatencyHistogram()
+
+    def snapshot(self):
+        return {'sent': self.sent,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'serialize_time': self.serialize_time.snapshot()}
+
+
+class ClientStats(object):
+    """
+    Counters and timings kept by a MetlogClient, see `MetlogClient.stats`.
+    """
+    # message counters, in reporting order
+    COUNTERS = ('created', 'filtered', 'suppressed', 'sampled_out', 'held',
+                'dropped', 'sent', 'errors', 'fallback_sent',
+                'fallback_errors')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.render_time = LatencyHistogram()
+        self.send_time = LatencyHistogram()
+
+    def snapshot(self):
+        result = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        result['render_time'] = self.render_time.snapshot()
+        result['send_time'] = self.send_time.snapshot()
+        return result
@@ -15,31 +15,157 @@
 from __future__ import absolute_import
 
 from metlog.client import SEVERITY
+import copy
 import logging
+import sys
+import threading
+import traceback
+
+if 'gevent.monkey' in sys.modules:
+    from gevent import queue as Queue
+else:
+    import Queue  # NOQA
+
+
+def _build_level_map():
+    """
+    Precompute the metlog severity for every stdlib logging level up to and
+    including CRITICAL. Non-standard levels get the severity of the closest
+    standard level below them.
+    """
+    thresholds = [(logging.CRITICAL, SEVERITY.CRITICAL),
+                  (logging.ERROR, SEVERITY.ERROR),
+                  (logging.WARNING, SEVERITY.WARNING),
+                  (logging.INFO, SEVERITY.INFORMATIONAL)]
+    level_map = []
+    for levelno in range(logging.CRITICAL + 1):
+        for threshold, severity in thresholds:
+            if levelno >= threshold:
+                break
+        else:
+            severity = SEVERITY.DEBUG
+        level_map.append(severity)
+    return level_map
+
+# maps logging message 'level' (used as index) to metlog 'severity'
+LEVEL_MAP = _build_level_map()
+
+
+def _same(arg):
+    return arg
+
+# shallow copy functions for the mutable arg types queued records snapshot
+_MUTABLE_COPIERS = {list: list, dict: dict, set: set}
 
 
 class MetlogHandler(logging.Handler):
-    def __init__(self, metlog_client):
+    """
+    Logging handler that hands records off to a MetlogClient as 'oldstyle'
+    messages. Message formatting and traceback rendering are deferred until
+    the client's filters have accepted the message.
+
+    If `queue_size` is provided, records are put on a bounded queue and
+    delivered by a background thread, so that logging calls never block on
+    the metlog sender. Records that arrive while the queue is full are
+    dropped and counted in the `dropped` attribute. Queued records carry
+    shallow copies of their mutable args and a pre-extracted traceback, so
+    that later changes to the logging call's arguments don't show up in the
+    message and frames aren't kept alive in the queue, while formatting is
+    still left to the background thread and skipped for filtered records.
+    """
+    def __init__(self, metlog_client, queue_size=None):
+        """
+        :param metlog_client: MetlogClient instance to use for delivery.
+        :param queue_size: Optional maximum number of records to hold for
+                           delivery by a background thread. None means
+                           records are delivered synchronously.
+        """
         logging.Handler.__init__(self)
         self.metlog_client = metlog_client
+        self.dropped = 0
+        self.queue = None
+        if queue_size is not None:
+            self.queue = Queue.Queue(queue_size)
+            self._worker = threading.Thread(target=self._drain)
+            self._worker.daemon = True
+            self._worker.start()
 
-    def emit(self, record):
-        if record.levelno == logging.DEBUG:
-            severity = SEVERITY.DEBUG
-        elif record.levelno == logging.INFO:
-            severity = SEVERITY.INFORMATIONAL
-        elif record.levelno == logging.WARNING:
-            severity = SEVERITY.WARNING
-        elif record.levelno == logging.ERROR:
-            severity = SEVERITY.ERROR
-        else:  # critical
+    @staticmethod
+    def _args(record):
+        args = record.args
+        if not isinstance(args, tuple):
+            # single mapping argument
+            args = (args,) if args else ()
+        return args
+
+    def _deliver(self, record):
+        levelno = record.levelno
+        if 0 <= levelno <= logging.CRITICAL:
+            severity = LEVEL_MAP[levelno]
+        else:
             severity = SEVERITY.CRITICAL
+        self.metlog_client._oldstyle(severity, record.msg,
+                                     *self._args(record),
+                                     exc_info=record.exc_info)
+
+    def _prepare(self, record):
+        """
+        Return a copy of `record` that's safe to queue: mutable args are
+        shallow copied, and the traceback in `exc_info` is replaced by its
+        `traceback.extract_tb` entries. The message itself isn't formatted.
+        """
+        args = record.args
+        if isinstance(args, tuple):
+            args = tuple(_MUTABLE_COPIERS.get(type(arg), _same)(arg)
+                         for arg in args)
+        elif args:
+            args = _MUTABLE_COPIERS.get(type(args), _same)(args)
+        exc_info = record.exc_info
+        if exc_info:
+            exc_info = (exc_info[0], exc_info[1],
+                        traceback.extract_tb(exc_info[2]))
+        record = copy.copy(record)
+        record.args = args
+        record.exc_info = exc_info
+        record.exc_text = None
+        return record
+
+    def _drain(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self._deliver(record)
+            except Exception:
+                self.handleError(record)
+
+    def emit(self, record):
+        try:
+            if self.queue is None:
+                self._deliver(record)
+                return
+            prepared = self._prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(prepared)
+        except Queue.Full:
+            self.dropped += 1
 
-        self.metlog_client.metlog(type='oldstyle', severity=severity,
-                                  payload=record.msg)
+    def close(self):
+        """
+        Stop the background thread, if any, after it has delivered the records
+        that are already queued.
+        """
+        if self.queue is not None and self._worker.is_alive():
+            self.queue.put(None)
+            self._worker.join()
+        logging.Handler.close(self)
 
 
-def hook_logger(logger_name, client):
+def hook_logger(logger_name, client, queue_size=None):
     """
     Used to hook metlog into the Python stdlib logging framework. Registers a
     logging module handler that delegates to a MetlogClient for actual message
@@ -49,6 +175,9 @@ def hook_logger(logger_name, client):
                  handler should be registered.
     :param client: MetlogClient instance that the registered handler will use
                    for actual message delivery.
+    :param queue_size: If provided, the handler will deliver messages from a
+                       background thread via a queue of this size. See
+                       `MetlogHandler`.
     """
     logger = logging.getLogger(logger_name)
     # first check to see if we're already registered
@@ -57,4 +186,4 @@ def hook_logger(logger_name, client):
             existing.metlog_client is client):
             # already done, do nothing
             return
-    logger.addHandler(MetlogHandler(client))
+    logger.addHandler(MetlogHandler(client, queue_size))
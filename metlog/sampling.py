@@ -0,0 +1,94 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+Samplers that can be given to a MetlogClient to choose the sample rate for
+its timers and counters at runtime. A sampler is any object w/ a
+`rate(name, rate)` method, which is called for every `timer` and `incr` call
+and returns the sample rate that should actually be used, given the metric
+name and the rate requested by the caller.
+"""
+from metlog.util import LRUCache
+import threading
+import time
+
+# indexes into the per-name state lists
+_START, _COUNT, _ESTIMATE, _CAP = 0, 1, 2, 3
+
+
+class AdaptiveSampler(object):
+    """
+    Adjusts the sample rate of each timer or counter name so that its
+    messages are generated at (no more than) roughly `target` per second.
+
+    Calls are counted per name over fixed windows; at the end of each window
+    the observed call rate is folded into an exponentially weighted moving
+    average, and the name's rate is capped at `target` divided by that
+    average for the following window. Names start out unsampled.
+    """
+    def __init__(self, target, window=10, smoothing=0.5, max_names=1000):
+        """
+        :param target: Messages per second to aim for, per name.
+        :param window: Length in seconds of each measurement window.
+        :param smoothing: Weight (btn 0 & 1) given to the most recent window
+                          vs. the previous estimate. 1 means only the most
+                          recent window is considered.
+        :param max_names: Maximum number of names to track. State for the
+                          least recently used name is dropped when a new
+                          name shows up.
+        """
+        self.target = float(target)
+        self.window = float(window)
+        self.smoothing = float(smoothing)
+        self._names = LRUCache(int(max_names))
+        self._lock = threading.Lock()
+
+    def rate(self, name, rate=1.0):
+        """
+        Record a call for `name` and return the sample rate to use, i.e. the
+        smaller of the requested `rate` and the current adaptive rate.
+        """
+        now = time.time()
+        with self._lock:
+            state = self._names.get(name)
+            if state is None:
+                state = [now, 0, None, 1.0]
+                self._names[name] = state
+            elapsed = now - state[_START]
+            if elapsed >= self.window:
+                observed = state[_COUNT] / elapsed
+                estimate = state[_ESTIMATE]
+                if estimate is None:
+                    estimate = observed
+                else:
+                    estimate = (self.smoothing * observed +
+                                (1 - self.smoothing) * estimate)
+                state[_ESTIMATE] = estimate
+                if estimate > self.target:
+                    state[_CAP] = self.target / estimate
+                else:
+                    state[_CAP] = 1.0
+                state[_START] = now
+                state[_COUNT] = 0
+            state[_COUNT] += 1
+            cap = state[_CAP]
+        return rate if rate < cap else cap
+
+    def current_rate(self, name):
+        """
+        Return the adaptive rate currently in effect for `name`, w/o counting
+        a call.
+        """
+        with self._lock:
+            state = self._names.get(name)
+        return 1.0 if state is None else state[_CAP]
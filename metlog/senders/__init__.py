@@ -15,6 +15,8 @@ from metlog.senders.dev import FileSender  # NOQA
 from metlog.senders.dev import StdOutSender  # NOQA
 from metlog.senders.dev import StreamSender  # NOQA
 from metlog.senders.dev import DebugCaptureSender  # NOQA
+from metlog.senders.dev import IndexedCaptureSender  # NOQA
+from metlog.senders.ring import RingBufferSender  # NOQA
 from metlog.senders.udp import UdpSender  # NOQA
 
 
@@ -0,0 +1,231 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+Sender for use in asyncio (or trollius) applications. Messages are written
+through a non-blocking datagram transport owned by the event loop, so
+`send_message` never blocks; anything the transport can't accept is dropped
+and counted rather than queued w/o bound.
+"""
+from __future__ import absolute_import
+try:
+    import simplejson as json
+except ImportError:
+    import json  # NOQA
+
+from collections import deque
+from metlog.instrument import LatencyHistogram, clock
+import socket
+import sys
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio  # NOQA
+    except ImportError:
+        asyncio = None  # NOQA
+
+if asyncio is not None:
+    _DatagramProtocol = asyncio.DatagramProtocol
+else:
+    _DatagramProtocol = object
+
+# default maximum number of messages waiting to be written
+MAX_PENDING = 1000
+
+
+class _SenderProtocol(_DatagramProtocol):
+    """
+    Datagram protocol that reports transport events back to its
+    `AsyncioUdpSender`.
+    """
+    def __init__(self, sender):
+        self.sender = sender
+
+    def connection_made(self, transport):
+        self.sender._connection_made(transport)
+
+    def connection_lost(self, exc):
+        self.sender._connection_lost()
+
+    def error_received(self, exc):
+        self.sender.errors += 1
+
+    def pause_writing(self):
+        self.sender.paused = True
+
+    def resume_writing(self):
+        self.sender.paused = False
+
+
+class AsyncioUdpSender(object):
+    """
+    Sends metlog messages out via UDP using an asyncio datagram transport.
+    Must only be used from the event loop's thread.
+
+    By default each message is written as soon as it's sent. If a
+    `flush_interval` is given, messages are instead collected and written in
+    batches by a callback scheduled on the loop, moving the JSON encoding
+    and socket writes out of the calling code's path.
+
+    Messages are dropped, and counted in `dropped`, when more than
+    `max_pending` are waiting to be written or while the transport has
+    paused writing because its buffer is full.
+    """
+    def __init__(self, host, port, loop=None, flush_interval=None,
+                 max_pending=MAX_PENDING):
+        """
+        :param host: Host to which messages should be delivered.
+        :param port: Port to which messages should be delivered.
+        :param loop: Event loop to use, defaults to the current event loop.
+        :param flush_interval: Optional number of seconds to collect messages
+                               before writing them out as a batch.
+        :param max_pending: Maximum number of messages waiting to be
+                            written, e.g. while the transport is being set
+                            up or btn batch flushes.
+        """
+        if asyncio is None:
+            raise ValueError('Must have `asyncio` or `trollius` installed '
+                             'to use AsyncioUdpSender')
+        self.host = host
+        self.port = int(port)
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.flush_interval = (float(flush_interval)
+                               if flush_interval is not None else None)
+        self.max_pending = int(max_pending)
+        self.paused = False
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.serialize_time = LatencyHistogram()
+        self._pending = deque()
+        self._transport = None
+        self._flush_handle = None
+        self._closed = False
+        self.connect()
+
+    def connect(self):
+        """
+        Start setting up the datagram transport, returning a future that
+        completes once it's ready. Called automatically on creation, only
+        needed to reconnect after `close`.
+        """
+        self._closed = False
+        future = asyncio.ensure_future(self.loop.create_datagram_endpoint(
+            lambda: _SenderProtocol(self), remote_addr=(self.host, self.port),
+            family=socket.AF_INET), loop=self.loop)
+        future.add_done_callback(self._connect_done)
+        return future
+
+    def _connect_done(self, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.errors += 1
+            sys.stderr.write('AsyncioUdpSender unable to connect to %s:%d: '
+                             '%s\n' % (self.host, self.port, exc))
+            self.dropped += len(self._pending)
+            self._pending.clear()
+
+    def _connection_made(self, transport):
+        if self._closed:
+            transport.close()
+            return
+        self._transport = transport
+        if self._pending:
+            self._schedule_flush()
+
+    def _connection_lost(self):
+        self._transport = None
+        self.paused = False
+
+    @property
+    def connected(self):
+        return self._transport is not None
+
+    def _schedule_flush(self):
+        if self._flush_handle is not None:
+            return
+        if self.flush_interval is None:
+            self._flush_handle = self.loop.call_soon(self.flush)
+        else:
+            self._flush_handle = self.loop.call_later(self.flush_interval,
+                                                      self.flush)
+
+    def send_message(self, msg):
+        """
+        Queue a message to be serialized and written, w/o blocking.
+
+        :param msg: Dictionary representing the message.
+        """
+        if self.paused or len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(msg)
+        if self._transport is None:
+            # will be flushed once connected
+            return
+        if self.flush_interval is None:
+            self.flush()
+        else:
+            self._schedule_flush()
+
+    def flush(self):
+        """
+        Write out all pending messages. Anything left over when the
+        transport pauses writing is dropped.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        transport = self._transport
+        if transport is None:
+            return
+        pending = self._pending
+        while pending and not self.paused:
+            try:
+                start = clock()
+                data = json.dumps(pending.popleft())
+                if not isinstance(data, bytes):
+                    data = data.encode('utf-8')
+                self.serialize_time.record(clock() - start)
+                transport.sendto(data)
+            except Exception:
+                self.errors += 1
+            else:
+                self.sent += 1
+        if pending:
+            self.dropped += len(pending)
+            pending.clear()
+
+    def stats(self):
+        """
+        Return a dictionary w/ the numbers of messages `sent`, `dropped` and
+        failed w/ `errors`, the number currently `pending`, and the time
+        spent serializing them.
+        """
+        return {'sent': self.sent,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'pending': len(self._pending),
+                'serialize_time': self.serialize_time.snapshot()}
+
+    def close(self):
+        """Flush any pending messages and close the transport."""
+        self.flush()
+        self._closed = True
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
@@ -15,8 +15,11 @@ try:
     import simplejson as json
 except ImportError:
     import json  # NOQA
+import collections
 import sys
+import threading
 
+from metlog.instrument import SenderStats, clock
 from metlog.path import resolve_name
 
 
@@ -32,6 +35,7 @@ class StreamSender(object):
                           string to be written to the stream.
         """
         self.stream = stream
+        self._stats = SenderStats()
         if formatter is None:
             self.formatter = self.default_formatter
         else:
@@ -46,11 +50,30 @@ class StreamSender(object):
         """
         return json.dumps(msg, indent=4)
 
+    def _format(self, msg):
+        """Format a message, recording the time it takes."""
+        start = clock()
+        output = self.formatter(msg)
+        self._stats.serialize_time.record(clock() - start)
+        return output
+
     def send_message(self, msg):
         """Deliver message to the stream object."""
-        output = self.formatter(msg)
-        self.stream.write('%s\n' % output)
-        self.stream.flush()
+        try:
+            output = self._format(msg)
+            self.stream.write('%s\n' % output)
+            self.stream.flush()
+        except Exception:
+            self._stats.errors += 1
+            raise
+        self._stats.sent += 1
+
+    def stats(self):
+        """
+        Return a dictionary w/ the number of messages `sent` and failed w/
+        `errors` and the time spent formatting them.
+        """
+        return self._stats.snapshot()
 
 
 class StdOutSender(StreamSender):
@@ -77,13 +100,141 @@ class DebugCaptureSender(object):
     development.
     """
     def __init__(self, **kwargs):
-        import collections
         self.msgs = collections.deque(maxlen=100)
+        self._stats = SenderStats()
         for k, v in kwargs.items():
             # set arbitrary attributes, useful for testing
             setattr(self, k, v)
 
     def send_message(self, msg):
         """JSONify and append to the circular buffer."""
+        start = clock()
         json_msg = json.dumps(msg)
+        self._stats.serialize_time.record(clock() - start)
+        if len(self.msgs) == self.msgs.maxlen:
+            self._stats.dropped += 1
         self.msgs.append(json_msg)
+        self._stats.sent += 1
+
+    def stats(self):
+        """
+        Return a dictionary w/ the number of messages `sent`, the number of
+        older messages `dropped` from the buffer to make room for them, and
+        the time spent serializing them.
+        """
+        return self._stats.snapshot()
+
+
+class IndexedCaptureSender(object):
+    """
+    Capture metlog messages in a bounded circular buffer, storing them as
+    message dictionaries indexed by `type`, `logger`, `severity` and
+    `fields['name']` so tests can query them w/o JSON decoding or linear
+    scans. Like `DebugCaptureSender`, this is meant for testing and
+    development only.
+    """
+    indexed = ('type', 'logger', 'severity', 'name')
+
+    def __init__(self, capacity=1000, **kwargs):
+        """
+        :param capacity: Maximum number of messages to retain, older messages
+                         are discarded once this is reached. None means
+                         unbounded.
+        """
+        self.capacity = capacity
+        self._stats = SenderStats()
+        self._lock = threading.Lock()
+        self.clear()
+        for k, v in kwargs.items():
+            # set arbitrary attributes, useful for testing
+            setattr(self, k, v)
+
+    def clear(self):
+        """Drop all captured messages."""
+        with self._lock:
+            self.msgs = collections.deque()
+            self._indexes = dict((key, {}) for key in self.indexed)
+
+    def __len__(self):
+        return len(self.msgs)
+
+    @staticmethod
+    def _keys(msg):
+        fields = msg.get('fields') or {}
+        return (('type', msg.get('type')), ('logger', msg.get('logger')),
+                ('severity', msg.get('severity')),
+                ('name', fields.get('name')))
+
+    def send_message(self, msg):
+        """Snapshot the message and add it to the buffer and indexes."""
+        msg = dict(msg)
+        if isinstance(msg.get('fields'), dict):
+            # the caller may reuse its fields dict, so take our own copy
+            msg['fields'] = dict(msg['fields'])
+        with self._lock:
+            if self.capacity is not None and len(self.msgs) >= self.capacity:
+                # messages leave in arrival order, so the oldest message is
+                # always at the front of each of its index buckets
+                oldest = self.msgs.popleft()
+                for key, value in self._keys(oldest):
+                    bucket = self._indexes[key][value]
+                    bucket.popleft()
+                    if not bucket:
+                        del self._indexes[key][value]
+                self._stats.dropped += 1
+            self.msgs.append(msg)
+            for key, value in self._keys(msg):
+                index = self._indexes[key]
+                if value not in index:
+                    index[value] = collections.deque()
+                index[value].append(msg)
+            self._stats.sent += 1
+
+    def stats(self):
+        """
+        Return a dictionary w/ the number of messages `sent` and the number
+        of older messages `dropped` to stay within `capacity`.
+        """
+        return self._stats.snapshot()
+
+    def find(self, **criteria):
+        """
+        Return a list of the captured messages (oldest first) matching all of
+        the provided criteria. `type`, `logger`, `severity` and `name`
+        (i.e. `fields['name']`) are looked up in the indexes, any other
+        keyword is compared against the top level message key of the same
+        name, or, failing that, against the same key in `fields`.
+        """
+        with self._lock:
+            candidates = self.msgs
+            for key in self.indexed:
+                if key in criteria:
+                    bucket = self._indexes[key].get(criteria[key], ())
+                    if len(bucket) < len(candidates):
+                        candidates = bucket
+            candidates = list(candidates)
+        return [msg for msg in candidates if self._matches(msg, criteria)]
+
+    def find_one(self, **criteria):
+        """
+        Return the most recent message matching the criteria (see `find`),
+        or None if there are no matches.
+        """
+        matches = self.find(**criteria)
+        if matches:
+            return matches[-1]
+
+    _missing = object()
+
+    def _matches(self, msg, criteria):
+        fields = msg.get('fields') or {}
+        for key, value in criteria.iteritems():
+            if key == 'name':
+                actual = fields.get('name', self._missing)
+            else:
+                actual = msg.get(key, self._missing)
+                if actual is self._missing:
+                    actual = fields.get(key, self._missing)
+            if actual != value:
+                return False
+        return True
@@ -17,6 +17,7 @@ standard library's `logging` module.
 """
 from __future__ import absolute_import
 from metlog.client import SEVERITY
+from metlog.instrument import SenderStats
 import logging
 try:
     import simplesjson as json
@@ -36,6 +37,23 @@ SEVERITY_MAP = {
     }
 
 
+class LazyJson(object):
+    """
+    Wraps a message so that JSON serialization is deferred until (and unless)
+    a logging handler actually formats the record.
+    """
+    __slots__ = ('msg', '_json')
+
+    def __init__(self, msg):
+        self.msg = msg
+        self._json = None
+
+    def __str__(self):
+        if self._json is None:
+            self._json = json.dumps(self.msg)
+        return self._json
+
+
 class StdLibLoggingSender(object):
     """
     Sender that passes messages off to Python stdlib's `logging` module for
@@ -71,14 +89,58 @@ class StdLibLoggingSender(object):
         if isinstance(json_types, basestring):
             json_types = [json_types]
         self.json_types = set(json_types)
+        self._stats = SenderStats()
+        self.refresh_levels()
+
+    def refresh_levels(self):
+        """
+        Rebuild the cached table mapping metlog severity to logging level,
+        w/ None for any level the logger currently discards. Happens
+        automatically whenever the logger's effective level or the global
+        `logging.disable` level changes, the only logging config that
+        decides whether a level is enabled.
+        """
+        logger = self.logger
+        self._levels_key = (logger.manager.disable,
+                            logger.getEffectiveLevel())
+        levels = {}
+        for severity, lvl in SEVERITY_MAP.items():
+            levels[severity] = lvl if self.logger.isEnabledFor(lvl) else None
+        self._levels = levels
+        self._default_level = (logging.WARN
+                               if self.logger.isEnabledFor(logging.WARN)
+                               else None)
 
     def send_message(self, msg):
+        logger = self.logger
+        if (logger.manager.disable,
+            logger.getEffectiveLevel()) != self._levels_key:
+            self.refresh_levels()
+        lvl = self._levels.get(msg['severity'], self._default_level)
+        if lvl is None:
+            # the logger would throw it away, don't bother w/ the work
+            self._stats.dropped += 1
+            return
         if msg['type'] in self.payload_types or '*' in self.payload_types:
             logging_msg = msg['payload']
         elif msg['type'] in self.json_types or '*' in self.json_types:
-            logging_msg = json.dumps(msg)
+            logging_msg = LazyJson(msg)
         else:
             # drop it
+            self._stats.dropped += 1
             return
-        lvl = SEVERITY_MAP.get(msg['severity'], logging.WARN)
-        self.logger.log(lvl, logging_msg)
+        try:
+            self.logger.log(lvl, logging_msg)
+        except Exception:
+            self._stats.errors += 1
+            raise
+        self._stats.sent += 1
+
+    def stats(self):
+        """
+        Return a dictionary w/ the numbers of messages `sent` to the logger,
+        `dropped` (because the logger would discard them or their type isn't
+        handled) and failed w/ `errors`. JSON serialization is left to the
+        logging handlers, so it isn't timed.
+        """
+        return self._stats.snapshot()
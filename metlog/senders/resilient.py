@@ -0,0 +1,380 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+Senders that wrap other senders to keep a failing back end from slowing down
+the application. The wrapped sender can be given as a sender object or as a
+config dictionary in the same format as the client's `sender` configuration,
+and in INI files its options are nested under a `sender_` prefix, e.g.::
+
+  [metlog]
+  sender_class = metlog.senders.resilient.CircuitBreakerSender
+  sender_failure_threshold = 3
+  sender_sender_class = metlog.senders.UdpSender
+  sender_sender_host = 127.0.0.1
+  sender_sender_port = 5565
+
+The `FailoverSender` wraps several senders, numbered in order of
+preference::
+
+  [metlog]
+  sender_class = metlog.senders.resilient.FailoverSender
+  sender_sender1_class = metlog.senders.UdpSender
+  sender_sender1_host = 127.0.0.1
+  sender_sender1_port = 5565
+  sender_sender2_class = metlog.senders.FileSender
+  sender_sender2_filepath = /var/log/metlog.log
+"""
+from __future__ import absolute_import
+from collections import deque
+from metlog.path import DottedNameResolver
+import re
+import sys
+import threading
+import time
+
+# numbered sender options for the FailoverSender, e.g. `sender2_host`
+_NUMBERED = re.compile(r'^sender(\d+)_(.+)$')
+
+# circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def make_sender(spec):
+    """
+    Return a sender from `spec`, which is either a sender object, returned
+    as is, or a config dictionary w/ a `class` dotted name, an optional
+    `args` sequence, and any remaining values as keyword arguments.
+    """
+    if not isinstance(spec, dict):
+        return spec
+    spec = dict(spec)
+    cls = DottedNameResolver().resolve(spec.pop('class'))
+    args = spec.pop('args', tuple())
+    return cls(*args, **spec)
+
+
+def _prefixed(prefix, kwargs):
+    """
+    Return a dictionary of the `kwargs` entries whose keys start w/ `prefix`,
+    w/ the prefix stripped.
+    """
+    return dict((key[len(prefix):], value) for key, value in kwargs.items()
+                if key.startswith(prefix))
+
+
+class CircuitBreakerSender(object):
+    """
+    Wraps a sender, and stops passing messages to it once it keeps failing.
+
+    While the circuit is `closed` messages are passed straight through, and
+    exceptions raised by the wrapped sender are re-raised for the client to
+    report. After `failure_threshold` consecutive failures the circuit
+    opens: messages are skipped w/o touching the wrapped sender, and kept in
+    a spool of up to `spool_size` messages (the oldest are dropped first) or
+    counted as `skipped`. Once `reset_timeout` seconds have passed the
+    circuit half-opens, and the next message is sent as a probe. If it goes
+    through the circuit closes and the spooled messages are replayed,
+    otherwise it opens again for another `reset_timeout`.
+    """
+    def __init__(self, sender=None, failure_threshold=5, reset_timeout=30,
+                 spool_size=0, **kwargs):
+        """
+        :param sender: Sender object or config dictionary of the wrapped
+                       sender. If not given, it's configured from the
+                       keyword arguments starting w/ `sender_`.
+        :param failure_threshold: Number of consecutive failures that open
+                                  the circuit.
+        :param reset_timeout: Number of seconds the circuit stays open before
+                              a probe message is let through.
+        :param spool_size: Maximum number of skipped messages kept to be
+                           replayed once the circuit closes again.
+        """
+        unexpected = [key for key in kwargs if not key.startswith('sender_')]
+        if unexpected:
+            raise TypeError('Unexpected CircuitBreakerSender arguments: %s'
+                            % ', '.join(sorted(unexpected)))
+        if sender is None:
+            sender = _prefixed('sender_', kwargs)
+            if not sender:
+                raise ValueError('CircuitBreakerSender requires a `sender`')
+        self.sender = make_sender(sender)
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.skipped = 0
+        self.replayed = 0
+        self._opened_at = None
+        self._spool = deque(maxlen=int(spool_size)) if spool_size else None
+        self._lock = threading.Lock()
+
+    def send_message(self, msg):
+        """
+        Pass a message to the wrapped sender, or skip it if the circuit is
+        open.
+
+        :param msg: Dictionary representing the message.
+        """
+        if self.state is not CLOSED and not self._allow_probe():
+            self._skip(msg)
+            return
+        try:
+            self.sender.send_message(msg)
+        except Exception:
+            self._failed()
+            raise
+        if self.state is not CLOSED:
+            self._closed()
+        elif self.failures:
+            self.failures = 0
+
+    def _allow_probe(self):
+        """
+        Half-open the circuit if it has been open long enough, returning
+        True if the current message should be sent as the probe.
+        """
+        with self._lock:
+            if (self.state is OPEN and
+                time.time() - self._opened_at >= self.reset_timeout):
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def _skip(self, msg):
+        if self._spool is not None:
+            if len(self._spool) == self._spool.maxlen:
+                self.skipped += 1
+            self._spool.append(msg)
+        else:
+            self.skipped += 1
+
+    def _failed(self, trip=False):
+        with self._lock:
+            self.failures += 1
+            if (trip or self.state is HALF_OPEN or
+                (self.state is CLOSED and
+                 self.failures >= self.failure_threshold)):
+                self.state = OPEN
+                self._opened_at = time.time()
+                self.opened += 1
+
+    def _closed(self):
+        with self._lock:
+            if self.state is not HALF_OPEN:
+                return
+            self.state = CLOSED
+            self.failures = 0
+        self._replay()
+
+    def _replay(self):
+        """
+        Send spooled messages. If one fails the back end hasn't really
+        recovered, so the circuit opens again right away.
+        """
+        spool = self._spool
+        while spool and self.state is CLOSED:
+            try:
+                msg = spool.popleft()
+            except IndexError:
+                break
+            try:
+                self.sender.send_message(msg)
+            except Exception:
+                spool.appendleft(msg)
+                self._failed(trip=True)
+                break
+            self.replayed += 1
+
+    def stats(self):
+        """
+        Return a dictionary w/ the circuit `state`, the current number of
+        consecutive `failures`, the number of times the circuit has been
+        `opened`, the number of messages `skipped` (i.e. lost) and
+        `replayed`, and the number currently `spooled`. The wrapped sender's
+        stats, if any, are included under `sender`.
+        """
+        result = {'state': self.state,
+                  'failures': self.failures,
+                  'opened': self.opened,
+                  'skipped': self.skipped,
+                  'replayed': self.replayed,
+                  'spooled': len(self._spool) if self._spool else 0}
+        sender_stats = getattr(self.sender, 'stats', None)
+        if callable(sender_stats):
+            result['sender'] = sender_stats()
+        return result
+
+
+class FailoverSender(object):
+    """
+    Sends each message to the first healthy sender from an ordered list,
+    e.g. a local relay w/ a remote router or a file as backups.
+
+    Only the active sender is called on the normal path. When it raises,
+    the message is retried on the other senders in order, and after
+    `failure_threshold` consecutive failures the sender is marked as down
+    and the first sender that accepted the message becomes the active one.
+    While a backup is active, every `probe_interval` seconds one message is
+    sent to the preferred senders that are down instead, and the first one
+    to accept it becomes active again. If no sender accepts a message the
+    active sender's exception is re-raised for the client to report.
+    """
+    def __init__(self, senders=None, failure_threshold=1, probe_interval=30,
+                 **kwargs):
+        """
+        :param senders: Sequence of sender objects or config dictionaries,
+                        in order of preference. If not given, they're
+                        configured from the keyword arguments starting w/
+                        `sender<N>_`, ordered by N.
+        :param failure_threshold: Number of consecutive failures after which
+                                  a sender is considered down.
+        :param probe_interval: Number of seconds btn attempts to switch
+                               back to a preferred sender that is down.
+        """
+        numbered = {}
+        for key, value in kwargs.items():
+            match = _NUMBERED.match(key)
+            if match is None:
+                raise TypeError('Unexpected FailoverSender argument: %s' % key)
+            number, option = match.groups()
+            numbered.setdefault(int(number), {})[option] = value
+        if senders is None:
+            senders = [numbered[number] for number in sorted(numbered)]
+        if not senders:
+            raise ValueError('FailoverSender requires at least one sender')
+        self.senders = [make_sender(sender) for sender in senders]
+        self.failure_threshold = int(failure_threshold)
+        self.probe_interval = float(probe_interval)
+        self._failures = [0] * len(self.senders)
+        self._down = [False] * len(self.senders)
+        self._active = 0
+        self._current = self.senders[0]
+        self._next_probe = 0
+        self.switches = 0
+        self.probes = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """Index of the sender currently receiving messages."""
+        return self._active
+
+    def send_message(self, msg):
+        """
+        Pass a message to the active sender, failing over to the others if
+        it raises.
+
+        :param msg: Dictionary representing the message.
+        """
+        if self._active and time.time() >= self._next_probe:
+            if self._probe(msg):
+                return
+        index = self._active
+        try:
+            self._current.send_message(msg)
+        except Exception:
+            self._failover(index, msg)
+            return
+        if self._failures[index]:
+            self._failures[index] = 0
+
+    def _activate(self, index):
+        """Make `index` the active sender. Must hold the lock."""
+        self._failures[index] = 0
+        self._down[index] = False
+        if index != self._active:
+            self._active = index
+            self._current = self.senders[index]
+            self.switches += 1
+            self._next_probe = time.time() + self.probe_interval
+
+    def _failover(self, failed, msg):
+        """
+        Handle a failure of the `failed` sender, passing the message on to
+        the other senders. Re-raises the original exception if none of them
+        accepts it.
+        """
+        exc_info = sys.exc_info()
+        with self._lock:
+            self._failures[failed] += 1
+            if self._failures[failed] >= self.failure_threshold:
+                self._down[failed] = True
+            down = list(self._down)
+        # healthy senders first, then the ones that are down as a last resort
+        others = [index for index in range(len(self.senders))
+                  if index != failed]
+        others.sort(key=lambda index: down[index])
+        for index in others:
+            try:
+                self.senders[index].send_message(msg)
+            except Exception:
+                with self._lock:
+                    self._failures[index] += 1
+                    if self._failures[index] >= self.failure_threshold:
+                        self._down[index] = True
+                continue
+            with self._lock:
+                if self._down[self._active] or index < self._active:
+                    self._activate(index)
+                else:
+                    self._failures[index] = 0
+            return
+        self.errors += 1
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _probe(self, msg):
+        """
+        Send `msg` to the preferred senders that are down, returning True if
+        one of them accepted it and is now active.
+        """
+        with self._lock:
+            if time.time() < self._next_probe:
+                return False
+            self._next_probe = time.time() + self.probe_interval
+            candidates = range(self._active)
+        self.probes += 1
+        for index in candidates:
+            try:
+                self.senders[index].send_message(msg)
+            except Exception:
+                continue
+            with self._lock:
+                self._activate(index)
+            return True
+        return False
+
+    def stats(self):
+        """
+        Return a dictionary w/ the index of the `active` sender, the number
+        of `switches` btn senders, of `probes` of preferred senders, and of
+        messages no sender accepted (`errors`), plus a `senders` list w/ the
+        health, consecutive failures and own stats (if any) of each sender.
+        """
+        senders = []
+        for index, sender in enumerate(self.senders):
+            sender_info = {'down': self._down[index],
+                           'failures': self._failures[index]}
+            sender_stats = getattr(sender, 'stats', None)
+            if callable(sender_stats):
+                sender_info['stats'] = sender_stats()
+            senders.append(sender_info)
+        return {'active': self._active,
+                'switches': self.switches,
+                'probes': self.probes,
+                'errors': self.errors,
+                'senders': senders}
@@ -0,0 +1,254 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+Sender that keeps the most recent metlog messages in a fixed size,
+memory-mapped ring file. Writes only touch mapped memory, so normal operation
+costs no file I/O syscalls, but because the pages belong to the OS page cache
+the contents will survive the generating process crashing and can be
+extracted afterwards w/ `read_ring`.
+
+Ring file layout is a fixed size header followed by the data area::
+
+    magic (4s) | version (I) | capacity (Q) | head (Q) | tail (Q) | gen (Q)
+
+`head` is the offset in the data area at which the next record will be
+written, `tail` is the offset of the oldest record still available, and `gen`
+is incremented each time the writer wraps around to the start of the data
+area. Each record is a 4 byte little-endian length followed by that many bytes
+of serialized message. Records are never split across the end of the data
+area; if a record doesn't fit a `WRAP_MARKER` length is written (if there is
+room) and the writer starts over at offset 0.
+"""
+from __future__ import absolute_import
+try:
+    import simplejson as json
+except ImportError:
+    import json  # NOQA
+
+import mmap
+import os
+import struct
+import threading
+
+from metlog.senders.dev import StreamSender
+
+MAGIC = 'MLRB'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQQ')
+LENGTH = struct.Struct('<I')
+WRAP_MARKER = 0xFFFFFFFF
+DEFAULT_SIZE = 4 * 1024 * 1024
+
+
+class RingBufferError(Exception):
+    """Raised when a ring file is missing or has an unrecognized header."""
+    pass
+
+
+class MmapRing(object):
+    """
+    File-like object that stores each `write` call as a single record in a
+    memory-mapped ring file, overwriting the oldest records when full.
+    """
+    def __init__(self, filepath, size=DEFAULT_SIZE):
+        """
+        :param filepath: Path to the ring file. Will be created (or resized
+                         and reset) if it doesn't already exist w/ the
+                         requested size. If it holds records from a previous
+                         run, it's first moved out of the way to
+                         `<filepath>.prev` so they can still be read.
+        :param size: Size of the data area, in bytes.
+        """
+        self.filepath = filepath
+        self.capacity = size
+        total = HEADER.size + size
+        prev_gen = self._preserve(filepath)
+        fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size != total:
+                os.ftruncate(fd, total)
+            self._map = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+        self._lock = threading.Lock()
+        # a fresh process always starts a fresh ring, but the generation
+        # keeps counting so readers can tell runs apart
+        magic, version, capacity, head, tail, gen = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or capacity != size:
+            gen = prev_gen
+        self._head = 0
+        self._tail = 0
+        self._wrapped = False
+        self._gen = gen + 1
+        self._write_header()
+
+    @staticmethod
+    def _preserve(filepath):
+        """
+        Rename an existing ring file that holds any records to
+        `<filepath>.prev`, replacing any older one, so that a restarted
+        process doesn't wipe out the records of the one that crashed.
+        Returns the previous ring's generation, or 0.
+        """
+        try:
+            with open(filepath, 'rb') as ringfile:
+                header = ringfile.read(HEADER.size)
+        except IOError:
+            return 0
+        if len(header) < HEADER.size:
+            return 0
+        magic, version, capacity, head, tail, gen = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            return 0
+        if head != tail:
+            os.rename(filepath, filepath + '.prev')
+        return gen
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.capacity,
+                         self._head, self._tail, self._gen)
+
+    def _drop_oldest(self):
+        """Advance the tail past the oldest record."""
+        pos = HEADER.size + self._tail
+        if self.capacity - self._tail >= LENGTH.size:
+            length = LENGTH.unpack_from(self._map, pos)[0]
+        else:
+            length = WRAP_MARKER
+        if length == WRAP_MARKER:
+            self._tail = 0
+            self._wrapped = False
+            return
+        self._tail += LENGTH.size + length
+        if self._tail >= self.capacity:
+            self._tail = 0
+            self._wrapped = False
+
+    def write(self, data):
+        """
+        Store `data` as a single record. Records too large to ever fit in
+        the ring are silently dropped.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        size = LENGTH.size + len(data)
+        if size > self.capacity - LENGTH.size:
+            return
+        with self._lock:
+            if self._head + size > self.capacity:
+                # no room before the end of the data area, wrap around
+                while self._wrapped:
+                    self._drop_oldest()
+                if self.capacity - self._head >= LENGTH.size:
+                    LENGTH.pack_into(self._map, HEADER.size + self._head,
+                                     WRAP_MARKER)
+                self._head = 0
+                self._wrapped = True
+                self._gen += 1
+            end = self._head + size
+            # reclaim records we're about to overwrite; `tail` is never
+            # allowed to equal `head` while wrapped, since that means empty
+            while self._wrapped and self._tail <= end:
+                self._drop_oldest()
+            # publish the new tail before clobbering the old records
+            self._write_header()
+            pos = HEADER.size + self._head
+            LENGTH.pack_into(self._map, pos, len(data))
+            self._map[pos + LENGTH.size:pos + size] = data
+            self._head = end
+            self._write_header()
+
+    def flush(self):
+        """
+        No-op, the OS will write dirty pages back to the file on its own
+        schedule, even if this process dies.
+        """
+        pass
+
+    def close(self):
+        self._map.close()
+
+
+class RingBufferSender(StreamSender):
+    """
+    Keeps the last `size` bytes worth of serialized metlog messages in a
+    memory-mapped ring file for post-mortem inspection w/ `read_ring`.
+    """
+    def __init__(self, filepath, size=DEFAULT_SIZE, formatter=None):
+        """
+        :param filepath: Path to the ring file.
+        :param size: Size of the ring's data area, in bytes.
+        :param formatter: Optional callable (or dotted name identifier) that
+                          accepts a msg dictionary and returns a formatted
+                          string to be stored in the ring.
+        """
+        ring = MmapRing(filepath, size)
+        super(RingBufferSender, self).__init__(ring, formatter)
+
+    def default_formatter(self, msg):
+        """
+        Default formatter, compact JSON to make the most of the ring space.
+        """
+        return json.dumps(msg)
+
+    def send_message(self, msg):
+        """Store the formatted message as a single ring record."""
+        self.stream.write(self._format(msg))
+        self._stats.sent += 1
+
+
+def read_ring(filepath):
+    """
+    Extract the records from a ring file, oldest first. Safe to use on the
+    ring of a dead (or even a still running) process, since the file is
+    never modified.
+
+    :param filepath: Path to the ring file.
+
+    Returns a 2-tuple `(generation, records)`, where `records` is a list of
+    the raw serialized messages as strings.
+    """
+    if not os.path.exists(filepath):
+        raise RingBufferError('Ring file not found: %s' % filepath)
+    with open(filepath, 'rb') as ringfile:
+        data = ringfile.read()
+    if len(data) < HEADER.size:
+        raise RingBufferError('Truncated ring file: %s' % filepath)
+    magic, version, capacity, head, tail, gen = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise RingBufferError('Not a metlog ring file: %s' % filepath)
+    if len(data) < HEADER.size + capacity:
+        raise RingBufferError('Truncated ring file: %s' % filepath)
+    data = data[HEADER.size:HEADER.size + capacity]
+
+    records = []
+
+    def extract(start, end):
+        pos = start
+        while pos + LENGTH.size <= end:
+            length = LENGTH.unpack_from(data, pos)[0]
+            if length == WRAP_MARKER or pos + LENGTH.size + length > end:
+                break
+            pos += LENGTH.size
+            records.append(data[pos:pos + length])
+            pos += length
+
+    if tail > head:
+        # wrapped, the older records run from the tail to the end
+        extract(tail, capacity)
+        extract(0, head)
+    else:
+        extract(tail, head)
+    return gen, records
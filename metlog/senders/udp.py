@@ -20,7 +20,9 @@ try:
 except:
     import json  # NOQA
 
+from metlog.instrument import SenderStats, clock
 import socket
+import sys
 
 
 class UdpSender(object):
@@ -50,13 +52,42 @@ class UdpSender(object):
             port.extend(num_extra_hosts * [port[-1]])
         self._destinations = zip(host, port)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._stats = SenderStats()
 
     def send_message(self, msg):
         """
-        Serialize and send a message off to the metlog listener(s).
+        Serialize and send a message off to the metlog listener(s). If
+        sending to one of the listeners fails the others still get the
+        message, and the first error is re-raised afterwards.
 
         :param msg: Dictionary representing the message.
         """
-        json_msg = json.dumps(msg)
-        for host, port in self._destinations:
-            self.socket.sendto(json_msg, (host, port))
+        stats = self._stats
+        start = clock()
+        try:
+            json_msg = json.dumps(msg)
+        except Exception:
+            stats.errors += 1
+            raise
+        stats.serialize_time.record(clock() - start)
+        exc_info = None
+        for destination in self._destinations:
+            try:
+                self.socket.sendto(json_msg, destination)
+            except socket.error:
+                stats.dropped += 1
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+        if exc_info is not None:
+            stats.errors += 1
+            raise exc_info[0], exc_info[1], exc_info[2]
+        stats.sent += 1
+
+    def stats(self):
+        """
+        Return a dictionary w/ the number of messages `sent` to all
+        listeners and failed w/ `errors`, the number of datagrams `dropped`
+        by failed sends to single listeners, and the time spent serializing
+        the messages.
+        """
+        return self._stats.snapshot()
@@ -17,6 +17,7 @@ try:
 except ImportError:
     import json  # NOQA
 
+from metlog.instrument import SenderStats, clock
 import threading
 import sys
 import time
@@ -137,15 +138,21 @@ class HandshakingClient(BaseClient):
                 self.handshake_socket.close()
 
     def send(self, msg):
+        """
+        Send a message, or write it to stderr if we're not connected.
+        Returns False in the latter case.
+        """
         try:
             if self.connected():
                 self.socket.send(msg)
+                return True
             else:
                 sys.stderr.write("%s\n" % msg)
                 sys.stderr.flush()
         except zmq.ZMQError:
             sys.stderr.write("%s\n" % msg)
             sys.stderr.flush()
+        return False
 
 
 class Pool(object):
@@ -208,15 +215,17 @@ class Pool(object):
 
     def send(self, msg):
         """
-        Threadsafely send a single text message over a 0mq socket
+        Threadsafely send a single text message over a 0mq socket. Returns
+        False if the message was written to stderr instead.
         """
         sock = None
         try:
             sock = self.socket()
-            sock.send(msg)
+            return sock.send(msg) is not False
         except Queue.Empty:
             # Sometimes, we'll get nothing
             sys.stderr.write("%s\n" % msg)
+            return False
         finally:
             if sock:
                 self._clients.put(sock)
@@ -258,11 +267,30 @@ class ZmqSender(object):
 
         :param msg: Dictionary representing the message.
         """
-        json_msg = json.dumps(msg)
-        if self.debug_stderr:
-            sys.stderr.write(json_msg + '\n')
-            sys.stderr.flush()
-        self.pool.send(json_msg)
+        stats = self._stats
+        start = clock()
+        try:
+            json_msg = json.dumps(msg)
+            stats.serialize_time.record(clock() - start)
+            if self.debug_stderr:
+                sys.stderr.write(json_msg + '\n')
+                sys.stderr.flush()
+            sent = self.pool.send(json_msg)
+        except Exception:
+            stats.errors += 1
+            raise
+        if sent:
+            stats.sent += 1
+        else:
+            stats.dropped += 1
+
+    def stats(self):
+        """
+        Return a dictionary w/ the number of messages `sent`, `dropped`
+        (i.e. written to stderr because no connection was available) and
+        failed w/ `errors`, and the time spent serializing them.
+        """
+        return self._stats.snapshot()
 
 
 class ZmqPubSender(ZmqSender):
@@ -297,6 +325,7 @@ class ZmqPubSender(ZmqSender):
                                 bindstrs,
                                 queue_length)
 
+        self._stats = SenderStats()
         self.pool = Pool(client_factory=get_client,
                 size=pool_size,
                 livecheck=livecheck)
@@ -347,6 +376,7 @@ class ZmqHandshakePubSender(ZmqSender):
             client.connect()
             return client
 
+        self._stats = SenderStats()
         self.pool = Pool(client_factory=get_client,
                 size=pool_size,
                 livecheck=livecheck)
@@ -0,0 +1,200 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from metlog.aggregate import MetricAggregator
+from metlog.client import MetlogClient
+from metlog.config import client_from_text_config
+from metlog.senders import IndexedCaptureSender
+from mock import patch
+from nose.tools import eq_, ok_
+
+import json
+
+
+@patch('metlog.aggregate.time')
+class TestMetricAggregator(object):
+    def test_gauge(self, mock_time):
+        mock_time.time.return_value = 0
+        aggregator = MetricAggregator(flush_interval=10)
+        for i, value in enumerate([5, 2, 9, 4]):
+            mock_time.time.return_value = i
+            eq_(aggregator.gauge('queue', value), ())
+        mock_time.time.return_value = 10
+        ready = aggregator.gauge('queue', 1)
+        eq_(len(ready), 1)
+        type, logger, severity, payload, fields = ready[0]
+        eq_(type, 'gauge')
+        eq_(payload, '4')
+        eq_(fields, {'name': 'queue', 'min': 2, 'max': 9, 'count': 4,
+                     'window': 10.0})
+        # new interval starts w/ the observation that ended the last one
+        eq_(aggregator.flush()[0][4]['count'], 1)
+        eq_(aggregator.flush(), [])
+
+    def test_unique(self, mock_time):
+        mock_time.time.return_value = 0
+        aggregator = MetricAggregator(flush_interval=10)
+        for i in range(3000):
+            aggregator.unique('users', 'user%d' % (i % 1000))
+        ready = aggregator.flush()
+        type, logger, severity, payload, fields = ready[0]
+        eq_(type, 'unique')
+        ok_(900 < int(payload) < 1100, payload)
+        eq_(fields['count'], 3000)
+
+    def test_names_bounded(self, mock_time):
+        mock_time.time.return_value = 0
+        aggregator = MetricAggregator(max_names=2)
+        aggregator.gauge('a', 1)
+        aggregator.gauge('b', 1)
+        # 'a' is reported early to make room
+        ready = aggregator.gauge('c', 1)
+        eq_([agg[4]['name'] for agg in ready], ['a'])
+        eq_(sorted(agg[4]['name'] for agg in aggregator.flush()),
+            ['b', 'c'])
+
+    def test_message_settings(self, mock_time):
+        mock_time.time.return_value = 0
+        aggregator = MetricAggregator()
+        aggregator.gauge('a', 1, logger='one', fields={'x': 1})
+        aggregator.gauge('a', 2, logger='two', severity=3, fields={'x': 2})
+        type, logger, severity, payload, fields = aggregator.flush()[0]
+        eq_((logger, severity, fields['x']), ('two', 3, 2))
+
+    def test_top(self, mock_time):
+        mock_time.time.return_value = 0
+        aggregator = MetricAggregator(top_k=2)
+        for i in range(100):
+            aggregator.top('urls', '/url%d' % i)
+            aggregator.top('urls', '/home', 2)
+            if i % 2:
+                aggregator.top('urls', '/about')
+        type, logger, severity, payload, fields = aggregator.flush()[0]
+        eq_(type, 'top')
+        eq_(json.loads(payload), [['/home', 200], ['/about', 50]])
+        eq_(fields['total'], 350)
+        eq_(fields['other'], 100)
+        eq_(fields['max_error'], 0)
+
+    def test_histogram(self, mock_time):
+        mock_time.time.return_value = 100
+        aggregator = MetricAggregator(timer_buckets=[10, 100], exemplars=2)
+        for i, elapsed in enumerate([3, 50, 60, 70, 500]):
+            aggregator.timing('db', elapsed,
+                              fields={'request_id': 'req%d' % i, 'a': 1})
+        type, logger, severity, payload, fields = aggregator.flush()[0]
+        eq_(type, 'histogram')
+        eq_(fields['count'], 5)
+        eq_((fields['sum'], fields['min'], fields['max']), (683, 3, 500))
+        # request ids only show up in the exemplars
+        ok_('request_id' not in fields)
+        eq_(fields['a'], 1)
+        payload = json.loads(payload)
+        eq_(payload['buckets'], [[10, 1], [100, 3], [None, 1]])
+        exemplars = payload['exemplars']
+        eq_(len(exemplars), 4)
+        eq_(exemplars[0], [10, 3, 100, 'req0'])
+        eq_(exemplars[-1], [None, 500, 100, 'req4'])
+        middle = exemplars[1:3]
+        ok_(all(ex[0] == 100 and 50 <= ex[1] <= 70 for ex in middle))
+
+    def test_histogram_reservoir_bounded(self, mock_time):
+        mock_time.time.return_value = 0
+        aggregator = MetricAggregator(timer_buckets=[10], exemplars=3)
+        for i in range(1000):
+            aggregator.timing('db', 5, fields={'request_id': i})
+        payload = json.loads(aggregator.flush()[0][3])
+        eq_(payload['buckets'], [[10, 1000]])
+        exemplars = payload['exemplars']
+        eq_(len(exemplars), 3)
+        # sampled from the whole window, not just the first few
+        ok_(max(ex[3] for ex in exemplars) >= 3)
+
+
+class TestClientAggregates(object):
+    def setUp(self):
+        self.sender = IndexedCaptureSender()
+        self.client = MetlogClient(self.sender, 'tests')
+
+    def test_gauge_and_unique(self):
+        for i in range(10):
+            self.client.gauge('load', i)
+            self.client.unique('users', i % 3)
+        # nothing sent until the interval ends
+        eq_(len(self.sender), 0)
+        self.client.flush()
+        gauge = self.sender.find_one(type='gauge')
+        eq_(gauge['payload'], '9')
+        eq_(gauge['logger'], 'tests')
+        eq_(gauge['fields']['max'], 9)
+        unique = self.sender.find_one(type='unique')
+        eq_(unique['payload'], '3')
+        eq_(unique['fields']['count'], 10)
+
+    @patch('metlog.aggregate.time')
+    def test_sent_at_interval(self, mock_time):
+        mock_time.time.return_value = 0
+        client = MetlogClient(self.sender, 'tests',
+                              aggregator=MetricAggregator(flush_interval=1))
+        client.gauge('load', 1)
+        mock_time.time.return_value = 1.5
+        client.gauge('load', 2)
+        eq_(len(self.sender), 1)
+        eq_(self.sender.find_one(type='gauge')['payload'], '1')
+
+    def test_keyed_incr(self):
+        for agent in ['firefox', 'chrome', 'firefox', 'curl']:
+            self.client.incr('agents', key=agent)
+        eq_(len(self.sender), 0)
+        self.client.flush()
+        msg = self.sender.find_one(type='top')
+        eq_(msg['fields']['name'], 'agents')
+        eq_(json.loads(msg['payload'])[0], ['firefox', 2])
+        eq_(msg['fields']['total'], 4)
+
+    def test_aggregated_timers(self):
+        client = MetlogClient(self.sender, 'tests', aggregate_timers=True)
+        for i in range(3):
+            with client.bind(request_id='req%d' % i).timer('view'):
+                pass
+        client.timer_send('view', 5000)
+        eq_(len(self.sender), 0)
+        client.flush()
+        msg = self.sender.find_one(type='histogram')
+        eq_(msg['fields']['name'], 'view')
+        eq_(msg['fields']['count'], 4)
+        exemplar_ids = [ex[3] for ex in
+                        json.loads(msg['payload'])['exemplars']]
+        ok_(set(exemplar_ids) - set([None]) <=
+            set(['req0', 'req1', 'req2']))
+        ok_(None in exemplar_ids)
+
+    def test_bound_fields(self):
+        child = self.client.bind(host='web1')
+        child.gauge('load', 1)
+        self.client.flush()
+        eq_(self.sender.find_one(type='gauge')['fields']['host'], 'web1')
+
+    def test_config(self):
+        cfg_txt = """
+        [metlog]
+        sender_class = metlog.senders.DebugCaptureSender
+        aggregator_class = metlog.aggregate.MetricAggregator
+        aggregator_flush_interval = 60
+        aggregator_timer_buckets = 10 100 1000
+        aggregate_timers = true
+        """
+        client = client_from_text_config(cfg_txt, 'metlog')
+        eq_(client.aggregator.flush_interval, 60)
+        eq_(client.aggregator.timer_buckets, (10, 100, 1000))
+        ok_(client.aggregate_timers)
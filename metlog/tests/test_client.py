@@ -15,10 +15,10 @@
 # ***** END LICENSE BLOCK *****
 from __future__ import absolute_import
 from datetime import datetime
-from metlog.client import MetlogClient, SEVERITY
-from mock import Mock
+from metlog.client import MetlogClient, OldstylePayload, SEVERITY
+from mock import Mock, patch
 from nose.tools import eq_, ok_
-from metlog.senders.dev import DebugCaptureSender
+from metlog.senders.dev import DebugCaptureSender, IndexedCaptureSender
 
 import StringIO
 import os
@@ -202,6 +202,332 @@ class TestMetlogClient(object):
         full_msg = self._extract_full_msg()
         eq_(full_msg['payload'], '10')
 
+    def test_sample_key(self):
+        self.client.sample_key = 'request_id'
+        kept = set()
+        for i in range(200):
+            request_id = 'req-%d' % i
+            before = self.mock_sender.send_message.call_count
+            for j in range(5):
+                fields = {'request_id': request_id}
+                self.client.incr('foo', fields=fields, rate=0.5)
+                with self.client.timer('bar', fields=fields, rate=0.5):
+                    pass
+            sent = self.mock_sender.send_message.call_count - before
+            # all or nothing for each request
+            ok_(sent in (0, 10))
+            if sent:
+                kept.add(request_id)
+        ok_(50 < len(kept) < 150)
+        eq_(self._extract_full_msg()['fields']['rate'], 0.5)
+
+    def test_timer_registry_bounded(self):
+        client = MetlogClient(self.mock_sender, self.logger, max_timers=3)
+        for i in range(10):
+            with client.timer('timer%d' % i):
+                pass
+        eq_(len(client._timer_obs), 3)
+        eq_(client._timer_obs.keys(), ['timer7', 'timer8', 'timer9'])
+        eq_(self.mock_sender.send_message.call_count, 10)
+
+    def test_timer_name_cardinality_guard(self):
+        client = MetlogClient(self.mock_sender, self.logger,
+                              max_timer_names=2)
+        names = []
+        for i in range(5):
+            with client.timer('timer%d' % i):
+                pass
+            with client.timer('timer0'):
+                pass
+            names.append(self._extract_full_msg()['fields']['name'])
+        eq_(names, ['timer0'] * 5)
+        msgs = [args[0][0] for args in
+                self.mock_sender.send_message.call_args_list]
+        eq_([msg['fields']['name'] for msg in msgs[::2]],
+            ['timer0', 'timer1', 'overflow', 'overflow', 'overflow'])
+        eq_(msgs[-2]['fields']['folded_names'], 3)
+        eq_(client.folded_timer_names, 3)
+
+    def test_span_tree(self):
+        with self.client.span('request', fields={'path': '/'}) as root:
+            eq_(self.client.current_span(), root)
+            with self.client.span('db') as db:
+                time.sleep(0.01)
+                with self.client.span('query'):
+                    pass
+            with self.client.span('render'):
+                # no messages until the root span is done
+                eq_(self.mock_sender.send_message.call_count, 0)
+        ok_(self.client.current_span() is None)
+        eq_(self.mock_sender.send_message.call_count, 1)
+        msg = self._extract_full_msg()
+        eq_(msg['type'], 'spans')
+        eq_(msg['fields']['name'], 'request')
+        eq_(msg['fields']['path'], '/')
+        eq_(msg['fields']['spans'], 4)
+        eq_(msg['fields']['trace_id'], root.trace_id)
+        eq_(len(root.trace_id), 16)
+        records = json.loads(msg['payload'])
+        eq_([(r[0], r[1], r[2]) for r in records],
+            [(1, 0, 'request'), (2, 1, 'db'), (3, 2, 'query'),
+             (4, 1, 'render')])
+        eq_(records[1][4], db.result)
+        ok_(db.result >= 10)
+        ok_(records[0][4] >= records[1][4])
+        # render starts after db is done
+        ok_(records[3][3] >= records[1][3] + records[1][4])
+
+    def test_span_threads(self):
+        sender = IndexedCaptureSender()
+        client = MetlogClient(sender, self.logger)
+
+        def worker(name):
+            with client.span(name):
+                with client.span(name + '.child'):
+                    time.sleep(0.01)
+
+        threads = [threading.Thread(target=worker, args=('t%d' % i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # each thread gets its own tree
+        msgs = sender.find(type='spans')
+        eq_(len(msgs), 3)
+        for msg in msgs:
+            records = json.loads(msg['payload'])
+            eq_(len(records), 2)
+            eq_(records[1][2], records[0][2] + '.child')
+
+    def test_max_spans(self):
+        client = MetlogClient(self.mock_sender, self.logger, max_spans=3)
+        with client.span('root'):
+            for i in range(5):
+                with client.span('child'):
+                    pass
+        msg = self._extract_full_msg()
+        records = json.loads(msg['payload'])
+        eq_([r[2] for r in records], ['root', 'child', 'child'])
+        eq_(msg['fields']['spans'], 6)
+        eq_(msg['fields']['dropped_spans'], 3)
+
+    def test_scope(self):
+        with self.client.scope(fields={'request': 'abc'}):
+            self.client.incr('hits')
+            with self.client.timer('view'):
+                pass
+            self.client.error('oops')
+            self.client.metlog('custom', logger='other')
+            eq_(self.mock_sender.send_message.call_count, 0)
+        eq_(self.mock_sender.send_message.call_count, 1)
+        msg = self._extract_full_msg()
+        eq_(msg['type'], 'scope')
+        eq_(msg['logger'], self.logger)
+        eq_(msg['severity'], SEVERITY.ERROR)
+        eq_(msg['fields'], {'request': 'abc', 'count': 4})
+        eq_(msg['metlog_pid'], os.getpid())
+        entries = json.loads(msg['payload'])
+        eq_([entry['type'] for entry in entries],
+            ['counter', 'timer', 'oldstyle', 'custom'])
+        eq_(entries[2]['payload'], 'oops')
+        # shared envelope values are left out
+        ok_('metlog_pid' not in entries[0])
+        ok_('logger' not in entries[0])
+        eq_(entries[3]['logger'], 'other')
+        ok_('timestamp' in entries[0])
+
+    def test_scope_nested_and_single(self):
+        with self.client.scope():
+            with self.client.scope():
+                self.client.incr('inner')
+            # inner scope joins the outer one
+            eq_(self.mock_sender.send_message.call_count, 0)
+        eq_(self.mock_sender.send_message.call_count, 1)
+        # lone messages are sent as is
+        msg = self._extract_full_msg()
+        eq_(msg['type'], 'counter')
+        eq_(msg['fields']['name'], 'inner')
+
+    def test_scope_max_messages(self):
+        with self.client.scope(max_messages=3):
+            for i in range(7):
+                self.client.incr('hits')
+        counts = [args[0][0]['fields']['count'] for args in
+                  self.mock_sender.send_message.call_args_list[:2]]
+        eq_(counts, [3, 3])
+        eq_(self.mock_sender.send_message.call_count, 3)
+        eq_(self._extract_full_msg()['type'], 'counter')
+
+    def test_scope_filtered(self):
+        self.client.filters = [lambda msg: msg['type'] != 'counter']
+        with self.client.scope():
+            self.client.incr('hits')
+            self.client.info('one')
+            self.client.info('two')
+        msg = self._extract_full_msg()
+        eq_(msg['fields']['count'], 2)
+        eq_(msg['severity'], SEVERITY.INFORMATIONAL)
+
+    def test_scope_thread_local(self):
+        def other_thread():
+            self.client.incr('elsewhere')
+
+        with self.client.scope():
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+            eq_(self.mock_sender.send_message.call_count, 1)
+            self.client.incr('here')
+            self.client.incr('here')
+        eq_(self.mock_sender.send_message.call_count, 2)
+
+    def _sent(self):
+        return [args[0][0] for args in
+                self.mock_sender.send_message.call_args_list]
+
+    def test_scope_hold_discarded(self):
+        with self.client.scope(composite=False,
+                               hold_severity=SEVERITY.DEBUG) as scope:
+            self.client.debug('details %s', 'here')
+            self.client.info('hello')
+            self.client.debug('more details')
+        eq_(scope.retained, False)
+        eq_([msg['payload'] for msg in self._sent()], ['hello'])
+
+    def test_scope_hold_discarded_unrendered(self):
+        render = Mock()
+        with patch.object(OldstylePayload, 'render', render):
+            with self.client.scope(hold_severity=SEVERITY.DEBUG):
+                self.client.debug('details %s', 'here')
+        eq_(render.call_count, 0)
+        eq_(self.mock_sender.send_message.call_count, 0)
+
+    def test_scope_hold_kept_on_error(self):
+        with self.client.scope(composite=False,
+                               hold_severity=SEVERITY.DEBUG) as scope:
+            self.client.debug('details')
+            self.client.error('oops')
+            self.client.debug('more details')
+        eq_(scope.retained, True)
+        eq_([msg['payload'] for msg in self._sent()],
+            ['oops', 'details', 'more details'])
+
+    def test_scope_hold_kept_on_exception(self):
+        try:
+            with self.client.scope(hold_severity=SEVERITY.DEBUG) as scope:
+                self.client.debug('details')
+                raise ValueError
+        except ValueError:
+            pass
+        eq_(scope.retained, True)
+        eq_(self._extract_full_msg()['payload'], 'details')
+
+    def test_scope_hold_kept_when_slow(self):
+        with self.client.scope(hold_severity=SEVERITY.DEBUG,
+                               latency_threshold=10) as scope:
+            self.client.debug('details')
+            self.client.info('hello')
+            time.sleep(0.02)
+        eq_(scope.retained, True)
+        # held messages go into the composite message too
+        msg = self._extract_full_msg()
+        eq_(msg['type'], 'scope')
+        eq_([entry['payload'] for entry in json.loads(msg['payload'])],
+            ['hello', 'details'])
+
+    def test_scope_hold_bounded(self):
+        with self.client.scope(composite=False, hold_severity=SEVERITY.DEBUG,
+                               max_held=2) as scope:
+            for i in range(5):
+                self.client.debug('details %d', i)
+            self.client.critical('bad')
+        eq_(scope.held_dropped, 3)
+        eq_([msg['payload'] for msg in self._sent()],
+            ['bad', 'details 3', 'details 4'])
+
+    def test_bind(self):
+        child = self.client.bind(request='abc', user='bob')
+        grandchild = child.bind(user='alice')
+        eq_(child.bound_fields, {'request': 'abc', 'user': 'bob'})
+        ok_(child.sender is self.client.sender)
+        child.info('hello')
+        eq_(self._extract_full_msg()['fields'],
+            {'request': 'abc', 'user': 'bob'})
+        grandchild.metlog('custom', fields={'extra': 1})
+        eq_(self._extract_full_msg()['fields'],
+            {'request': 'abc', 'user': 'alice', 'extra': 1})
+        # per call fields win over bound ones
+        child.incr('hits', fields={'user': 'carol'})
+        fields = self._extract_full_msg()['fields']
+        eq_(fields['user'], 'carol')
+        eq_(fields['name'], 'hits')
+        # parent is unaffected
+        self.client.info('plain')
+        eq_(self._extract_full_msg()['fields'], {})
+        eq_(child.bound_fields, {'request': 'abc', 'user': 'bob'})
+
+    def test_bind_timers(self):
+        child = self.client.bind(request='abc')
+        with child.timer('shared'):
+            pass
+        fields = self._extract_full_msg()['fields']
+        eq_(fields['request'], 'abc')
+        eq_(fields['name'], 'shared')
+        # the timer object is shared, but not the child's context
+        with self.client.timer('shared'):
+            pass
+        ok_('request' not in self._extract_full_msg()['fields'])
+        ok_(self.client.timer('shared') is child.timer('shared'))
+
+    def test_bind_sample_key(self):
+        client = MetlogClient(self.mock_sender, self.logger,
+                              sample_key='request')
+        kept = 0
+        for i in range(20):
+            child = client.bind(request='req%d' % i)
+            child.incr('a', rate=0.5)
+            child.incr('b', rate=0.5)
+            calls = self.mock_sender.send_message.call_count
+            eq_(calls % 2, 0)
+            kept = calls
+        ok_(0 < kept < 40)
+
+    def test_fields_not_mutated(self):
+        fields = {'a': 1}
+        self.client.incr('hits', fields=fields)
+        self.client.timer_send('t', 10, fields=fields)
+        with self.client.timer('t2', fields=fields):
+            pass
+        eq_(fields, {'a': 1})
+        eq_(self._extract_full_msg()['fields']['a'], 1)
+
+    def test_bound_fields_shared_not_mutated(self):
+        from metlog.dedupe import ExceptionAggregator
+        self.client.exc_aggregator = ExceptionAggregator()
+        child = self.client.bind(request='abc')
+        bound = child._bound_fields
+        ok_(child._merge_fields(None) is bound)
+        try:
+            {}['missing']
+        except KeyError:
+            child.exception('oops')
+        fields = self._extract_full_msg()['fields']
+        ok_('exc_fingerprint' in fields)
+        with child.span('root', fields={'extra': 1}):
+            pass
+        eq_(self._extract_full_msg()['fields']['request'], 'abc')
+        eq_(bound, {'request': 'abc'})
+
+    def test_bind_dynamic_methods(self):
+        def plugin(self, value):
+            self.metlog('plugin', payload=value)
+        plugin.metlog_name = 'plugin'
+        self.client.add_method(plugin)
+        child = self.client.bind(request='abc')
+        child.plugin('x')
+        eq_(self._extract_full_msg()['fields'], {'request': 'abc'})
+
 
 class TestDisabledTimer(object):
     logger = 'tests'
@@ -352,3 +678,77 @@ class TestUnicode(object):
         sys.stderr.seek(0)
         err = sys.stderr.read()
         ok_('Error sending' in err)
+
+    def test_failures_summarized(self):
+        for i in range(5):
+            self.client.send_message({'payload': 'msg %d' % i})
+        sys.stderr.seek(0)
+        err = sys.stderr.read()
+        eq_(err.count('Error sending'), 1)
+        ok_('msg 0' in err)
+        eq_(self.client.stats()['errors'], 5)
+        self.client.flush()
+        sys.stderr.seek(0)
+        err = sys.stderr.read()
+        ok_('4 failures' in err)
+        ok_('UnicodeError: 4' in err)
+        ok_('msg 4' in err)
+        # nothing left to report
+        self.client.flush()
+        sys.stderr.seek(0)
+        eq_(sys.stderr.read(), err)
+
+    def test_failure_report_interval(self):
+        self.client.setup(self.mock_sender, self.logger, error_interval=0)
+        for i in range(3):
+            self.client.send_message({'payload': 'msg %d' % i})
+        sys.stderr.seek(0)
+        eq_(sys.stderr.read().count('Error sending'), 3)
+
+    def test_long_message_truncated(self):
+        self.client.send_message({'payload': 'x' * 10000})
+        sys.stderr.seek(0)
+        ok_(len(sys.stderr.read()) < 1000)
+
+    def test_fallback_sender(self):
+        fallback = DebugCaptureSender()
+        self.client.setup(self.mock_sender, self.logger,
+                          fallback_sender=fallback)
+        msg = {'payload': 'fall back'}
+        self.client.send_message(msg)
+        eq_(list(fallback.msgs), [json.dumps(msg)])
+        eq_(self.client.stats()['fallback_sent'], 1)
+        # a failing fallback is counted
+        fallback.send_message = Mock(side_effect=IOError)
+        self.client.send_message(msg)
+        stats = self.client.stats()
+        eq_(stats['fallback_sent'], 1)
+        eq_(stats['fallback_errors'], 1)
+        eq_(stats['errors'], 2)
+
+    def test_summary_written_on_later_delivery(self):
+        sender = self.mock_sender
+        with patch('metlog.client.time') as mock_time:
+            mock_time.time.return_value = 100
+            for i in range(3):
+                self.client.send_message({'payload': 'msg %d' % i})
+            # the outage ends, the next message goes through
+            sender.send_message.side_effect = None
+            self.client.send_message({'payload': 'ok'})
+            sys.stderr.seek(0)
+            ok_('2 failures' not in sys.stderr.read())
+            mock_time.time.return_value = 160
+            self.client.send_message({'payload': 'ok'})
+        sys.stderr.seek(0)
+        err = sys.stderr.read()
+        ok_('2 failures' in err)
+        ok_('msg 2' in err)
+
+    def test_setup_keeps_pending_failures(self):
+        for i in range(3):
+            self.client.send_message({'payload': 'msg %d' % i})
+        self.client.setup(self.mock_sender, self.logger, error_interval=30)
+        eq_(self.client._error_reporter.interval, 30)
+        self.client.flush()
+        sys.stderr.seek(0)
+        ok_('2 failures' in sys.stderr.read())
@@ -271,3 +271,67 @@ def test_clients_expose_configuration():
 
     client = client_from_dict_config(cfg)
     eq_(client._config, json.dumps(cfg))
+
+
+def test_sample_key_config():
+    cfg_txt = """
+    [metlog]
+    sender_class = metlog.senders.DebugCaptureSender
+    sample_key = request_id
+    """
+    client = client_from_text_config(cfg_txt, 'metlog')
+    eq_(client.sample_key, 'request_id')
+
+
+def test_fallback_sender_config():
+    cfg_txt = """
+    [metlog]
+    sender_class = metlog.senders.DebugCaptureSender
+    error_interval = 30
+    fallback_sender_class = metlog.senders.DebugCaptureSender
+    fallback_sender_name = fallback
+    """
+    client = client_from_text_config(cfg_txt, 'metlog')
+    eq_(client._error_reporter.interval, 30)
+    eq_(client.fallback_sender.__class__.__name__, 'DebugCaptureSender')
+    eq_(client.fallback_sender.name, 'fallback')
+
+
+def test_circuit_breaker_sender_config():
+    cfg_txt = """
+    [metlog]
+    sender_class = metlog.senders.resilient.CircuitBreakerSender
+    sender_failure_threshold = 3
+    sender_sender_class = metlog.senders.DebugCaptureSender
+    sender_sender_name = wrapped
+    """
+    client = client_from_text_config(cfg_txt, 'metlog')
+    eq_(client.sender.failure_threshold, 3)
+    eq_(client.sender.sender.name, 'wrapped')
+
+
+def test_failover_sender_config():
+    cfg_txt = """
+    [metlog]
+    sender_class = metlog.senders.resilient.FailoverSender
+    sender_probe_interval = 5
+    sender_sender1_class = metlog.senders.DebugCaptureSender
+    sender_sender1_name = relay
+    sender_sender2_class = metlog.senders.DebugCaptureSender
+    sender_sender2_name = backup
+    """
+    client = client_from_text_config(cfg_txt, 'metlog')
+    eq_(client.sender.probe_interval, 5)
+    eq_([sender.name for sender in client.sender.senders],
+        ['relay', 'backup'])
+
+
+def test_failover_sender_dict_config():
+    cfg = {'sender': {'class': 'metlog.senders.resilient.FailoverSender',
+                      'senders': [
+                          {'class': 'metlog.senders.DebugCaptureSender'},
+                          {'class': 'metlog.senders.IndexedCaptureSender',
+                           'capacity': 10}]}}
+    client = client_from_dict_config(cfg)
+    eq_(len(client.sender.senders), 2)
+    eq_(client.sender.senders[1].capacity, 10)
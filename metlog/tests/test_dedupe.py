@@ -0,0 +1,185 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from metlog.client import MetlogClient
+from metlog.config import client_from_text_config
+from metlog.dedupe import ExceptionAggregator, MessageDeduper
+from metlog.senders import IndexedCaptureSender
+from mock import patch
+from nose.tools import eq_, ok_
+
+
+@patch('metlog.dedupe.time')
+class TestMessageDeduper(object):
+    def setUp(self):
+        self.sender = IndexedCaptureSender(capacity=None)
+        self.deduper = MessageDeduper(window=10, max_fingerprints=2)
+        self.client = MetlogClient(self.sender, 'tests',
+                                   deduper=self.deduper)
+
+    def test_repeats_suppressed(self, mock_time):
+        mock_time.time.return_value = 0
+        for i in range(5):
+            self.client.error('connection to %s failed', 'db%d' % i)
+        self.client.error('something else')
+        eq_([msg['payload'] for msg in self.sender.find(type='oldstyle')],
+            ['connection to db0 failed', 'something else'])
+
+    def test_summary_after_window(self, mock_time):
+        mock_time.time.return_value = 0
+        for i in range(5):
+            self.client.error('oops')
+        mock_time.time.return_value = 11
+        self.client.error('oops')
+        payloads = [msg['payload'] for msg in self.sender.msgs]
+        eq_(payloads, ['oops', 'Message repeated 4 times: oops', 'oops'])
+        summary = self.sender.msgs[1]
+        eq_(summary['fields']['repeats'], 4)
+        eq_(summary['logger'], 'tests')
+        ok_('timestamp' in summary)
+
+    def test_summary_on_eviction(self, mock_time):
+        mock_time.time.return_value = 0
+        self.client.error('one')
+        self.client.error('one')
+        self.client.error('two')
+        self.client.error('three')
+        eq_(self.sender.find_one(repeats=1)['payload'],
+            'Message repeated 1 times: one')
+
+    def test_quiet_fingerprints_expire(self, mock_time):
+        mock_time.time.return_value = 0
+        self.client.error('one')
+        self.client.error('one')
+        mock_time.time.return_value = 20
+        self.client.error('two')
+        eq_(len(self.sender.find(repeats=1)), 1)
+
+    def test_other_types_untouched(self, mock_time):
+        mock_time.time.return_value = 0
+        for i in range(3):
+            self.client.incr('foo')
+        eq_(len(self.sender.find(type='counter')), 3)
+
+    def test_distinct_exceptions_not_repeats(self, mock_time):
+        mock_time.time.return_value = 0
+        for exc_type in (KeyError, KeyError, ValueError):
+            try:
+                raise exc_type('boom')
+            except exc_type:
+                self.client.error('request failed', exc_info=True)
+        msgs = self.sender.find(type='oldstyle')
+        eq_(len(msgs), 2)
+        ok_('KeyError' in msgs[0]['payload'])
+        ok_('ValueError' in msgs[1]['payload'])
+
+    def test_other_types_sweep(self, mock_time):
+        mock_time.time.return_value = 0
+        self.client.error('one')
+        self.client.error('one')
+        mock_time.time.return_value = 20
+        self.client.incr('foo')
+        eq_(len(self.sender.find(repeats=1)), 1)
+        eq_(len(self.sender.find(type='counter')), 1)
+
+    def test_flush(self, mock_time):
+        mock_time.time.return_value = 0
+        self.client.error('one')
+        self.client.error('one')
+        self.client.error('two')
+        summaries = self.deduper.flush()
+        eq_([summary['fields']['repeats'] for summary in summaries], [1])
+        self.client.error('one')
+        eq_(len(self.sender.find(payload='one')), 2)
+
+
+@patch('metlog.dedupe.time')
+class TestExceptionAggregator(object):
+    def setUp(self):
+        self.sender = IndexedCaptureSender(capacity=None)
+        self.aggregator = ExceptionAggregator(window=60)
+        self.client = MetlogClient(self.sender, 'tests',
+                                   exc_aggregator=self.aggregator)
+
+    def _fail(self, key):
+        try:
+            {}[key]
+        except KeyError:
+            self.client.error('lookup of %s failed', key, exc_info=True)
+
+    def test_full_then_compact(self, mock_time):
+        mock_time.time.return_value = 0
+        for key in ['a', 'b', 'c']:
+            self._fail(key)
+        msgs = self.sender.find(type='oldstyle')
+        eq_(len(msgs), 3)
+        full, compact = msgs[0], msgs[2]
+        ok_(full['payload'].startswith('lookup of a failed\n'
+                                       'Traceback (most recent call last):'))
+        ok_('test_dedupe.py' in full['payload'])
+        ok_(full['payload'].endswith("KeyError: 'a'"))
+        fingerprint = full['fields']['exc_fingerprint']
+        eq_(compact['fields'], {'exc_fingerprint': fingerprint,
+                                'exc_count': 3})
+        eq_(compact['payload'],
+            "lookup of c failed\nKeyError: 'c' [traceback %s, seen 3 times]"
+            % fingerprint)
+
+    def test_window_resets(self, mock_time):
+        mock_time.time.return_value = 0
+        self._fail('a')
+        self._fail('a')
+        mock_time.time.return_value = 61
+        self._fail('a')
+        msgs = self.sender.find(type='oldstyle')
+        eq_([msg['fields']['exc_count'] for msg in msgs], [1, 2, 1])
+        ok_('Traceback' in msgs[2]['payload'])
+
+    def test_distinct_locations(self, mock_time):
+        mock_time.time.return_value = 0
+        self._fail('a')
+        try:
+            {}['a']
+        except KeyError:
+            self.client.exception('elsewhere')
+        fingerprints = set(msg['fields']['exc_fingerprint']
+                           for msg in self.sender.find(type='oldstyle'))
+        eq_(len(fingerprints), 2)
+
+    def test_plain_messages_untouched(self, mock_time):
+        self.client.error('no exception here')
+        eq_(self.sender.find_one(type='oldstyle')['fields'], {})
+
+
+def test_deduper_config():
+    cfg_txt = """
+    [metlog]
+    sender_class = metlog.senders.DebugCaptureSender
+    deduper_class = metlog.dedupe.MessageDeduper
+    deduper_window = 30
+    """
+    client = client_from_text_config(cfg_txt, 'metlog')
+    ok_(isinstance(client.deduper, MessageDeduper))
+    eq_(client.deduper.window, 30)
+
+
+def test_exc_aggregator_config():
+    cfg_txt = """
+    [metlog]
+    sender_class = metlog.senders.DebugCaptureSender
+    exc_aggregator_class = metlog.dedupe.ExceptionAggregator
+    exc_aggregator_window = 30
+    """
+    client = client_from_text_config(cfg_txt, 'metlog')
+    ok_(isinstance(client.exc_aggregator, ExceptionAggregator))
+    eq_(client.exc_aggregator.window, 30)
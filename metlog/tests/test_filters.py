@@ -92,3 +92,156 @@ class TestMetlogClientFilters(object):
         eq_(len(foos), 4)
         bars = [msg for msg in msgs if msg['type'] == 'bar']
         eq_(len(bars), 6)
+
+    def test_rate_limit(self):
+        from metlog.filters import rate_limit_provider
+        self.client.filters = [rate_limit_provider(rate=0.001, burst=2)]
+        for i in range(5):
+            self.client.metlog('foo', payload='msg')
+            self.client.metlog('bar', payload='msg')
+        msgs = [json.loads(msg) for msg in self.sender.msgs]
+        eq_([msg['type'] for msg in msgs], ['foo', 'bar', 'foo', 'bar'])
+
+    def test_rate_limit_field_key(self):
+        from metlog.filters import rate_limit_provider
+        self.client.filters = [rate_limit_provider(rate='0.001', burst=1,
+                                                   key='name')]
+        for i in range(3):
+            self.client.incr('foo')
+            self.client.incr('bar')
+            self.client.incr('foo', fields={'other': i})
+        eq_(len(self.sender.msgs), 2)
+
+    def test_rate_limit_summary(self):
+        from metlog.filters import rate_limit_provider
+        rate_limit = rate_limit_provider(rate=0.001, burst=1,
+                                         summary_interval=0)
+        self.client.filters = [rate_limit]
+        fields = {'foo': 'bar'}
+        self.client.metlog('foo', payload='msg', fields=fields)
+        self.client.metlog('foo', payload='msg', fields=fields)
+        eq_(len(self.sender.msgs), 2)
+        summary = json.loads(self.sender.msgs[1])
+        eq_(summary['type'], 'rate_limit_summary')
+        eq_(summary['payload'], '1')
+        eq_(summary['fields']['suppressed'], {'foo': 1})
+        # caller's fields dict isn't touched
+        eq_(fields, {'foo': 'bar'})
+
+    def test_rate_limit_flush(self):
+        from metlog.filters import rate_limit_provider
+        rate_limit = rate_limit_provider(rate=0.001, burst=1,
+                                         summary_interval=3600)
+        self.client.filters = [rate_limit]
+        for i in range(3):
+            self.client.metlog('foo', payload='msg')
+        eq_(len(self.sender.msgs), 1)
+        # the last window's counts are reported on flush, only once
+        self.client.flush()
+        self.client.flush()
+        eq_(len(self.sender.msgs), 2)
+        summary = json.loads(self.sender.msgs[1])
+        eq_(summary['type'], 'rate_limit_summary')
+        eq_(summary['logger'], self.client.logger)
+        eq_(summary['payload'], '2')
+        eq_(summary['fields']['suppressed'], {'foo': 2})
+
+    def test_rate_limit_bounded_keys(self):
+        from metlog.filters import rate_limit_provider
+        rate_limit = rate_limit_provider(rate=0.001, burst=1, max_keys=2,
+                                         summary_interval=3600)
+        self.client.filters = [rate_limit]
+        for msgtype in ['a', 'a', 'b', 'c', 'c', 'a']:
+            self.client.metlog(msgtype, payload='msg')
+        # 'a' was forgotten when 'c' showed up, so it gets a new bucket
+        eq_([json.loads(msg)['type'] for msg in self.sender.msgs],
+            ['a', 'b', 'c', 'a'])
+
+    def test_sample_by_type(self):
+        from metlog.filters import sample_provider
+        self.client.filters = [sample_provider(types={'foo': 0.1,
+                                                      'bar': 0})]
+        for i in range(1000):
+            self.client.metlog('foo', payload='msg')
+            self.client.metlog('bar', payload='msg')
+            self.client.metlog('baz', payload='msg')
+        msgs = [json.loads(msg) for msg in self.sender.msgs]
+        ok_(not [msg for msg in msgs if msg['type'] == 'bar'])
+        # the sender only keeps the last 100 messages
+        foos = [msg for msg in msgs if msg['type'] == 'foo']
+        ok_(0 < len(foos) < 30)
+        for msg in foos:
+            eq_(msg['fields']['rate'], 0.1)
+        for msg in msgs:
+            if msg['type'] == 'baz':
+                ok_('rate' not in msg['fields'])
+
+    def test_sample_config_strings(self):
+        from metlog.filters import sample_provider
+        sample = sample_provider(loggers=['tests:0'], default='1')
+        self.client.filters = [sample]
+        self.client.metlog('foo', payload='msg')
+        self.client.metlog('foo', logger='other', payload='msg')
+        eq_(len(self.sender.msgs), 1)
+
+    def test_sample_by_severity(self):
+        from metlog.filters import sample_provider
+        sample = sample_provider(severities={SEVERITY.INFORMATIONAL: 0.5,
+                                             SEVERITY.DEBUG: 0})
+        self.client.filters = [sample]
+        for i in range(40):
+            self.client.debug('msg')
+            self.client.warn('msg')
+        msgs = [json.loads(msg) for msg in self.sender.msgs]
+        eq_(len(msgs), 40)
+        ok_(all(msg['severity'] == SEVERITY.WARNING for msg in msgs))
+
+    def test_sample_compounds_rate(self):
+        from metlog.filters import sample_provider
+        self.client.filters = [sample_provider(types={'counter': 0.5})]
+        while not self.sender.msgs:
+            self.client.incr('foo', rate=0.5)
+        msg = json.loads(self.sender.msgs[0])
+        eq_(msg['fields']['rate'], 0.25)
+
+    def test_sample_copies_fields(self):
+        from metlog.filters import sample_provider
+        self.client.filters = [sample_provider(default=0.5)]
+        fields = {'foo': 'bar'}
+        for i in range(40):
+            self.client.metlog('foo', payload='msg', fields=fields)
+        eq_(fields, {'foo': 'bar'})
+        msgs = [json.loads(msg) for msg in self.sender.msgs]
+        ok_(msgs)
+        ok_(all(msg['fields']['rate'] == 0.5 for msg in msgs))
+
+    def test_sample_hash_key(self):
+        from metlog.filters import sample_provider
+        sample = sample_provider(default=0.5, hash_key='request_id')
+        self.client.filters = [sample]
+        for i in range(50):
+            fields = {'request_id': 'req-%d' % i}
+            self.client.metlog('foo', payload='msg', fields=dict(fields))
+            self.client.metlog('bar', payload='msg', fields=dict(fields))
+        msgs = [json.loads(msg) for msg in self.sender.msgs]
+        ok_(0 < len(msgs) < 100)
+        # both messages for a request always go together
+        eq_([msg['type'] for msg in msgs], ['foo', 'bar'] * (len(msgs) / 2))
+        ok_(all(msg['fields']['rate'] == 0.5 for msg in msgs))
+
+    def test_sample_hash_key_two_stages(self):
+        from metlog.filters import sample_provider
+        self.client.sample_key = 'request_id'
+        self.client.filters = [sample_provider(default=0.5,
+                                               hash_key='request_id')]
+        sender = self.sender
+        kept = 0
+        for i in range(4000):
+            sender.msgs.clear()
+            self.client.incr('foo', rate=0.5, fields={'request_id': i})
+            if sender.msgs:
+                kept += 1
+                msg = json.loads(sender.msgs[0])
+                eq_(msg['fields']['rate'], 0.25)
+        # independent decisions, so the kept fraction matches the rate
+        ok_(800 < kept < 1200)
@@ -0,0 +1,212 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from metlog.client import MetlogClient, SEVERITY
+from metlog.dedupe import MessageDeduper
+from metlog.instrument import LatencyHistogram
+from metlog.senders import IndexedCaptureSender, StreamSender
+from metlog.senders.udp import UdpSender
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+
+import StringIO
+import json
+import logging
+import sys
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for seconds in (0.000003, 0.000003, 0.0001, 2.5):
+        histogram.record(seconds)
+    snapshot = histogram.snapshot()
+    eq_(snapshot['count'], 4)
+    eq_(snapshot['max_us'], 2500000)
+    eq_(snapshot['total_us'], 2500106)
+    eq_(snapshot['mean_us'], 625026)
+    # 3us -> <4us, 100us -> <128us, 2.5s -> <4194304us
+    eq_(snapshot['buckets'], [[4, 2], [128, 1], [4194304, 1]])
+
+
+def test_latency_histogram_negative():
+    histogram = LatencyHistogram()
+    histogram.record(0.000003)
+    histogram.record(-0.5)
+    snapshot = histogram.snapshot()
+    eq_(snapshot['count'], 2)
+    eq_(snapshot['total_us'], 3)
+    eq_(snapshot['buckets'], [[1, 1], [4, 1]])
+
+
+def test_latency_histogram_empty():
+    eq_(LatencyHistogram().snapshot(),
+        {'count': 0, 'total_us': 0, 'mean_us': 0, 'max_us': 0,
+         'buckets': []})
+
+
+class TestClientStats(object):
+    def setUp(self):
+        self.sender = IndexedCaptureSender()
+        self.client = MetlogClient(self.sender, 'tests', latency_sample=1)
+
+    def test_counters(self):
+        self.client.filters = [lambda msg: msg['type'] != 'skipped']
+        self.client.deduper = MessageDeduper()
+        self.client.info('hello %s', 'there')
+        self.client.info('hello %s', 'again')
+        self.client.metlog('skipped')
+        self.client.incr('sampled', rate=0.0)
+        with self.client.scope(composite=False,
+                               hold_severity=SEVERITY.DEBUG):
+            self.client.debug('never sent')
+        stats = self.client.stats()
+        eq_(stats['created'], 4)
+        eq_(stats['filtered'], 1)
+        eq_(stats['suppressed'], 1)
+        eq_(stats['sampled_out'], 1)
+        eq_(stats['held'], 1)
+        eq_(stats['dropped'], 1)
+        eq_(stats['sent'], 1)
+        eq_(stats['errors'], 0)
+        eq_(stats['render_time']['count'], 1)
+        eq_(stats['send_time']['count'], 1)
+
+    def test_errors(self):
+        sender = Mock(spec=['send_message'])
+        sender.send_message.side_effect = ValueError('boom')
+        client = MetlogClient(sender, 'tests')
+        old_stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            client.metlog('test')
+        finally:
+            sys.stderr = old_stderr
+        stats = client.stats()
+        eq_(stats['errors'], 1)
+        eq_(stats['sent'], 0)
+        # senders w/o a stats method are fine
+        ok_('sender' not in stats)
+
+    def test_sender_stats(self):
+        stream = StringIO.StringIO()
+        client = MetlogClient(StreamSender(stream), 'tests')
+        client.metlog('test')
+        client.metlog('test')
+        sender_stats = client.stats()['sender']
+        eq_(sender_stats['sent'], 2)
+        eq_(sender_stats['serialize_time']['count'], 2)
+
+    @patch('metlog.client.time')
+    def test_stats_interval(self, mock_time):
+        mock_time.time.return_value = 0
+        # as read from an INI file
+        client = MetlogClient(self.sender, 'tests', stats_interval='60',
+                              latency_sample=1)
+        client.metlog('test')
+        eq_(self.sender.find(type='metlog_internal'), [])
+        mock_time.time.return_value = 61
+        client.metlog('test')
+        internal = self.sender.find_one(type='metlog_internal')
+        eq_(internal['fields']['created'], 1)
+        eq_(internal['fields']['sent'], 1)
+        eq_(json.loads(internal['payload'])['send_time']['count'], 1)
+        eq_(len(self.sender.find(type='test')), 2)
+        # not again until the next interval is up
+        client.metlog('test')
+        eq_(len(self.sender.find(type='metlog_internal')), 1)
+
+    def test_latency_sample(self):
+        client = MetlogClient(self.sender, 'tests', latency_sample=3)
+        for i in range(6):
+            client.info('msg %d', i)
+        stats = client.stats()
+        eq_(stats['sent'], 6)
+        eq_(stats['send_time']['count'], 2)
+        eq_(stats['render_time']['count'], 2)
+        client.setup(self.sender, 'tests', latency_sample=0)
+        client.metlog('test')
+        eq_(client.stats()['send_time']['count'], 2)
+
+
+def test_udp_sender_stats():
+    sender = UdpSender('127.0.0.1', 5565)
+    with patch.object(sender, 'socket'):
+        sender.send_message({'type': 'test'})
+    stats = sender.stats()
+    eq_(stats['sent'], 1)
+    eq_(stats['serialize_time']['count'], 1)
+
+
+def test_udp_sender_errors():
+    import socket
+    sender = UdpSender(['127.0.0.1', '127.0.0.2'], 5565)
+    with patch.object(sender, 'socket') as mock_socket:
+        mock_socket.sendto.side_effect = [socket.error('boom'), None]
+        try:
+            sender.send_message({'type': 'test'})
+        except socket.error:
+            pass
+        else:
+            raise AssertionError('socket.error not raised')
+        # the second listener still got the message
+        eq_(mock_socket.sendto.call_count, 2)
+    stats = sender.stats()
+    eq_(stats['sent'], 0)
+    eq_(stats['errors'], 1)
+    eq_(stats['dropped'], 1)
+
+
+def test_stream_sender_errors():
+    def broken(msg):
+        raise ValueError('boom')
+
+    sender = StreamSender(StringIO.StringIO(), formatter=broken)
+    try:
+        sender.send_message({'type': 'test'})
+    except ValueError:
+        pass
+    stats = sender.stats()
+    eq_(stats['sent'], 0)
+    eq_(stats['errors'], 1)
+
+
+def test_capture_sender_stats():
+    from metlog.senders import DebugCaptureSender
+    sender = DebugCaptureSender()
+    for i in range(101):
+        sender.send_message({'type': 'test'})
+    stats = sender.stats()
+    eq_(stats['sent'], 101)
+    eq_(stats['dropped'], 1)
+    eq_(stats['serialize_time']['count'], 101)
+    sender = IndexedCaptureSender(capacity=2)
+    for i in range(3):
+        sender.send_message({'type': 'test'})
+    stats = sender.stats()
+    eq_(stats['sent'], 3)
+    eq_(stats['dropped'], 1)
+
+
+def test_logging_sender_stats():
+    from metlog.senders.logging import StdLibLoggingSender
+    sender = StdLibLoggingSender('tests.sender_stats', payload_types=['a'],
+                                 json_types=['b'])
+    sender.logger.setLevel(logging.INFO)
+    for msg_type, severity in [('a', SEVERITY.ERROR), ('b', SEVERITY.ERROR),
+                               ('c', SEVERITY.ERROR), ('a', SEVERITY.DEBUG)]:
+        sender.send_message({'type': msg_type, 'severity': severity,
+                             'payload': 'msg'})
+    stats = sender.stats()
+    eq_(stats['sent'], 2)
+    eq_(stats['dropped'], 2)
+    eq_(stats['errors'], 0)
@@ -12,12 +12,16 @@
 #
 # ***** END LICENSE BLOCK *****
 from __future__ import absolute_import
-from metlog.client import MetlogClient
-from metlog.logging import hook_logger
+from metlog.client import MetlogClient, SEVERITY
+from metlog.dedupe import ExceptionAggregator
+from metlog.filters import severity_max_provider
+from metlog.logging import MetlogHandler, hook_logger
 from mock import Mock
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
 import logging
+import sys
+import traceback
 
 
 class TestLoggingHook(object):
@@ -36,3 +40,139 @@ class TestLoggingHook(object):
         msg = "this is an info message"
         logger.info(msg)
         eq_(msg, self.mock_sender.send_message.call_args[0][0]['payload'])
+
+    def _make_logger(self, name, **kwargs):
+        logger = logging.getLogger(name)
+        logger.setLevel(1)
+        logger.propagate = False
+        handler = MetlogHandler(self.client, **kwargs)
+        logger.handlers = [handler]
+        return logger, handler
+
+    def _payloads(self):
+        return [args[0][0]['payload'] for args in
+                self.mock_sender.send_message.call_args_list]
+
+    def test_args_and_exc_info(self):
+        logger, handler = self._make_logger('demo.args')
+        logger.warn('%s and %s', 'this', 'that')
+        logger.info('%(foo)s', {'foo': 'bar'})
+        try:
+            a = b  # NOQA
+        except NameError:
+            logger.exception('oops')
+        payloads = self._payloads()
+        eq_(payloads[:2], ['this and that', 'bar'])
+        ok_(payloads[2].startswith('oops\n'))
+        ok_("NameError: global name 'b' is not defined" in payloads[2])
+
+    def test_filtered_not_formatted(self):
+        class Explosive(object):
+            def __str__(self):
+                raise AssertionError('should never be formatted')
+
+        self.client.filters = [severity_max_provider(SEVERITY.WARNING)]
+        logger, handler = self._make_logger('demo.lazy')
+        logger.debug('%s', Explosive())
+        eq_(self.mock_sender.send_message.call_count, 0)
+
+    def test_level_map(self):
+        logger, handler = self._make_logger('demo.levels')
+        logger.log(5, 'trace')
+        logger.log(25, 'between')
+        logger.log(logging.ERROR, 'error')
+        logger.log(60, 'off the charts')
+        severities = [args[0][0]['severity'] for args in
+                      self.mock_sender.send_message.call_args_list]
+        eq_(severities, [SEVERITY.DEBUG, SEVERITY.INFORMATIONAL,
+                         SEVERITY.ERROR, SEVERITY.CRITICAL])
+
+    def test_queued(self):
+        logger, handler = self._make_logger('demo.queued', queue_size=10)
+        for i in range(5):
+            logger.info('msg %d', i)
+        handler.close()
+        eq_(self._payloads(), ['msg %d' % i for i in range(5)])
+
+    def test_queue_full_drops(self):
+        logger, handler = self._make_logger('demo.full', queue_size=1)
+        # stop the worker so nothing gets drained
+        handler.close()
+        logger.info('one')
+        logger.info('two')
+        eq_(handler.dropped, 1)
+
+    def test_queued_formatted_when_logged(self):
+        logger, handler = self._make_logger('demo.mutated', queue_size=10)
+        items = ['before']
+        logger.info('items: %s', items)
+        items[0] = 'after'
+        try:
+            a = b  # NOQA
+        except NameError:
+            logger.exception('oops')
+        handler.close()
+        payloads = self._payloads()
+        eq_(payloads[0], "items: ['before']")
+        ok_(payloads[1].startswith('oops\n'))
+        ok_("NameError: global name 'b' is not defined" in payloads[1])
+
+    def test_queued_record_snapshot(self):
+        logger, handler = self._make_logger('demo.prepared')
+        items = ['arg']
+        try:
+            a = b  # NOQA
+        except NameError:
+            exc_info = sys.exc_info()
+        record = logger.makeRecord('demo.prepared', logging.ERROR, __file__,
+                                   1, '%s', (items,), exc_info)
+        prepared = handler._prepare(record)
+        # not formatted yet, but w/o references to mutable args or frames
+        eq_(prepared.msg, '%s')
+        eq_(prepared.args, (['arg'],))
+        ok_(prepared.args[0] is not items)
+        eq_(prepared.exc_info[:2], exc_info[:2])
+        eq_(prepared.exc_info[2], traceback.extract_tb(exc_info[2]))
+        # the original record is left alone for other handlers
+        ok_(record.args[0] is items)
+        ok_(record.exc_info is exc_info)
+
+    def test_queued_filtered_not_formatted(self):
+        class Explosive(object):
+            def __str__(self):
+                raise AssertionError('should never be formatted')
+
+        self.client.filters = [severity_max_provider(SEVERITY.WARNING)]
+        logger, handler = self._make_logger('demo.queued_lazy', queue_size=10)
+        handler.handleError = Mock()
+        logger.debug('%s', Explosive())
+        handler.close()
+        eq_(self.mock_sender.send_message.call_count, 0)
+        eq_(handler.handleError.call_count, 0)
+
+    def test_queued_exception_aggregated(self):
+        self.client.exc_aggregator = ExceptionAggregator()
+        logger, handler = self._make_logger('demo.queued_exc', queue_size=10)
+        for i in range(2):
+            try:
+                a = b  # NOQA
+            except NameError:
+                logger.exception('oops')
+        handler.close()
+        msgs = [args[0][0] for args in
+                self.mock_sender.send_message.call_args_list]
+        eq_([msg['fields']['exc_count'] for msg in msgs], [1, 2])
+        eq_(msgs[0]['fields']['exc_fingerprint'],
+            msgs[1]['fields']['exc_fingerprint'])
+        ok_('Traceback (most recent call last):' in msgs[0]['payload'])
+        ok_('a = b' in msgs[0]['payload'])
+
+    def test_delivery_error_handled(self):
+        def broken(msg):
+            raise ValueError('broken filter')
+
+        self.client.filters = [broken]
+        logger, handler = self._make_logger('demo.broken')
+        handler.handleError = Mock()
+        logger.info('msg')
+        eq_(handler.handleError.call_count, 1)
@@ -0,0 +1,84 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from metlog.client import MetlogClient
+from metlog.config import client_from_text_config
+from metlog.sampling import AdaptiveSampler
+from metlog.senders import IndexedCaptureSender
+from mock import patch
+from nose.tools import eq_, ok_
+
+
+@patch('metlog.sampling.time')
+class TestAdaptiveSampler(object):
+    def _calls(self, sampler, mock_time, start, seconds, per_second,
+               name='foo'):
+        for i in range(seconds * per_second):
+            mock_time.time.return_value = start + float(i) / per_second
+            rate = sampler.rate(name)
+        return rate
+
+    def test_unsampled_until_window_ends(self, mock_time):
+        sampler = AdaptiveSampler(target=10, window=1)
+        eq_(self._calls(sampler, mock_time, 0, 1, 100), 1.0)
+
+    def test_tracks_target(self, mock_time):
+        sampler = AdaptiveSampler(target=10, window=1, smoothing=1)
+        rate = self._calls(sampler, mock_time, 0, 3, 100)
+        ok_(0.09 < rate < 0.11, rate)
+        # traffic dies down, sampling is relaxed
+        rate = self._calls(sampler, mock_time, 3, 3, 5)
+        eq_(rate, 1.0)
+        eq_(sampler.current_rate('foo'), 1.0)
+        eq_(sampler.current_rate('bar'), 1.0)
+
+    def test_requested_rate_respected(self, mock_time):
+        sampler = AdaptiveSampler(target=10, window=1, smoothing=1)
+        self._calls(sampler, mock_time, 0, 3, 100)
+        eq_(sampler.rate('foo', 0.01), 0.01)
+        ok_(sampler.rate('foo', 0.5) < 0.5)
+
+    def test_names_independent(self, mock_time):
+        sampler = AdaptiveSampler(target=10, window=1, smoothing=1)
+        self._calls(sampler, mock_time, 0, 3, 100)
+        eq_(sampler.rate('bar'), 1.0)
+
+
+class TestClientSampler(object):
+    def setUp(self):
+        self.sender = IndexedCaptureSender(capacity=None)
+        self.sampler = AdaptiveSampler(target=10)
+        self.client = MetlogClient(self.sender, 'tests',
+                                   sampler=self.sampler)
+
+    def test_rate_reported(self):
+        # pretend we've been busy
+        self.sampler._names['foo'] = [1e12, 0, 100.0, 0.5]
+        for i in range(100):
+            self.client.incr('foo')
+            with self.client.timer('foo'):
+                pass
+        msgs = self.sender.find(name='foo')
+        ok_(0 < len(msgs) < 200)
+        ok_(all(msg['fields']['rate'] == 0.5 for msg in msgs))
+
+    def test_config(self):
+        cfg_txt = """
+        [metlog]
+        sender_class = metlog.senders.DebugCaptureSender
+        sampler_class = metlog.sampling.AdaptiveSampler
+        sampler_target = 25
+        """
+        client = client_from_text_config(cfg_txt, 'metlog')
+        ok_(isinstance(client.sampler, AdaptiveSampler))
+        eq_(client.sampler.target, 25)
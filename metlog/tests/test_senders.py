@@ -13,17 +13,24 @@
 #
 # ***** END LICENSE BLOCK *****
 from metlog.client import SEVERITY
+from metlog.senders import aio
 from metlog.senders.udp import UdpSender
-from metlog.senders.dev import StdOutSender
+from metlog.client import MetlogClient
+from metlog.senders.dev import IndexedCaptureSender, StdOutSender
 from metlog.senders.logging import StdLibLoggingSender
+from metlog.senders.resilient import CircuitBreakerSender, FailoverSender
+from metlog.senders.ring import RingBufferSender, read_ring
 from metlog.senders.zmq import ZmqPubSender, zmq
-from mock import patch
+from mock import Mock, patch
 from nose.plugins.skip import SkipTest
-from nose.tools import eq_, raises
+from nose.tools import eq_, ok_, raises
 
 import sys
 import json
 import logging
+import os
+import shutil
+import tempfile
 import threading
 import time
 import StringIO
@@ -145,15 +152,19 @@ class TestLoggingSender(object):
         for msg in self.msgs:
             sender.send_message(msg)
 
+    def _logged(self, log):
+        # JSON output is passed through lazily, so compare rendered values
+        return [(args[0], str(args[1])) for args, kwargs in log.call_args_list]
+
     def test_defaults(self, mock_logging):
         sender = self._make_one()
         self._send_em(sender)
         log = mock_logging.getLogger().log
         eq_(log.call_count, 4)
-        log.assert_any_call(logging.WARN, 'oldstyle')
-        log.assert_any_call(logging.ERROR, json.dumps(self.msgs[1]))
-        log.assert_any_call(logging.INFO, json.dumps(self.msgs[2]))
-        log.assert_called_with(logging.DEBUG, json.dumps(self.msgs[3]))
+        ok_((logging.WARN, 'oldstyle') in self._logged(log))
+        ok_((logging.ERROR, json.dumps(self.msgs[1])) in self._logged(log))
+        ok_((logging.INFO, json.dumps(self.msgs[2])) in self._logged(log))
+        ok_((logging.DEBUG, json.dumps(self.msgs[3])) in self._logged(log))
 
     def test_alternate_logger_name(self, mock_logging):
         name = 'logger_name'
@@ -161,10 +172,10 @@ class TestLoggingSender(object):
         self._send_em(sender)
         log = mock_logging.getLogger(name).log
         eq_(log.call_count, 4)
-        log.assert_any_call(logging.WARN, 'oldstyle')
-        log.assert_any_call(logging.ERROR, json.dumps(self.msgs[1]))
-        log.assert_any_call(logging.INFO, json.dumps(self.msgs[2]))
-        log.assert_called_with(logging.DEBUG, json.dumps(self.msgs[3]))
+        ok_((logging.WARN, 'oldstyle') in self._logged(log))
+        ok_((logging.ERROR, json.dumps(self.msgs[1])) in self._logged(log))
+        ok_((logging.INFO, json.dumps(self.msgs[2])) in self._logged(log))
+        ok_((logging.DEBUG, json.dumps(self.msgs[3])) in self._logged(log))
 
     def test_specific_types(self, mock_logging):
         sender = self._make_one(payload_types=['this', 'that'],
@@ -172,19 +183,188 @@ class TestLoggingSender(object):
         self._send_em(sender)
         log = mock_logging.getLogger().log
         eq_(log.call_count, 3)
-        log.assert_any_call(logging.ERROR, 'this')
-        log.assert_any_call(logging.INFO, 'that')
-        log.assert_called_with(logging.DEBUG, json.dumps(self.msgs[3]))
+        ok_((logging.ERROR, 'this') in self._logged(log))
+        ok_((logging.INFO, 'that') in self._logged(log))
+        ok_((logging.DEBUG, json.dumps(self.msgs[3])) in self._logged(log))
 
     def test_payload_all(self, mock_logging):
         sender = self._make_one(payload_types=['*'])
         self._send_em(sender)
         log = mock_logging.getLogger().log
         eq_(log.call_count, 4)
-        log.assert_any_call(logging.WARN, 'oldstyle')
-        log.assert_any_call(logging.ERROR, 'this')
-        log.assert_any_call(logging.INFO, 'that')
-        log.assert_any_call(logging.DEBUG, 'the other')
+        ok_((logging.WARN, 'oldstyle') in self._logged(log))
+        ok_((logging.ERROR, 'this') in self._logged(log))
+        ok_((logging.INFO, 'that') in self._logged(log))
+        ok_((logging.DEBUG, 'the other') in self._logged(log))
+
+
+class TestLoggingSenderLevels(object):
+    class Unserializable(object):
+        pass
+
+    def setUp(self):
+        self.logger = logging.getLogger('metlog.tests.levels')
+        self.logger.setLevel(logging.WARN)
+        self.logger.propagate = False
+        self.records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: self.records.append(record.getMessage())
+        self.logger.handlers = [handler]
+        self.sender = StdLibLoggingSender('metlog.tests.levels')
+
+    def tearDown(self):
+        self.logger.handlers = []
+
+    def test_disabled_level_skips_serialization(self):
+        # would blow up if we tried to serialize it
+        msg = {'type': 'test', 'severity': SEVERITY.DEBUG,
+               'payload': self.Unserializable()}
+        self.sender.send_message(msg)
+        eq_(self.records, [])
+
+    def test_enabled_level_serialized(self):
+        msg = {'type': 'test', 'severity': SEVERITY.ERROR, 'payload': 'boo'}
+        self.sender.send_message(msg)
+        eq_(self.records, [json.dumps(msg)])
+
+    def test_level_change_picked_up(self):
+        msg = {'type': 'test', 'severity': SEVERITY.DEBUG, 'payload': 'boo'}
+        self.logger.setLevel(logging.DEBUG)
+        self.sender.send_message(msg)
+        eq_(self.records, [json.dumps(msg)])
+        self.logger.setLevel(logging.WARN)
+        self.sender.send_message(msg)
+        eq_(len(self.records), 1)
+
+    def test_parent_level_change_picked_up(self):
+        msg = {'type': 'test', 'severity': SEVERITY.DEBUG, 'payload': 'boo'}
+        self.logger.setLevel(logging.NOTSET)
+        parent = logging.getLogger('metlog.tests')
+        old_level = parent.level
+        parent.setLevel(logging.DEBUG)
+        try:
+            self.sender.send_message(msg)
+        finally:
+            parent.setLevel(old_level)
+        eq_(self.records, [json.dumps(msg)])
+
+    def test_logging_disable_picked_up(self):
+        msg = {'type': 'test', 'severity': SEVERITY.ERROR, 'payload': 'boo'}
+        logging.disable(logging.CRITICAL)
+        try:
+            self.sender.send_message(msg)
+        finally:
+            logging.disable(logging.NOTSET)
+        eq_(self.records, [])
+        self.sender.send_message(msg)
+        eq_(self.records, [json.dumps(msg)])
+
+
+class TestIndexedCaptureSender(object):
+    def setUp(self):
+        self.sender = IndexedCaptureSender(capacity=5)
+        self.client = MetlogClient(self.sender, 'tests')
+
+    def test_find(self):
+        self.client.incr('hits')
+        self.client.timer_send('db', 10)
+        self.client.timer_send('db', 20, logger='other')
+        self.client.error('oops')
+        eq_(len(self.sender), 4)
+        timers = self.sender.find(type='timer', name='db')
+        eq_([msg['payload'] for msg in timers], ['10', '20'])
+        eq_(len(self.sender.find(type='timer', logger='tests')), 1)
+        eq_(self.sender.find(severity=SEVERITY.ERROR)[0]['payload'], 'oops')
+        eq_(self.sender.find_one(name='db')['payload'], '20')
+        eq_(self.sender.find(type='nope'), [])
+        eq_(self.sender.find_one(type='nope'), None)
+
+    def test_find_unindexed(self):
+        self.client.incr('hits', fields={'user': 'bob'})
+        self.client.incr('hits', fields={'user': 'ann'})
+        eq_(len(self.sender.find(user='ann')), 1)
+        eq_(len(self.sender.find(type='counter', payload='1')), 2)
+
+    def test_capacity(self):
+        for i in range(8):
+            self.client.timer_send('t%d' % (i % 2), i)
+        eq_(len(self.sender), 5)
+        eq_([msg['payload'] for msg in self.sender.find(type='timer')],
+            ['3', '4', '5', '6', '7'])
+        eq_([msg['payload'] for msg in self.sender.find(name='t0')],
+            ['4', '6'])
+        self.sender.clear()
+        eq_(self.sender.find(type='timer'), [])
+
+    def test_snapshot_fields(self):
+        fields = {'foo': 'bar'}
+        self.client.metlog('test', fields=fields)
+        fields['foo'] = 'baz'
+        eq_(self.sender.find_one(type='test')['fields'], {'foo': 'bar'})
+
+
+class TestRingBufferSender(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'metlog.ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_one(self, size=1024):
+        return RingBufferSender(self.path, size=size)
+
+    def _read_msgs(self):
+        gen, records = read_ring(self.path)
+        return [json.loads(record) for record in records]
+
+    def test_roundtrip(self):
+        sender = self._make_one()
+        msgs = [{'type': 'test', 'payload': str(i)} for i in range(5)]
+        for msg in msgs:
+            sender.send_message(msg)
+        eq_(self._read_msgs(), msgs)
+
+    def test_wraparound_keeps_newest_in_order(self):
+        sender = self._make_one(size=256)
+        for i in range(100):
+            sender.send_message({'payload': str(i)})
+        payloads = [int(msg['payload']) for msg in self._read_msgs()]
+        ok_(len(payloads) > 1)
+        eq_(payloads[-1], 99)
+        eq_(payloads, range(payloads[0], 100))
+        ok_(read_ring(self.path)[0] > 1)
+
+    def test_oversized_dropped(self):
+        sender = self._make_one(size=64)
+        sender.send_message({'payload': 'x' * 100})
+        sender.send_message({'payload': 'y'})
+        eq_(self._read_msgs(), [{'payload': 'y'}])
+
+    def test_reopen_starts_new_generation(self):
+        sender = self._make_one()
+        sender.send_message({'payload': 'old'})
+        gen, records = read_ring(self.path)
+        sender.stream.close()
+        self._make_one()
+        new_gen, records = read_ring(self.path)
+        eq_(records, [])
+        ok_(new_gen > gen)
+
+    def test_reopen_preserves_previous_ring(self):
+        sender = self._make_one()
+        sender.send_message({'payload': 'before crash'})
+        gen, records = read_ring(self.path)
+        sender.stream.close()
+        sender = self._make_one()
+        prev_gen, prev_records = read_ring(self.path + '.prev')
+        eq_(prev_gen, gen)
+        eq_([json.loads(record) for record in prev_records],
+            [{'payload': 'before crash'}])
+        # an empty ring isn't worth keeping, the old one stays in place
+        sender.stream.close()
+        self._make_one()
+        eq_(read_ring(self.path + '.prev')[1], prev_records)
 
 
 class TestUdpSender(object):
@@ -353,3 +533,295 @@ class TestUDPUnicode(object):
         eq_(self.mock_socket.sendto.call_count, 1)
         write_args = self.mock_socket.sendto.call_args_list
         eq_(json.loads(write_args[0][0][0]), u"User (%s)" % msg)
+
+
+class _Listener(object):
+    """Local datagram endpoint collecting whatever it receives."""
+    def __init__(self):
+        self.received = []
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.received.append(json.loads(data))
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class TestAsyncioUdpSender(object):
+    def setUp(self):
+        if aio.asyncio is None:
+            raise SkipTest
+        self.loop = aio.asyncio.new_event_loop()
+        self.listener = _Listener()
+        transport, protocol = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                lambda: self.listener, local_addr=('127.0.0.1', 0)))
+        self.listen_transport = transport
+        self.port = transport.get_extra_info('sockname')[1]
+
+    def tearDown(self):
+        self.listen_transport.close()
+        self.loop.close()
+
+    def _make_one(self, **kwargs):
+        sender = aio.AsyncioUdpSender('127.0.0.1', self.port, loop=self.loop,
+                                      **kwargs)
+        self.loop.run_until_complete(aio.asyncio.sleep(0.01, loop=self.loop))
+        return sender
+
+    def _run(self, seconds=0.05):
+        self.loop.run_until_complete(aio.asyncio.sleep(seconds,
+                                                       loop=self.loop))
+
+    def test_send(self):
+        sender = self._make_one()
+        ok_(sender.connected)
+        sender.send_message({'payload': 'one'})
+        sender.send_message({'payload': 'two'})
+        self._run()
+        eq_([msg['payload'] for msg in self.listener.received],
+            ['one', 'two'])
+        eq_(sender.sent, 2)
+        eq_(sender.dropped, 0)
+        sender.close()
+
+    def test_pending_until_connected(self):
+        sender = aio.AsyncioUdpSender('127.0.0.1', self.port, loop=self.loop)
+        ok_(not sender.connected)
+        sender.send_message({'payload': 'early'})
+        self._run()
+        eq_(self.listener.received, [{'payload': 'early'}])
+        sender.close()
+
+    def test_batched(self):
+        sender = self._make_one(flush_interval=0.05)
+        for i in range(5):
+            sender.send_message({'payload': i})
+        # nothing written until the flush callback fires
+        eq_(sender.sent, 0)
+        self._run(0.1)
+        eq_(len(self.listener.received), 5)
+        eq_(sender.sent, 5)
+        sender.close()
+
+    def test_max_pending(self):
+        sender = self._make_one(flush_interval=10, max_pending=3)
+        for i in range(5):
+            sender.send_message({'payload': i})
+        eq_(sender.dropped, 2)
+        sender.close()
+        self._run()
+        eq_(len(self.listener.received), 3)
+
+    def test_paused_drops(self):
+        sender = self._make_one()
+        protocol = sender._transport._protocol
+        protocol.pause_writing()
+        sender.send_message({'payload': 'dropped'})
+        eq_(sender.dropped, 1)
+        protocol.resume_writing()
+        sender.send_message({'payload': 'kept'})
+        self._run()
+        eq_(self.listener.received, [{'payload': 'kept'}])
+        sender.close()
+
+    def test_pause_during_flush(self):
+        sender = self._make_one(flush_interval=10)
+        for i in range(3):
+            sender.send_message({'payload': i})
+        protocol = sender._transport._protocol
+        sendto = sender._transport.sendto
+
+        def pausing_sendto(data):
+            sendto(data)
+            protocol.pause_writing()
+        with patch.object(sender._transport, 'sendto', pausing_sendto):
+            sender.flush()
+        eq_(sender.sent, 1)
+        eq_(sender.dropped, 2)
+        sender.close()
+
+
+@patch('metlog.senders.resilient.time')
+class TestCircuitBreakerSender(object):
+    def setUp(self):
+        self.inner = IndexedCaptureSender()
+        self.inner.send_message = Mock(wraps=self.inner.send_message)
+        self.sender = CircuitBreakerSender(self.inner, failure_threshold=2,
+                                           reset_timeout=10, spool_size=2)
+
+    def _fail(self, msg):
+        try:
+            self.sender.send_message(msg)
+        except IOError:
+            pass
+        else:
+            raise AssertionError('IOError not raised')
+
+    def _open(self, mock_time):
+        mock_time.time.return_value = 100
+        self.inner.send_message.side_effect = IOError
+        self._fail({'payload': 'fail 1'})
+        eq_(self.sender.state, 'closed')
+        self._fail({'payload': 'fail 2'})
+        eq_(self.sender.state, 'open')
+
+    def test_opens_after_consecutive_failures(self, mock_time):
+        mock_time.time.return_value = 100
+        self.inner.send_message.side_effect = IOError
+        self._fail({'payload': 'fail'})
+        # a success resets the failure count
+        self.inner.send_message.side_effect = None
+        self.sender.send_message({'payload': 'ok'})
+        eq_(self.sender.failures, 0)
+        self._open(mock_time)
+        eq_(self.sender.stats()['opened'], 1)
+
+    def test_open_skips_and_spools(self, mock_time):
+        self._open(mock_time)
+        calls = self.inner.send_message.call_count
+        for i in range(3):
+            self.sender.send_message({'payload': 'skipped %d' % i})
+        eq_(self.inner.send_message.call_count, calls)
+        stats = self.sender.stats()
+        eq_(stats['spooled'], 2)
+        eq_(stats['skipped'], 1)
+
+    def test_probe_failure_reopens(self, mock_time):
+        self._open(mock_time)
+        mock_time.time.return_value = 109
+        self.sender.send_message({'payload': 'skipped'})
+        mock_time.time.return_value = 110
+        self._fail({'payload': 'probe'})
+        eq_(self.sender.state, 'open')
+        eq_(self.sender.opened, 2)
+        # open for another full timeout
+        mock_time.time.return_value = 119
+        self.sender.send_message({'payload': 'skipped'})
+        eq_(self.sender.stats()['spooled'], 2)
+
+    def test_probe_success_closes_and_replays(self, mock_time):
+        self._open(mock_time)
+        self.sender.send_message({'payload': 'spooled 1'})
+        self.sender.send_message({'payload': 'spooled 2'})
+        mock_time.time.return_value = 110
+        self.inner.send_message.side_effect = None
+        self.sender.send_message({'payload': 'probe'})
+        eq_(self.sender.state, 'closed')
+        eq_([msg['payload'] for msg in self.inner.msgs],
+            ['probe', 'spooled 1', 'spooled 2'])
+        stats = self.sender.stats()
+        eq_(stats['replayed'], 2)
+        eq_(stats['spooled'], 0)
+
+    def test_replay_failure_reopens(self, mock_time):
+        self._open(mock_time)
+        self.sender.send_message({'payload': 'spooled'})
+        mock_time.time.return_value = 110
+        self.inner.send_message.side_effect = [None, IOError]
+        self.sender.send_message({'payload': 'probe'})
+        eq_(self.sender.state, 'open')
+        eq_(self.sender.stats()['spooled'], 1)
+
+    def test_configured_from_kwargs(self, mock_time):
+        sender = CircuitBreakerSender(
+            sender_class='metlog.senders.dev.IndexedCaptureSender',
+            sender_capacity=5)
+        ok_(isinstance(sender.sender, IndexedCaptureSender))
+        eq_(sender.sender.capacity, 5)
+        eq_(sender.stats()['state'], 'closed')
+
+    @raises(TypeError)
+    def test_unexpected_kwargs(self, mock_time):
+        CircuitBreakerSender(self.inner, bogus=1)
+
+
+@patch('metlog.senders.resilient.time')
+class TestFailoverSender(object):
+    def setUp(self):
+        self.relay = IndexedCaptureSender()
+        self.relay.send_message = Mock(wraps=self.relay.send_message)
+        self.backup = IndexedCaptureSender()
+        self.sender = FailoverSender([self.relay, self.backup],
+                                     failure_threshold=2, probe_interval=10)
+
+    def _payloads(self, sender):
+        return [msg['payload'] for msg in sender.msgs]
+
+    def test_primary_used_while_healthy(self, mock_time):
+        mock_time.time.return_value = 100
+        self.sender.send_message({'payload': 'one'})
+        eq_(self._payloads(self.relay), ['one'])
+        eq_(len(self.backup), 0)
+
+    def test_failed_message_retried_on_backup(self, mock_time):
+        mock_time.time.return_value = 100
+        self.relay.send_message.side_effect = IOError
+        self.sender.send_message({'payload': 'one'})
+        eq_(self._payloads(self.backup), ['one'])
+        # below the failure threshold, the relay stays active
+        eq_(self.sender.active, 0)
+        self.sender.send_message({'payload': 'two'})
+        eq_(self.sender.active, 1)
+        stats = self.sender.stats()
+        eq_(stats['switches'], 1)
+        eq_(stats['senders'][0]['down'], True)
+        # the backup now gets messages directly
+        calls = self.relay.send_message.call_count
+        self.sender.send_message({'payload': 'three'})
+        eq_(self.relay.send_message.call_count, calls)
+        eq_(self._payloads(self.backup), ['one', 'two', 'three'])
+
+    def test_probe_switches_back(self, mock_time):
+        mock_time.time.return_value = 100
+        self.relay.send_message.side_effect = IOError
+        self.sender.send_message({'payload': 'one'})
+        self.sender.send_message({'payload': 'two'})
+        eq_(self.sender.active, 1)
+        # failed probe, the message still goes to the backup
+        mock_time.time.return_value = 110
+        self.sender.send_message({'payload': 'three'})
+        eq_(self.sender.active, 1)
+        eq_(self._payloads(self.backup), ['one', 'two', 'three'])
+        # no probe until the interval has passed again
+        calls = self.relay.send_message.call_count
+        self.sender.send_message({'payload': 'four'})
+        eq_(self.relay.send_message.call_count, calls)
+        self.relay.send_message.side_effect = None
+        mock_time.time.return_value = 120
+        self.sender.send_message({'payload': 'five'})
+        eq_(self.sender.active, 0)
+        eq_(self._payloads(self.relay), ['five'])
+        stats = self.sender.stats()
+        eq_(stats['probes'], 2)
+        eq_(stats['switches'], 2)
+        eq_(stats['senders'][0]['down'], False)
+
+    @raises(IOError)
+    def test_all_senders_fail(self, mock_time):
+        mock_time.time.return_value = 100
+        self.relay.send_message.side_effect = IOError
+        self.backup.send_message = Mock(side_effect=ValueError)
+        try:
+            self.sender.send_message({'payload': 'lost'})
+        finally:
+            eq_(self.sender.stats()['errors'], 1)
+
+    def test_configured_from_kwargs(self, mock_time):
+        sender = FailoverSender(
+            sender2_class='metlog.senders.dev.IndexedCaptureSender',
+            sender2_capacity=5,
+            sender1_class='metlog.senders.dev.DebugCaptureSender')
+        eq_([type(s).__name__ for s in sender.senders],
+            ['DebugCaptureSender', 'IndexedCaptureSender'])
+        eq_(sender.senders[1].capacity, 5)
+
+    @raises(TypeError)
+    def test_unexpected_kwargs(self, mock_time):
+        FailoverSender([self.relay], bogus=1)
@@ -24,7 +24,7 @@ timer_name = 'test'
 
 def _make_em():
     mock_client = Mock(spec=MetlogClient)
-    timer = _Timer(mock_client, timer_name, {})
+    timer = _Timer(mock_client, timer_name)
     return mock_client, timer
 
 
@@ -64,16 +64,81 @@ def test_decorator():
 
 def test_attrs_threadsafe():
     mock_client, timer = _make_em()
+    results = {}
 
-    def reentrant(val):
-        sentinel = object()
-        if getattr(timer, 'value', sentinel) is not sentinel:
-            ok_(False, "timer.value already exists in new thread")
-        timer.value = val
+    def timed(sleep):
+        with timer:
+            time.sleep(sleep)
+        results[threading.current_thread().name] = timer.result
 
-    t0 = threading.Thread(target=reentrant, args=(10,))
-    t1 = threading.Thread(target=reentrant, args=(100,))
+    # the slow thread enters first and exits last, so its start time would
+    # get clobbered if the timer state were shared
+    t0 = threading.Thread(target=timed, args=(0.05,), name='slow')
+    t1 = threading.Thread(target=timed, args=(0.01,), name='fast')
     t0.start()
-    time.sleep(0.01)  # give it enough time to be sure timer.value is set
-    t1.start()  # this will raise assertion error if timer.value from other
-                # thread leaks through
+    time.sleep(0.01)
+    t1.start()
+    t0.join()
+    t1.join()
+    ok_(results['slow'] >= 50)
+    ok_(results['fast'] < 50)
+    # nothing leaks into the main thread either
+    ok_(timer.result is None)
+    eq_(mock_client.timer_send.call_count, 2)
+
+
+def test_microseconds():
+    mock_client, timer = _make_em()
+    timer = _Timer(mock_client, timer_name, units='us')
+    with timer:
+        time.sleep(0.01)
+    timing_args = mock_client.timer_send.call_args
+    ok_(timing_args[0][1] >= 10000)
+    eq_(timing_args[1], {'units': 'us'})
+
+
+def test_msg_data_passed_through():
+    mock_client, timer = _make_em()
+    timer = _Timer(mock_client, timer_name, ('logger', 3, {'a': 1}, 0.5))
+    with timer:
+        pass
+    eq_(mock_client.timer_send.call_args[0][2:],
+        ('logger', 3, {'a': 1}, 0.5))
+
+
+def test_state_doesnt_keep_timer_alive():
+    import gc
+    import weakref
+    mock_client, timer = _make_em()
+    with timer:
+        pass
+    ref = weakref.ref(timer)
+    del timer
+    gc.collect()
+    ok_(ref() is None)
+
+
+def test_state_dropped_w_timer():
+    from metlog.client import _timer_states
+    mock_client, timer = _make_em()
+    with timer:
+        pass
+    count = len(_timer_states())
+    del timer
+    eq_(len(_timer_states()), count - 1)
+
+
+def test_state_dropped_w_thread():
+    import gc
+    import weakref
+    from metlog.client import _timer_local, _timer_states
+    mock_client, timer = _make_em()
+    with timer:
+        pass
+    ref = weakref.ref(_timer_states())
+    # what happens to the thread local's dict when the thread exits
+    del _timer_local.states
+    gc.collect()
+    # the timer doesn't keep the thread's state alive
+    ok_(ref() is None)
+    ok_(timer.result is None)
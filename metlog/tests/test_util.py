@@ -0,0 +1,127 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+from metlog.util import ContextLocal, HyperLogLog, LRUCache, SpaceSaving
+from metlog.util import hash_fraction
+from nose.tools import eq_, ok_, raises
+
+import threading
+
+
+def test_lru_eviction():
+    evicted = []
+    cache = LRUCache(2, on_evict=lambda k, v: evicted.append((k, v)))
+    cache['a'] = 1
+    cache['b'] = 2
+    eq_(cache.get('a'), 1)  # 'b' is now least recently used
+    cache['c'] = 3
+    eq_(evicted, [('b', 2)])
+    eq_(len(cache), 2)
+    ok_('b' not in cache)
+    eq_(cache.items(), [('a', 1), ('c', 3)])
+
+
+def test_lru_update_and_pop():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a'] = 10
+    eq_(cache.keys(), ['b', 'a'])
+    eq_(cache.pop('b'), 2)
+    eq_(cache.pop('b', None), None)
+    eq_(cache['a'], 10)
+    cache.clear()
+    eq_(len(cache), 0)
+    eq_(cache.items(), [])
+
+
+@raises(KeyError)
+def test_lru_missing():
+    LRUCache(1)['nope']
+
+
+def test_hyperloglog():
+    hll = HyperLogLog()
+    eq_(len(hll), 0)
+    for i in range(3):
+        for j in range(20000):
+            hll.add('user%d' % j)
+    ok_(abs(len(hll) - 20000) < 20000 * 0.1, len(hll))
+    hll.clear()
+    ok_(hll.add('foo'))
+    ok_(not hll.add('foo'))
+    eq_(len(hll), 1)
+
+
+def test_hash_fraction():
+    eq_(hash_fraction('foo'), hash_fraction(u'foo'))
+    eq_(hash_fraction(10), hash_fraction('10'))
+    ok_(0 <= hash_fraction('bar') < 1)
+    eq_(hash_fraction('foo', 'salt'), hash_fraction(u'foo', 'salt'))
+    ok_(hash_fraction('foo', 'salt') != hash_fraction('foo'))
+
+
+def test_context_local():
+    local = ContextLocal()
+    local.value = 'main'
+    seen = []
+
+    def other():
+        seen.append(getattr(local, 'value', None))
+        local.value = 'other'
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    thread.join()
+    eq_(seen, [None])
+    eq_(local.value, 'main')
+    del local.value
+    ok_(not hasattr(local, 'value'))
+
+
+def test_space_saving():
+    sketch = SpaceSaving(10)
+    # a few heavy hitters in a long tail of one-off keys
+    for i in range(5000):
+        sketch.add('tail%d' % i)
+        if i % 4 == 0:
+            sketch.add('hot')
+        if i % 10 == 0:
+            sketch.add('warm', 2)
+    eq_(len(sketch), 10)
+    eq_(sketch.total, 5000 + 1250 + 1000)
+    top = sketch.top(2)
+    eq_([entry[0] for entry in top], ['hot', 'warm'])
+    for (key, count, error), true_count in zip(top, [1250, 1000]):
+        # counts may be overestimated, but never by more than `error`
+        ok_(count - error <= true_count <= count)
+
+
+def test_space_saving_replaces_lowest():
+    import random
+    rand = random.Random(42)
+    sketch = SpaceSaving(5)
+    for i in range(2000):
+        key = 'key%d' % int(rand.expovariate(0.2))
+        full = len(sketch) == sketch.capacity
+        if full and key not in sketch._counters:
+            lowest = min(count for count, error in
+                         sketch._counters.values())
+            count = rand.randint(1, 3)
+            sketch.add(key, count)
+            # the replaced counter was (one of) the lowest
+            eq_(sketch._counters[key], [lowest + count, lowest])
+        else:
+            sketch.add(key, rand.randint(1, 3))
+        eq_(sum(count for count, error in sketch._counters.values()),
+            sketch.total)
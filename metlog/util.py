@@ -0,0 +1,314 @@
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2012
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Rob Miller (rmiller@mozilla.com)
+#
+# ***** END LICENSE BLOCK *****
+"""
+Small data structure helpers shared by the client, filters and senders.
+"""
+import heapq
+import itertools
+import math
+import threading
+import zlib
+
+try:
+    # per greenlet, and per thread outside of gevent; monkeypatching
+    # `threading.local` only helps if it happens before this module is
+    # imported, so don't depend on it
+    from gevent.local import local as ContextLocal
+except ImportError:
+    ContextLocal = threading.local
+
+
+def hash_fraction(key, salt=None):
+    """
+    Deterministically map `key` to a float in [0, 1). Uses CRC32 rather than
+    `hash` so that the result is the same across processes, platforms and
+    hosts, which lets separate services make the same sampling decision for a
+    shared request id.
+
+    :param key: Value to hash.
+    :param salt: Optional string mixed into the hash. Sampling stages that
+                 use different salts make independent decisions for the same
+                 key, so their rates can be multiplied.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    elif not isinstance(key, str):
+        key = str(key)
+    value = zlib.crc32(key) & 0xffffffff
+    if salt:
+        # CRC32 is linear, so prefixing the salt would leave the results
+        # correlated; scramble the combined bits instead
+        value = _mix64(value | (zlib.crc32(salt) & 0xffffffff) << 32) >> 32
+    return value / 4294967296.0
+
+
+# indexes into the LRU linked list nodes
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """
+    Dictionary-like mapping w/ a maximum size. Once full, adding a new key
+    evicts the least recently used entry. Both `get` and `__setitem__` count
+    as a use. All operations are O(1). Not thread safe, callers that share
+    an instance across threads must provide their own locking.
+    """
+    def __init__(self, maxsize, on_evict=None):
+        """
+        :param maxsize: Maximum number of entries to hold.
+        :param on_evict: Optional callable that will be passed the key and
+                         value of each evicted entry.
+        """
+        if maxsize < 1:
+            raise ValueError('LRUCache maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._map = {}
+        # circular doubly linked list, the root's NEXT is the least recently
+        # used node and its PREV the most recently used
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def _unlink(self, node):
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+
+    def _append(self, node):
+        root = self._root
+        last = root[_PREV]
+        node[_PREV] = last
+        node[_NEXT] = root
+        last[_NEXT] = root[_PREV] = node
+
+    def get(self, key, default=None):
+        """Return the value for `key` and mark it as recently used."""
+        node = self._map.get(key)
+        if node is None:
+            return default
+        self._unlink(node)
+        self._append(node)
+        return node[_VALUE]
+
+    def __getitem__(self, key):
+        node = self._map[key]
+        self._unlink(node)
+        self._append(node)
+        return node[_VALUE]
+
+    def __setitem__(self, key, value):
+        node = self._map.get(key)
+        if node is not None:
+            node[_VALUE] = value
+            self._unlink(node)
+            self._append(node)
+            return
+        if len(self._map) >= self.maxsize:
+            oldest = self._root[_NEXT]
+            self._unlink(oldest)
+            del self._map[oldest[_KEY]]
+            if self.on_evict is not None:
+                self.on_evict(oldest[_KEY], oldest[_VALUE])
+        node = [None, None, key, value]
+        self._append(node)
+        self._map[key] = node
+
+    def oldest(self):
+        """
+        Return the least recently used `(key, value)` pair w/o marking it as
+        used, or None if the cache is empty.
+        """
+        node = self._root[_NEXT]
+        if node is self._root:
+            return None
+        return node[_KEY], node[_VALUE]
+
+    def pop(self, key, *default):
+        """Remove `key` and return its value, w/o calling `on_evict`."""
+        node = self._map.pop(key, None)
+        if node is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._unlink(node)
+        return node[_VALUE]
+
+    def clear(self):
+        self._map.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def items(self):
+        """Return a list of `(key, value)` pairs, least recently used first."""
+        result = []
+        node = self._root[_NEXT]
+        while node is not self._root:
+            result.append((node[_KEY], node[_VALUE]))
+            node = node[_NEXT]
+        return result
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+
+_MASK64 = 0xffffffffffffffff
+
+
+def _mix64(value):
+    """
+    Scramble the bits of a 64-bit integer (MurmurHash3's finalizer), to
+    spread the builtin `hash` values of similar keys across all bit
+    positions.
+    """
+    value &= _MASK64
+    value ^= value >> 33
+    value = (value * 0xff51afd7ed558ccd) & _MASK64
+    value ^= value >> 33
+    value = (value * 0xc4ceb9fe1a85ec53) & _MASK64
+    value ^= value >> 33
+    return value
+
+
+class HyperLogLog(object):
+    """
+    Approximate distinct value counter using a fixed amount of memory
+    (2 ** `precision` bytes). The standard error is roughly
+    1.04 / sqrt(2 ** precision), i.e. about 3% w/ the default precision.
+    Values are hashed w/ the builtin `hash`, so sketches are only meaningful
+    within a single process.
+    """
+    def __init__(self, precision=10):
+        """
+        :param precision: Number of hash bits used to pick a register,
+                          btn 4 and 16.
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError('HyperLogLog precision must be btn 4 and 16')
+        self.precision = precision
+        self._size = 1 << precision
+        self._registers = bytearray(self._size)
+        self._rank_bits = 64 - precision
+        if self._size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / self._size)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self._size]
+        self._alpha_mm = alpha * self._size * self._size
+
+    def add(self, value):
+        """
+        Add a value to the sketch. Returns True if the sketch changed, i.e.
+        if the estimate may have changed.
+        """
+        hashed = _mix64(hash(value))
+        index = hashed >> self._rank_bits
+        remainder = hashed & ((1 << self._rank_bits) - 1)
+        # position of the leftmost 1 bit in the remaining bits
+        rank = self._rank_bits - remainder.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+            return True
+        return False
+
+    def estimate(self):
+        """Return the estimated number of distinct values added."""
+        registers = self._registers
+        total = 0.0
+        zeros = 0
+        for register in registers:
+            total += 2.0 ** -register
+            if not register:
+                zeros += 1
+        estimate = self._alpha_mm / total
+        if estimate <= 2.5 * self._size and zeros:
+            # small range correction, linear counting
+            estimate = self._size * math.log(float(self._size) / zeros)
+        return estimate
+
+    def clear(self):
+        self._registers = bytearray(self._size)
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+
+class SpaceSaving(object):
+    """
+    Tracks the most frequent keys of a stream using a fixed number of
+    counters (Metwally et al.'s Space-Saving algorithm). When a new key
+    shows up and all counters are taken, it replaces the key w/ the lowest
+    count and inherits that count as its potential overestimate. Any key
+    whose true count is above `total / capacity` is guaranteed to be
+    tracked.
+
+    The lowest counter is found through a min-heap w/ one entry per key.
+    Counts only grow, so an entry is allowed to fall behind its key's count
+    and is only refreshed once it reaches the top of the heap, which keeps
+    increments of tracked keys O(1) and replacements O(log capacity)
+    amortized.
+    """
+    def __init__(self, capacity):
+        """
+        :param capacity: Number of counters, i.e. the maximum number of keys
+                         tracked at once.
+        """
+        if capacity < 1:
+            raise ValueError('SpaceSaving capacity must be at least 1')
+        self.capacity = capacity
+        self.total = 0
+        # key -> [count, error]
+        self._counters = {}
+        # (count when pushed, sequence number, key) entries; the sequence
+        # number breaks ties so keys are never compared
+        self._heap = []
+        self._seq = itertools.count()
+
+    def add(self, key, count=1):
+        self.total += count
+        counters = self._counters
+        counter = counters.get(key)
+        if counter is not None:
+            counter[0] += count
+            return
+        heap = self._heap
+        if len(counters) < self.capacity:
+            counters[key] = [count, 0]
+            heapq.heappush(heap, (count, next(self._seq), key))
+            return
+        while True:
+            heap_count, seq, min_key = heap[0]
+            min_count = counters[min_key][0]
+            if min_count == heap_count:
+                break
+            # stale entry, put it back w/ the current count
+            heapq.heapreplace(heap, (min_count, next(self._seq), min_key))
+        del counters[min_key]
+        counters[key] = [min_count + count, min_count]
+        heapq.heapreplace(heap, (min_count + count, next(self._seq), key))
+
+    def top(self, k):
+        """
+        Return up to `k` `(key, count, error)` tuples, highest count first.
+        Each `count` may overestimate the true count by at most `error`.
+        """
+        ranked = sorted(self._counters.iteritems(),
+                        key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in ranked[:k]]
+
+    def __len__(self):
+        return len(self._counters)
@@ -52,6 +52,7 @@ setup(name='metlog-py',
       entry_points={
           'console_scripts': [
               'mb = metlog.command:mb',
+              'mbtimer = metlog.command:mbtimer',
               ],
           },
       )